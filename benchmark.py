@@ -0,0 +1,505 @@
+# This file contains benchmarks for the compression code. It doesn't
+# need the game's files--it generates synthetic data that looks roughly like
+# the game's files. A real file can be benchmarked with the -f option.
+#
+# Running with --suite benchmarks every synthetic corpus across a range of
+# window sizes and compression levels, and can save the results as JSON.
+# Passing --baseline compares the results against a saved run, and fails
+# if throughput or compression ratio got noticeably worse. Throughput is
+# compared relative to a fixed reference workload that's timed in turns with
+# each result, so a baseline saved on one machine can be compared against on
+# another.
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import struct
+import time
+import tracemalloc
+
+import compression
+import compression_numpy
+from util import *
+
+# Roughly the size of overlay_golf.bin.
+DEFAULT_DATA_SIZE = 0x100000
+
+# Size of each corpus in the benchmark suite. It's smaller than a real
+# overlay, so the whole suite runs in a reasonable amount of time.
+DEFAULT_SUITE_DATA_SIZE = 0x20000
+
+SUITE_WINDOW_SIZES = [256, 1024, compression.LZ_MAX_WINDOW_SIZE]
+
+# How much worse a suite result can be than the baseline before it counts
+# as a regression. Throughput is compared as a fraction of the baseline's
+# speed relative to the reference workload, and compression ratio as an
+# absolute difference.
+DEFAULT_MAX_SLOWDOWN = 0.25
+DEFAULT_MAX_RATIO_INCREASE = 0.005
+
+# Each suite timing is repeated at least this many times, and for at least
+# SUITE_MIN_SECONDS in total, to smooth out noise. Quick operations like
+# decompression are run more times than slow ones.
+DEFAULT_SUITE_REPEAT = 3
+SUITE_MIN_SECONDS = 0.5
+
+# Throughput fields of each suite result, as multiples of the reference
+# workload's throughput. These are what's compared against the baseline.
+SUITE_SPEED_FIELDS = ("compress_relative", "decompress_relative")
+
+# A result that's slower than the baseline is benchmarked up to this many
+# more times before it counts as a regression.
+SUITE_RECHECKS = 2
+
+SUITE_VERSION = 2
+
+
+def make_overlay_data(size, seed=0):
+    """
+    Generates synthetic data that resembles a code overlay: runs of
+    PowerPC-like instructions, float tables, and zero padding.
+    """
+    rng = random.Random(seed)
+    opcodes = [rng.getrandbits(16) << 16 for _ in range(48)]
+    data = bytearray()
+    while len(data) < size:
+        kind = rng.random()
+        if kind < 0.6:
+            # Instructions: a small set of opcodes with varying operands.
+            for _ in range(rng.randint(16, 256)):
+                data.extend(struct.pack(">I", rng.choice(opcodes) | rng.getrandbits(8)))
+        elif kind < 0.85:
+            # Float tables.
+            base = rng.uniform(-1000.0, 1000.0)
+            for _ in range(rng.randint(8, 128)):
+                data.extend(struct.pack(">f", base + rng.uniform(-50.0, 50.0)))
+        else:
+            # Zero padding.
+            data.extend(bytes(rng.randint(4, 1024)))
+
+    return bytearray(data[:size])
+
+
+def make_code_data(size, seed=0):
+    """
+    Generates synthetic PowerPC code: functions with the usual stack frame
+    prologue and epilogue, and bodies of loads, stores, arithmetic and
+    branches on a handful of registers.
+    """
+    rng = random.Random(seed)
+    registers = [0, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 29, 30, 31]
+    # Primary opcodes for addi, lwz, stw, lfs, stfs, ori and cmpwi.
+    dform_opcodes = [14, 32, 36, 48, 52, 24, 11]
+    data = bytearray()
+    while len(data) < size:
+        frame_size = rng.choice([0x10, 0x20, 0x30, 0x40, 0x60])
+        data.extend(struct.pack(">I", 0x94210000 | (-frame_size & 0xFFFF)))  # stwu r1, -frame_size(r1)
+        data.extend(struct.pack(">I", 0x7C0802A6))  # mflr r0
+        data.extend(struct.pack(">I", 0x90010000 | (frame_size + 4)))  # stw r0, frame_size+4(r1)
+        for _ in range(rng.randint(8, 96)):
+            kind = rng.random()
+            if kind < 0.75:
+                opcode = rng.choice(dform_opcodes)
+                rd = rng.choice(registers)
+                ra = rng.choice(registers)
+                immediate = rng.choice([0, 4, 8, 0xC, 0x10, 0x14, 0x18, 0x1C, rng.getrandbits(16)])
+                data.extend(struct.pack(">I", (opcode << 26) | (rd << 21) | (ra << 16) | immediate))
+            elif kind < 0.9:
+                # bl to a nearby function.
+                data.extend(struct.pack(">I", (18 << 26) | ((rng.randint(-0x10000, 0x10000) * 4) & 0x3FFFFFC) | 1))
+            else:
+                # Conditional branch a few instructions ahead.
+                data.extend(struct.pack(">I", (16 << 26) | (rng.choice([4, 12]) << 21) | (rng.randint(1, 16) * 4)))
+        data.extend(struct.pack(">I", 0x80010000 | (frame_size + 4)))  # lwz r0, frame_size+4(r1)
+        data.extend(struct.pack(">I", 0x7C0803A6))  # mtlr r0
+        data.extend(struct.pack(">I", 0x38210000 | frame_size))  # addi r1, r1, frame_size
+        data.extend(struct.pack(">I", 0x4E800020))  # blr
+
+    return bytearray(data[:size])
+
+
+def make_float_table_data(size, seed=0):
+    """
+    Generates synthetic float tables laid out like the Ring Attack files:
+    a ring count, followed by records of 7 big-endian floats.
+    """
+    rng = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        num_rings = rng.randint(3, 12)
+        data.extend(struct.pack(">I", num_rings))
+        center_x = rng.uniform(-2000.0, 2000.0)
+        center_z = rng.uniform(-2000.0, 2000.0)
+        for _ in range(num_rings):
+            scale = rng.choice([1.0, 1.0, 1.5, 2.0])
+            data.extend(struct.pack(">fffffff",
+                center_x + rng.uniform(-300.0, 300.0),
+                rng.uniform(0.0, 200.0),
+                center_z + rng.uniform(-300.0, 300.0),
+                rng.choice([0.0, 0.0, rng.uniform(-3.14, 3.14)]),
+                rng.uniform(-3.14, 3.14),
+                scale,
+                scale))
+
+    return bytearray(data[:size])
+
+
+def make_padded_data(size, seed=0):
+    """
+    Generates data with large zero-padded regions between chunks of code
+    and float tables, like sections aligned in an overlay or .dol file.
+    """
+    rng = random.Random(seed)
+    data = bytearray()
+    while len(data) < size:
+        if rng.random() < 0.5:
+            data.extend(make_code_data(rng.randint(0x100, 0x1000), rng.getrandbits(32)))
+        else:
+            data.extend(make_float_table_data(rng.randint(0x80, 0x800), rng.getrandbits(32)))
+        # Pad up to a 32-byte boundary, and then some.
+        data.extend(bytes(-len(data) % 0x20 + rng.choice([0, 0x20, 0x100, 0x1000])))
+
+    return bytearray(data[:size])
+
+
+# The synthetic corpora used by the benchmark suite.
+CORPORA = {
+    "overlay": make_overlay_data,
+    "code": make_code_data,
+    "float_tables": make_float_table_data,
+    "padded": make_padded_data,
+}
+
+
+def legacy_compress_commands(data, window_size=64):
+    """
+    Performs the original greedy parse with the brute-force prefix search,
+    so the hash-chain match finder can be compared against it.
+    """
+    num_commands = 0
+    i = 0
+    while i < len(data):
+        _, length = compression.get_longest_prefix(data, i, window_size)
+        i += length if length > compression.LZ_PREFIX_MIN_LENGTH else 1
+        num_commands += 1
+    return num_commands
+
+
+def time_call(func, *args, repeat=1, min_seconds=0, **kwargs):
+    """
+    Runs the given function and returns its result along with the
+    elapsed time in seconds. If repeat is more than 1, the function is run
+    that many times, and the fastest time is returned. It's also run until
+    it's taken min_seconds in total.
+    """
+    best = None
+    total = 0
+    runs = 0
+    while runs < repeat or total < min_seconds:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+        total += seconds
+        runs += 1
+    return result, best
+
+
+def time_call_relative(reference_data, func, *args, repeat=1, min_seconds=0, **kwargs):
+    """
+    Like time_call(), but also runs the reference workload on the given data
+    before each run of the function. Returns the function's result, its
+    fastest time, and the median of its time divided by the reference
+    workload's time, across each pair of runs. Both runs of a pair are timed
+    under the same conditions, so the ratio stays steady even when the
+    machine's speed changes while the suite runs.
+    """
+    best = None
+    ratios = []
+    total = 0
+    while len(ratios) < repeat or total < min_seconds:
+        _, reference_seconds = time_call(run_reference_workload, reference_data)
+        result, seconds = time_call(func, *args, **kwargs)
+        if best is None or seconds < best:
+            best = seconds
+        ratios.append(seconds / max(reference_seconds, 1e-9))
+        total += seconds
+    return result, best, statistics.median(ratios)
+
+
+def measure_peak_memory(func, *args, **kwargs):
+    """
+    Runs the given function and returns the peak amount of memory, in bytes,
+    that was allocated while it ran. This slows the function down a lot, so
+    it's measured separately from the timings.
+    """
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_reference_workload(data):
+    """
+    Runs a fixed pure-Python workload over the given data, doing the same
+    kinds of work as the LZ codec: reading bytes, hashing short runs and
+    looking them up in a dict. Suite throughputs are measured relative to
+    its throughput, which cancels out most of the difference between
+    machines and Python versions. Don't change it, or older baselines can
+    no longer be compared against.
+    """
+    table = {}
+    num_matches = 0
+    for i in range(len(data) - 3):
+        key = (data[i] << 16) | (data[i + 1] << 8) | data[i + 2]
+        previous = table.get(key)
+        if previous is not None and data[previous + 3] == data[i + 3]:
+            num_matches += 1
+        table[key] = i
+    return num_matches
+
+
+def get_mb_per_second(num_bytes, seconds):
+    """
+    Gets the throughput for processing the given number of bytes.
+    """
+    return num_bytes / (1024 * 1024) / max(seconds, 1e-9)
+
+
+def get_relative_speed(num_bytes, reference_bytes, time_ratio):
+    """
+    Gets the throughput for processing the given number of bytes, as a
+    multiple of the reference workload's throughput, from the ratio of
+    their times.
+    """
+    return num_bytes / reference_bytes / max(time_ratio, 1e-9)
+
+
+def run_benchmark(data, window_size, level, workers, legacy, memory, backend=compression.LZ_BACKEND_AUTO, compare_backends=False):
+    """
+    Times compression and decompression of the given data, and checks
+    that the data survives the round trip.
+    """
+    backend = compression.get_backend(backend, level)
+    print_info("match finder backend: %s" % backend)
+    compressed, seconds = time_call(compression.compress, data, window_size=window_size, level=level, workers=workers, backend=backend)
+    print_info("compress:   %.2f s (%.2f MB/s), %d -> %d bytes (%.1f%%)" % (
+        seconds, get_mb_per_second(len(data), seconds), len(data), len(compressed), 100.0 * len(compressed) / len(data)))
+
+    if memory:
+        peak = measure_peak_memory(compression.compress, data, window_size=window_size, level=level, backend=backend)
+        print_info("compress peak memory: %.2f MB" % (peak / (1024 * 1024)))
+
+    decompressed, seconds = time_call(compression.decompress, compressed)
+    print_info("decompress: %.2f s (%.2f MB/s)" % (seconds, get_mb_per_second(len(data), seconds)))
+    if decompressed != data:
+        fatal_error("Round trip failed: decompressed data doesn't match the input.")
+
+    if legacy:
+        _, seconds = time_call(legacy_compress_commands, data)
+        print_info("legacy brute-force search (window 64): %.2f s (%.2f MB/s)" % (seconds, get_mb_per_second(len(data), seconds)))
+
+    if compare_backends:
+        if not compression_numpy.is_available():
+            fatal_error("Comparing match finder backends requires NumPy to be installed.")
+        python_compressed, python_seconds = time_call(compression.compress, data, window_size=window_size, level=level,
+                                                      backend=compression.LZ_BACKEND_PYTHON)
+        numpy_compressed, numpy_seconds = time_call(compression.compress, data, window_size=window_size, level=level,
+                                                    backend=compression.LZ_BACKEND_NUMPY)
+        if python_compressed != numpy_compressed:
+            fatal_error("The python and numpy match finder backends gave different output.")
+        print_info("python backend: %.2f s (%.2f MB/s)" % (python_seconds, get_mb_per_second(len(data), python_seconds)))
+        print_info("numpy backend:  %.2f s (%.2f MB/s), %.2fx faster, identical output" % (
+            numpy_seconds, get_mb_per_second(len(data), numpy_seconds), python_seconds / numpy_seconds))
+
+
+def run_suite_result(corpus_name, data, level, window_size, backend, reference_data, repeat):
+    """
+    Benchmarks one corpus with the given compression settings. Returns the
+    result in a JSON-friendly dict.
+    """
+    compressed, compress_seconds, compress_time_ratio = time_call_relative(
+        reference_data, compression.compress, data, window_size=window_size, level=level, backend=backend,
+        repeat=repeat, min_seconds=SUITE_MIN_SECONDS)
+    decompressed, decompress_seconds, decompress_time_ratio = time_call_relative(
+        reference_data, compression.decompress, compressed, repeat=repeat, min_seconds=SUITE_MIN_SECONDS)
+    if decompressed != data:
+        fatal_error("Round trip failed for corpus '%s' (level %s, window %s)." % (corpus_name, level, window_size))
+
+    result = {
+        "corpus": corpus_name,
+        "level": level,
+        "window_size": window_size,
+        "backend": backend,
+        "input_size": len(data),
+        "compressed_size": len(compressed),
+        "ratio": len(compressed) / len(data),
+        "compress_mb_s": get_mb_per_second(len(data), compress_seconds),
+        "decompress_mb_s": get_mb_per_second(len(data), decompress_seconds),
+        "compress_relative": get_relative_speed(len(data), len(reference_data), compress_time_ratio),
+        "decompress_relative": get_relative_speed(len(data), len(reference_data), decompress_time_ratio),
+    }
+    print_info("%-12s %-8s window %4d: ratio %.4f, compress %.2f MB/s (%.3fx), decompress %.2f MB/s (%.3fx)" % (
+        corpus_name, level, window_size, result["ratio"], result["compress_mb_s"], result["compress_relative"],
+        result["decompress_mb_s"], result["decompress_relative"]))
+    return result
+
+
+def run_suite(size, levels, window_sizes, repeat=DEFAULT_SUITE_REPEAT, backend=compression.LZ_BACKEND_AUTO):
+    """
+    Benchmarks every synthetic corpus with each of the given compression
+    levels and window sizes. Returns the results in a JSON-friendly dict.
+    """
+    reference_data = make_overlay_data(size)
+    results = []
+    memory = []
+    for corpus_name, make_data in CORPORA.items():
+        data = make_data(size)
+        for level in levels:
+            level_backend = compression.get_backend(backend, level)
+            for window_size in window_sizes:
+                results.append(run_suite_result(corpus_name, data, level, window_size, level_backend, reference_data, repeat))
+
+        peak = measure_peak_memory(compression.compress, data, backend=compression.get_backend(backend, compression.COMPRESS_LEVEL_GREEDY))
+        memory.append({"corpus": corpus_name, "compress_peak_bytes": peak})
+        print_info("%-12s compress peak memory: %.2f MB" % (corpus_name, peak / (1024 * 1024)))
+
+    return {
+        "version": SUITE_VERSION,
+        "python": platform.python_version(),
+        "data_size": size,
+        "results": results,
+        "memory": memory,
+    }
+
+
+def recheck_slow_results(suite, baseline, max_slowdown=DEFAULT_MAX_SLOWDOWN, repeat=DEFAULT_SUITE_REPEAT):
+    """
+    Benchmarks the suite results that are slower than the baseline again,
+    up to SUITE_RECHECKS more times, and keeps their fastest throughput.
+    Noise can only make a result look slower, not faster, so this weeds out
+    false regressions without hiding real ones.
+    """
+    base_results = {get_result_key(result): result for result in baseline["results"]}
+    reference_data = make_overlay_data(suite["data_size"])
+    for result in suite["results"]:
+        base = base_results.get(get_result_key(result))
+        if base is None:
+            continue
+
+        data = CORPORA[result["corpus"]](suite["data_size"])
+        for _ in range(SUITE_RECHECKS):
+            if len(get_slow_fields(result, base, max_slowdown)) == 0:
+                break
+            print_info("Checking %s/%s/window %s/%s again." % get_result_key(result))
+            new_result = run_suite_result(result["corpus"], data, result["level"], result["window_size"], result["backend"],
+                                          reference_data, repeat)
+            for field in SUITE_SPEED_FIELDS + ("compress_mb_s", "decompress_mb_s"):
+                result[field] = max(result[field], new_result[field])
+
+
+def check_baseline(suite, baseline):
+    """
+    Checks that a baseline was made by this version of the benchmark suite,
+    with the same amount of data. If it wasn't, then the program is
+    terminated.
+    """
+    if baseline.get("version") != SUITE_VERSION:
+        fatal_error("The baseline was made by a different version of the benchmark suite. Run --suite --json again to make a new one.")
+    if baseline.get("data_size") != suite["data_size"]:
+        fatal_error("The baseline was run with %s bytes of data per corpus, but this run used %s." % (baseline.get("data_size"), suite["data_size"]))
+
+
+def get_result_key(result):
+    """
+    Gets the key that identifies a suite result when comparing runs.
+    """
+    return (result["corpus"], result["level"], result["window_size"], result["backend"])
+
+
+def get_slow_fields(result, base, max_slowdown):
+    """
+    Gets the throughput fields of a suite result that are noticeably slower
+    than the baseline result's.
+    """
+    return [field for field in SUITE_SPEED_FIELDS if result[field] < base[field] * (1.0 - max_slowdown)]
+
+
+def find_regressions(suite, baseline, max_slowdown=DEFAULT_MAX_SLOWDOWN, max_ratio_increase=DEFAULT_MAX_RATIO_INCREASE):
+    """
+    Compares suite results against a baseline run. Returns a list of
+    messages describing each result that got noticeably worse. Throughput
+    is compared relative to the reference workload. Results that aren't in
+    the baseline, such as ones with a different backend, are ignored.
+    """
+    check_baseline(suite, baseline)
+
+    baseline_results = {get_result_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in suite["results"]:
+        base = baseline_results.get(get_result_key(result))
+        if base is None:
+            continue
+
+        name = "%s/%s/window %s/%s" % get_result_key(result)
+        if result["ratio"] > base["ratio"] + max_ratio_increase:
+            regressions.append("%s: ratio %.4f is worse than the baseline's %.4f" % (name, result["ratio"], base["ratio"]))
+        for field in get_slow_fields(result, base, max_slowdown):
+            regressions.append("%s: %s %.4fx the reference workload is slower than the baseline's %.4fx" % (name, field, result[field], base[field]))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser("ToadsTool compression benchmark")
+    argparser.add_argument("-f", "--file", help="Uncompressed file to benchmark, instead of synthetic data")
+    argparser.add_argument("--size", help="Size of the synthetic data, in bytes", type=lambda x: int(x, 0))
+    argparser.add_argument("--window-size", help="LZ window size", type=int, default=compression.LZ_WINDOW_SIZE)
+    argparser.add_argument("--level", help="Compression level", choices=compression.COMPRESS_LEVELS, default=compression.COMPRESS_LEVEL_GREEDY)
+    argparser.add_argument("--workers", help="Number of worker processes for compression", type=int, default=1)
+    argparser.add_argument("--memory", help="Also measure the compressor's peak memory use", action="store_true")
+    argparser.add_argument("--legacy", help="Also time the original brute-force prefix search", action="store_true")
+    argparser.add_argument("--backend", help="Match finder backend. 'auto' uses numpy if it's installed, except for greedy compression, where the python backend is faster", choices=compression.LZ_BACKENDS, default=compression.LZ_BACKEND_AUTO)
+    argparser.add_argument("--compare-backends", help="Also time the python and numpy match finder backends against each other", action="store_true")
+    argparser.add_argument("--suite", help="Run the full benchmark suite over every synthetic corpus", action="store_true")
+    argparser.add_argument("--levels", help="Comma-separated compression levels for --suite. Defaults to all of them", default=",".join(compression.COMPRESS_LEVELS))
+    argparser.add_argument("--repeat", help="Minimum number of times each --suite timing is repeated. Defaults to %s" % DEFAULT_SUITE_REPEAT, type=int, default=DEFAULT_SUITE_REPEAT)
+    argparser.add_argument("--json", help="File to write the --suite results to, as JSON")
+    argparser.add_argument("--baseline", help="JSON results from an earlier --suite run. Fails if this run is noticeably worse")
+    argparser.add_argument("--max-slowdown", help="Allowed throughput drop compared to the baseline, as a fraction. Defaults to %s" % DEFAULT_MAX_SLOWDOWN, type=float, default=DEFAULT_MAX_SLOWDOWN)
+    argparser.add_argument("--max-ratio-increase", help="Allowed compression ratio increase compared to the baseline. Defaults to %s" % DEFAULT_MAX_RATIO_INCREASE, type=float, default=DEFAULT_MAX_RATIO_INCREASE)
+    args = argparser.parse_args()
+
+    if args.suite:
+        levels = args.levels.split(",")
+        for level in levels:
+            if level not in compression.COMPRESS_LEVELS:
+                fatal_error("Invalid compression level '%s'. Valid levels are %s." % (level, ", ".join(compression.COMPRESS_LEVELS)))
+        suite = run_suite(args.size or DEFAULT_SUITE_DATA_SIZE, levels, SUITE_WINDOW_SIZES, args.repeat, args.backend)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(suite, f, indent=2)
+        if args.baseline:
+            assert_file_exists(args.baseline)
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            check_baseline(suite, baseline)
+            recheck_slow_results(suite, baseline, args.max_slowdown, args.repeat)
+            regressions = find_regressions(suite, baseline, args.max_slowdown, args.max_ratio_increase)
+            if len(regressions) > 0:
+                fatal_error("%s benchmark regression(s) compared to '%s':\n%s" % (len(regressions), args.baseline, "\n".join(regressions)))
+            print_info("No regressions compared to '%s'." % args.baseline)
+    else:
+        if args.file:
+            assert_file_exists(args.file)
+            with open(args.file, "rb") as f:
+                data = bytearray(f.read())
+        else:
+            data = make_overlay_data(args.size or DEFAULT_DATA_SIZE)
+
+        run_benchmark(data, args.window_size, args.level, args.workers, args.legacy, args.memory, args.backend, args.compare_backends)
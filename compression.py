@@ -3,88 +3,327 @@
 # compression method where data is either copied directly, or it's copied
 # from a previous position from the decompression buffer.
 #
-# This file's compression and decompression functionality probably needs
-# to be rewritten in C or C++ because the game's files are large enough
-# that Python's slowness is getting in the way.  (One file can take
-# 5-10 seconds to compress, for example.)
+# The game's files are large enough that Python's slowness gets in the
+# way, so the compressor finds matches using hash chains keyed on the
+# 3-byte minimum match, rather than scanning the entire window at every
+# position.
 
+import bisect
+import concurrent.futures
+import hashlib
+import itertools
 import struct
+import time
 
+import compression_numpy
 from util import fatal_error
 
 
-def bits(b):
+def get_decompressed_size(data):
     """
-    Returns a tuple of the individual bits in a byte, in order
-    of most-significant to least-significant.
+    Reads the uncompressed data size from the given compressed data's header.
+    The first header byte is the compression type, and the remaining three
+    bytes are the size.
     """
-    return ((b >> 7) & 1,
-            (b >> 6) & 1,
-            (b >> 5) & 1,
-            (b >> 4) & 1,
-            (b >> 3) & 1,
-            (b >> 2) & 1,
-            (b >> 1) & 1,
-            (b) & 1)
+    if len(data) < 4:
+        fatal_error("Compressed data is too small (%s bytes) to have a header." % len(data))
+    return struct.unpack_from(">I", data, 0)[0] & 0xFFFFFF
+
+
+def get_ctrl_runs(ctrl):
+    """
+    Splits a ctrl byte into runs of immediate bytes. Returns a tuple of the
+    run lengths that come before each copy command, and the length of the
+    run after the last copy command.
+    """
+    runs = []
+    run = 0
+    for bit in range(7, -1, -1):
+        if ctrl & (1 << bit):
+            runs.append(run)
+            run = 0
+        else:
+            run += 1
+    return tuple(runs), run
+
+
+# Precomputed runs for every ctrl byte, so the decompressor can copy
+# immediate bytes as slices instead of checking one bit at a time.
+CTRL_RUNS = [get_ctrl_runs(ctrl) for ctrl in range(0x100)]
+
+
+def decode_group(data, index, output, out, limit):
+    """
+    Decodes the group of commands for the ctrl byte at data[index], writing
+    the decompressed bytes into output starting at output[out]. No bytes are
+    written at or past output[limit]. Returns a tuple of the new index, the
+    new output position, and whether the terminating command was reached.
+    """
+    data_len = len(data)
+    if index >= data_len:
+        fatal_error("Compressed data is truncated at %s bytes." % data_len)
+    command = data[index]
+    index += 1
+
+    # Each bit in the command says whether to copy an immediate byte (0), or
+    # to copy a string of bytes from the previously-decompressed data (1).
+    copy_runs, last_run = CTRL_RUNS[command]
+    for run in copy_runs:
+        if run:
+            # Copy immediate bytes.
+            if index + run > data_len:
+                fatal_error("Compressed data is truncated at %s bytes." % data_len)
+            if out + run > limit:
+                fatal_error("Decompressed data is larger than the size given in the header.")
+            output[out:out + run] = data[index:index + run]
+            index += run
+            out += run
+
+        if index + 2 > data_len:
+            fatal_error("Compressed data is truncated at %s bytes." % data_len)
+        p0 = data[index]
+        p1 = data[index + 1]
+        index += 2
+        if p0 == 0 and p1 == 0:
+            return index, out, True
+
+        # Calculate the offset in the decompression buffer, from which we
+        # will copy data.
+        offset = (p0 & 0xF0) * 0x10 + p1
+        copy_ctrl = p0 & 0xF
+        if copy_ctrl == 0:
+            # Copy at least 17 bytes
+            if index >= data_len:
+                fatal_error("Compressed data is truncated at %s bytes." % data_len)
+            num_bytes = data[index] + 17
+            index += 1
+        else:
+            # Copy somewhere between 1 and 16 bytes.
+            num_bytes = copy_ctrl + 1
+
+        if offset == 0 or offset > out:
+            fatal_error("Invalid copy offset %s at compressed offset %s." % (hex(offset), hex(index)))
+        if out + num_bytes > limit:
+            fatal_error("Decompressed data is larger than the size given in the header.")
+
+        # Perform the copy from the previously-decompressed data. When the
+        # copy overlaps itself, the copied data repeats every `offset` bytes,
+        # so the amount that can be copied in one slice doubles each time.
+        src = out - offset
+        while num_bytes > 0:
+            chunk = min(out - src, num_bytes)
+            output[out:out + chunk] = output[src:src + chunk]
+            out += chunk
+            num_bytes -= chunk
+
+    if last_run:
+        # Copy immediate bytes.
+        if index + last_run > data_len:
+            fatal_error("Compressed data is truncated at %s bytes." % data_len)
+        if out + last_run > limit:
+            fatal_error("Decompressed data is larger than the size given in the header.")
+        output[out:out + last_run] = data[index:index + last_run]
+        index += last_run
+        out += last_run
+
+    return index, out, False
 
 
 def decompress(data):
     """
-    Decompresses the given input bytearray.
-    TODO: Add error handling.
+    Decompresses the given input bytearray. The output buffer is allocated
+    up front using the size in the header, and copies are done with slices
+    wherever possible.
     """
+    size = get_decompressed_size(data)
+    output = bytearray(size)
+    out = 0
     # Skip the first 4 header bytes.
     index = 4
+    done = False
+    while not done:
+        index, out, done = decode_group(data, index, output, out, size)
 
-    def read_byte():
-        nonlocal index
-        b = data[index]
-        index += 1
-        return b
-
-    output = bytearray()
-    while True:
-        command = read_byte()
-        if command == 0:
-            # Copy 8 immediate bytes.
-            for i in range(8):
-                output.append(read_byte())
-        else:
-            # Take different action depending on each bit in the command.
-            for bit in bits(command):
-                if bit == 0:
-                    # Copy an immediate byte
-                    output.append(read_byte())
-                else:
-                    # We will be copying a string of bytes from the previously-decompressed data.
-                    p0 = read_byte()
-                    p1 = read_byte()
-                    if p0 == 0 and p1 == 0:
-                        return output
-
-                    # Calculate the offset in the decompression buffer, from which we
-                    # will copy data.
-                    offset = (p0 & 0xF0) * 0x10 + p1
-                    copy_ctrl = p0 & 0xF
-                    if copy_ctrl == 0:
-                        # Copy at least 17 bytes
-                        num_bytes = read_byte() + 17
-                    else:
-                        # Copy somewhere between 1 and 16 bytes.
-                        num_bytes = copy_ctrl + 1
-
-                    # Perform the copy from the previously-decompressed data.
-                    for i in range(num_bytes):
-                        output.append(output[-offset])
+    if out != size:
+        fatal_error("Decompressed data is %s bytes, but the header says %s bytes." % (out, size))
+    return output
+
+
+# Checkpoints are recorded roughly every CHECKPOINT_INTERVAL bytes of
+# decompressed output. DECOMPRESS_CHUNK_SIZE is how much decompressed
+# output iter_decompress() collects before yielding it.
+CHECKPOINT_INTERVAL = 0x10000
+DECOMPRESS_CHUNK_SIZE = 0x10000
+
+# Largest number of bytes that one ctrl byte's group of commands can output.
+MAX_GROUP_OUTPUT_SIZE = 8 * 272
+
+
+def iter_decompress(data, checkpoint=None, checkpoints=None, checkpoint_interval=CHECKPOINT_INTERVAL):
+    """
+    Decompresses the given compressed data a chunk at a time, yielding each
+    chunk of decompressed bytes. Only the last window of decompressed data is
+    kept around, so memory use doesn't depend on the size of the file.
+    Args:
+        data: the compressed data. This can be an mmap, so the compressed file doesn't need to be read into memory.
+        checkpoint: optional checkpoint to start decompressing from, instead of the start of the data
+        checkpoints: optional list that new checkpoints are appended to while decompressing
+        checkpoint_interval: how many bytes of output there are between new checkpoints
+    Checkpoints are dicts of shape:
+        {
+            "input_offset": int,
+            "output_offset": int,
+            "window": bytes,
+        }
+    """
+    size = get_decompressed_size(data)
+    if checkpoint is None:
+        index = 4
+        base = 0
+        buff = bytearray()
+    else:
+        index = checkpoint["input_offset"]
+        base = checkpoint["output_offset"] - len(checkpoint["window"])
+        buff = bytearray(checkpoint["window"])
+
+    # buff holds the decompressed bytes from output offset `base` onwards.
+    # Everything from `emitted` onwards hasn't been yielded yet.
+    emitted = base + len(buff)
+    last_checkpoint = emitted
+    buff.extend(bytes(DECOMPRESS_CHUNK_SIZE + MAX_GROUP_OUTPUT_SIZE))
+    out = emitted - base
+    done = False
+    while not done:
+        if checkpoints is not None and base + out - last_checkpoint >= checkpoint_interval:
+            last_checkpoint = base + out
+            checkpoints.append({
+                "input_offset": index,
+                "output_offset": last_checkpoint,
+                "window": bytes(buff[max(0, out - LZ_MAX_WINDOW_SIZE):out]),
+            })
+
+        index, out, done = decode_group(data, index, buff, out, size - base)
+        if base + out - emitted >= DECOMPRESS_CHUNK_SIZE or done:
+            if base + out > emitted:
+                yield bytes(buff[emitted - base:out])
+            emitted = base + out
+            # Only keep the last window of decompressed data.
+            keep_start = max(0, out - LZ_MAX_WINDOW_SIZE)
+            del buff[:keep_start]
+            buff.extend(bytes(keep_start))
+            base += keep_start
+            out -= keep_start
+
+    if base + out != size:
+        fatal_error("Decompressed data is %s bytes, but the header says %s bytes." % (base + out, size))
+
+
+def build_checkpoint_index(data, checkpoint_interval=CHECKPOINT_INTERVAL):
+    """
+    Decompresses the given compressed data, and gets the list of checkpoints
+    that read_at() can start decompressing from.
+    """
+    checkpoints = []
+    for _ in iter_decompress(data, checkpoints=checkpoints, checkpoint_interval=checkpoint_interval):
+        pass
+    return checkpoints
+
+
+def read_at(data, offset, size, checkpoints=None):
+    """
+    Reads `size` decompressed bytes, starting at the given offset in the
+    decompressed data. If checkpoints are given, decompression starts at the
+    nearest checkpoint before the offset, rather than the start of the data.
+    """
+    if offset + size > get_decompressed_size(data):
+        fatal_error("Can't read %s bytes at offset %s past the end of the decompressed data." % (hex(size), hex(offset)))
+
+    checkpoint = None
+    if checkpoints:
+        i = bisect.bisect_right([c["output_offset"] for c in checkpoints], offset) - 1
+        if i >= 0:
+            checkpoint = checkpoints[i]
+
+    position = 0 if checkpoint is None else checkpoint["output_offset"]
+    result = bytearray()
+    for chunk in iter_decompress(data, checkpoint):
+        chunk_start = max(0, offset - position)
+        chunk_end = min(len(chunk), offset + size - position)
+        if chunk_start < chunk_end:
+            result.extend(chunk[chunk_start:chunk_end])
+        position += len(chunk)
+        if position >= offset + size:
+            break
+    return result
+
+
+# The checkpoint index file starts with CHECKPOINT_INDEX_MAGIC, the SHA-1 of
+# the compressed data it was built from, and the number of checkpoints.
+# Each checkpoint is stored as its input offset, output offset, window size,
+# and the window's bytes.
+CHECKPOINT_INDEX_MAGIC = b"TTCI"
+
+
+def save_checkpoint_index(filepath, data, checkpoints):
+    """
+    Writes the checkpoints for the given compressed data to a file.
+    """
+    index_data = bytearray(CHECKPOINT_INDEX_MAGIC)
+    index_data.extend(hashlib.sha1(data).digest())
+    index_data.extend(struct.pack(">I", len(checkpoints)))
+    for checkpoint in checkpoints:
+        index_data.extend(struct.pack(">III", checkpoint["input_offset"], checkpoint["output_offset"], len(checkpoint["window"])))
+        index_data.extend(checkpoint["window"])
+    with open(filepath, "wb") as f:
+        f.write(index_data)
+
+
+def load_checkpoint_index(filepath, data):
+    """
+    Reads the checkpoints for the given compressed data from a file. Returns
+    None if the file doesn't exist, or if it was built from different data.
+    """
+    try:
+        with open(filepath, "rb") as f:
+            index_data = f.read()
+    except OSError:
+        return None
+
+    header_size = len(CHECKPOINT_INDEX_MAGIC) + 20 + 4
+    if len(index_data) < header_size or not index_data.startswith(CHECKPOINT_INDEX_MAGIC):
+        return None
+    if index_data[len(CHECKPOINT_INDEX_MAGIC):len(CHECKPOINT_INDEX_MAGIC) + 20] != hashlib.sha1(data).digest():
+        return None
+
+    num_checkpoints = struct.unpack_from(">I", index_data, header_size - 4)[0]
+    checkpoints = []
+    offset = header_size
+    for _ in range(num_checkpoints):
+        input_offset, output_offset, window_size = struct.unpack_from(">III", index_data, offset)
+        offset += 12
+        checkpoints.append({
+            "input_offset": input_offset,
+            "output_offset": output_offset,
+            "window": bytes(index_data[offset:offset + window_size]),
+        })
+        offset += window_size
+    return checkpoints
 
 
 # LZ_WINDOW_SIZE can be freely tweaked to control
 # the processing speed, with a compression quality tradeoff.
 # A larger LZ_WINDOW_SIZE will result in better compression, but
-# it will take longer to run.  LZ_WINDOW_SIZE has a maximum of 4096.
-# I've found that LZ_WINDOW_SIZE=512 will result in slightly smaller
-# file sizes than the original game's files.
-LZ_WINDOW_SIZE = 64
+# it will take longer to run.  The copy offset is stored in 12 bits,
+# so LZ_WINDOW_SIZE has a maximum of LZ_MAX_WINDOW_SIZE (4095).
+# Now that matches are found with hash chains, the full window is cheap
+# enough to use by default.
+LZ_MAX_WINDOW_SIZE = 0xFFF
+LZ_WINDOW_SIZE = LZ_MAX_WINDOW_SIZE
+
+# LZ_MAX_CHAIN limits how many previous occurrences of a 3-byte sequence
+# are checked when looking for a match. Raising it gives slightly better
+# compression on repetitive data, at the cost of speed.
+LZ_MAX_CHAIN = 128
 
 # Don't tweak these values--they are constants baked into the
 # game's decompression code.
@@ -93,7 +332,9 @@ LZ_PREFIX_MAX_LENGTH = 272
 
 def get_longest_prefix(data, cur_index, window_size):
     """
-    Performs an LZ prefix search in a sliding window of the input data.
+    Performs a brute-force LZ prefix search in a sliding window of the
+    input data. This is very slow, and it's only kept around as a reference
+    for checking the hash-chain match finder.
     """
     data_len = len(data)
     longest_prefix_index = cur_index
@@ -116,77 +357,838 @@ def get_longest_prefix(data, cur_index, window_size):
     return longest_prefix_index, longest_prefix_length
 
 
-def compress(data, compress_type=0x1, window_size=LZ_WINDOW_SIZE):
+def get_match_length(data, index_a, index_b, max_length, length=0):
     """
-    Compresses the given input bytearray.
-    Args:
-        data: the raw data bytearray to be compressed
-        compress_type: there are two types of compressed files; 0x1 and 0x2
-                       Type 0x1 is a plain compressed file.
-                       Type 0x2 is just like type 0x1, but there is a data table appended to the file.
-                           ToadsTool doesn't support type 0x2 right now, because the data table isn't fully
-                           understood. If you need to modify a type-2 compressed file, simply append the
-                           original datatable to the end of the resulting compressed file.
+    Counts how many bytes match between the two given positions in the data,
+    up to max_length. The first `length` bytes are assumed to already match.
+    Slices are compared in growing chunks, so long matches don't have to be
+    walked one byte at a time in Python.
     """
-    data_len = len(data)
-    if data_len > 0xFFFFFF:
-        fatal_error("Data is too large (%s bytes) to compress! Must be <= 0xFFFFFF bytes" % hex(data_len))
+    chunk_size = 8
+    while length < max_length:
+        size = max_length - length
+        if size > chunk_size:
+            size = chunk_size
+        if data[index_a + length:index_a + length + size] == data[index_b + length:index_b + length + size]:
+            length += size
+            chunk_size <<= 1
+        elif size == 1:
+            break
+        else:
+            chunk_size = size >> 1
 
-    output = bytearray(4)
-    struct.pack_into(">I", output, 0, data_len)
-    # The uncompressed data length is only three bytes large, and we
-    # overwrite the first byte in the header with the compression type
-    output[0] = compress_type
+    return length
+
+
+# Number of buckets in the match finder's hash table. Each bucket holds the
+# most recent position whose first 3 bytes hash to it. A fixed-size table
+# keeps memory use the same no matter how big the input is.
+LZ_HASH_SIZE = 0x10000
+
+
+def get_match_hash(data, index):
+    """
+    Gets the hash table bucket for the 3 bytes at the given position.
+    """
+    key = (data[index] << 16) | (data[index + 1] << 8) | data[index + 2]
+    return ((key * 2654435761) >> 16) & (LZ_HASH_SIZE - 1)
+
+
+def init_match_finder(data, window_size=LZ_WINDOW_SIZE, max_chain=LZ_MAX_CHAIN):
+    """
+    Gets an initial hash-chain match finder object for the given data.
+    """
+    if window_size > LZ_MAX_WINDOW_SIZE:
+        fatal_error("LZ window size %s is too large. Must be <= %s" % (window_size, LZ_MAX_WINDOW_SIZE))
+
+    # head maps the hash of a 3-byte sequence to the most recent position it
+    # was seen at. prev links each position to the previous position with the
+    # same hash. Positions older than the window are never followed, so prev
+    # only needs to hold one window's worth of links.
+    return {
+        "data": data,
+        "window_size": window_size,
+        "max_chain": max_chain,
+        "head": [-1] * LZ_HASH_SIZE,
+        "prev": [-1] * (LZ_MAX_WINDOW_SIZE + 1),
+        "next_index": 0,
+        "match_start": 0,
+        "match_indexes": None,
+        "match_lengths": None,
+    }
+
+
+def insert_match_positions(finder, end_index):
+    """
+    Adds all positions up to (but not including) end_index to the
+    match finder's hash chains.
+    """
+    index = finder["next_index"]
+    data = finder["data"]
+    end_index = min(end_index, len(data) - LZ_PREFIX_MIN_LENGTH + 1)
+    if index >= end_index:
+        return
+
+    head = finder["head"]
+    prev = finder["prev"]
+    while index < end_index:
+        key = (data[index] << 16) | (data[index + 1] << 8) | data[index + 2]
+        h = ((key * 2654435761) >> 16) & (LZ_HASH_SIZE - 1)
+        prev[index & LZ_MAX_WINDOW_SIZE] = head[h]
+        head[h] = index
+        index += 1
+
+    finder["next_index"] = index
+
+
+def find_longest_match(finder, cur_index):
+    """
+    Finds the longest match for the data at cur_index within the
+    match finder's window. Returns a tuple of the match's start index
+    and its length. A length of 0 means no match was found.
+    """
+    # If the matches are being found a block at a time up front, just
+    # look this one up.
+    if finder["match_lengths"] is not None:
+        offset = cur_index - finder["match_start"]
+        if offset < 0 or offset >= len(finder["match_lengths"]):
+            load_match_block(finder, cur_index)
+            offset = 0
+        return finder["match_indexes"][offset], finder["match_lengths"][offset]
+
+    data = finder["data"]
+    max_length = len(data) - cur_index
+    if max_length > LZ_PREFIX_MAX_LENGTH:
+        max_length = LZ_PREFIX_MAX_LENGTH
+    elif max_length < LZ_PREFIX_MIN_LENGTH:
+        return cur_index, 0
 
-    # Build up the list of LZ commands for copying immediate or pre-existing data.
-    commands = []
-    i = 0
+    if finder["next_index"] < cur_index:
+        insert_match_positions(finder, cur_index)
+    candidate = finder["head"][get_match_hash(data, cur_index)]
+    min_index = cur_index - finder["window_size"]
+    prev = finder["prev"]
+    chain = finder["max_chain"]
+
+    # Different 3-byte sequences can share a hash, so candidates must be
+    # at least the minimum length to count as a match.
+    best_index = cur_index
+    best_length = LZ_PREFIX_MIN_LENGTH - 1
+    while candidate >= min_index and candidate >= 0 and chain > 0:
+        # Only do the full comparison if this candidate could beat the
+        # current best match.
+        if data[candidate + best_length] == data[cur_index + best_length]:
+            length = get_match_length(data, candidate, cur_index, max_length)
+            if length > best_length:
+                best_index = candidate
+                best_length = length
+                if length == max_length:
+                    break
+        candidate = prev[candidate & LZ_MAX_WINDOW_SIZE]
+        chain -= 1
+
+    if best_length < LZ_PREFIX_MIN_LENGTH:
+        return cur_index, 0
+    return best_index, best_length
+
+
+# With the numpy backend, matches are found for this many positions at a
+# time. Bigger blocks have less overhead, but use more memory.
+LZ_MATCH_BLOCK_SIZE = 0x10000
+
+
+def load_match_block(finder, start_index):
+    """
+    Finds the matches for the block of positions starting at start_index,
+    using the numpy backend.
+    """
+    end_index = min(start_index + LZ_MATCH_BLOCK_SIZE, len(finder["data"]) + 1)
+    finder["match_indexes"], finder["match_lengths"] = compression_numpy.find_matches(
+        finder["data"], start_index, end_index, finder["window_size"], finder["max_chain"])
+    finder["match_start"] = start_index
+
+
+# Compression levels control how the input is parsed into LZ commands.
+#   greedy:  always takes the longest match at the current position. Fastest.
+#   lazy:    before taking a match, checks whether the next position has a
+#            longer one, and emits a literal first if so.
+#   optimal: finds the cheapest possible sequence of commands for the matches
+#            available at every position. Slowest, but gives the smallest files.
+COMPRESS_LEVEL_GREEDY = "greedy"
+COMPRESS_LEVEL_LAZY = "lazy"
+COMPRESS_LEVEL_OPTIMAL = "optimal"
+COMPRESS_LEVELS = [
+    COMPRESS_LEVEL_GREEDY,
+    COMPRESS_LEVEL_LAZY,
+    COMPRESS_LEVEL_OPTIMAL,
+]
+
+# Encoded size, in bits, of each kind of LZ command. Every command takes
+# one bit in its group's ctrl byte, plus the bytes it writes to the stream.
+LZ_LITERAL_COST = 1 + 8
+LZ_SHORT_PREFIX_COST = 1 + 16
+LZ_LONG_PREFIX_COST = 1 + 24
+# Longest prefix that can be encoded in the short (2-byte) form.
+LZ_SHORT_PREFIX_MAX_LENGTH = 16
+
+
+# LZ commands are stored as plain ints, rather than objects, so millions of
+# them can be produced without much overhead. An int less than 0x100 is an
+# immediate byte. Anything else is a prefix copy, with the copy length
+# in the upper bits and the offset in the lower LZ_OFFSET_BITS bits.
+LZ_OFFSET_BITS = 12
+LZ_OFFSET_MASK = (1 << LZ_OFFSET_BITS) - 1
+LZ_TERMINATOR = 1 << LZ_OFFSET_BITS
+
+
+def parse_greedy(data, finder, start_index=0):
+    """
+    Generates the LZ commands by always taking the longest match.
+    Parsing begins at start_index, but matches can refer to earlier data.
+    """
+    data_len = len(data)
+    i = start_index
     while i < data_len:
-        longest_prefix_index, longest_prefix_length = get_longest_prefix(data, i, window_size)
-        if longest_prefix_length > LZ_PREFIX_MIN_LENGTH:
+        longest_prefix_index, longest_prefix_length = find_longest_match(finder, i)
+        if longest_prefix_length >= LZ_PREFIX_MIN_LENGTH:
             # Emit command for copying previous data.
-            offset = i - longest_prefix_index
-            commands.append({'type': 'prefix', 'offset': offset, 'length': longest_prefix_length})
+            yield ((longest_prefix_length << LZ_OFFSET_BITS) | (i - longest_prefix_index))
             i += longest_prefix_length
         else:
             # Emit command for copying immediate data.
-            commands.append({'type': 'copy', 'value': data[i]})
+            yield data[i]
+            i += 1
+
+
+def parse_lazy(data, finder, start_index=0):
+    """
+    Generates the LZ commands with lazy matching. A match is deferred
+    by one literal if the next position has a longer match.
+    Parsing begins at start_index, but matches can refer to earlier data.
+    """
+    data_len = len(data)
+    i = start_index
+    match_index, match_length = find_longest_match(finder, i)
+    while i < data_len:
+        if match_length >= LZ_PREFIX_MIN_LENGTH:
+            next_index, next_length = find_longest_match(finder, i + 1)
+            if next_length > match_length:
+                # The next position has a better match, so copy this
+                # byte immediately and consider the next match instead.
+                yield data[i]
+                i += 1
+                match_index, match_length = next_index, next_length
+                continue
+
+            yield ((match_length << LZ_OFFSET_BITS) | (i - match_index))
+            i += match_length
+        else:
+            yield data[i]
             i += 1
 
-    # Add the terminating command.
-    commands.append({'type': 'prefix', 'offset': 0, 'length': 1})
+        match_index, match_length = find_longest_match(finder, i)
+
+
+def parse_optimal(data, finder, start_index=0):
+    """
+    Generates the LZ commands with the smallest encoded size, given the
+    longest match at every position. The cost of a prefix only depends on
+    its length, and any shorter prefix of a match is also a match, so the
+    longest match at each position is enough to find the optimal parse.
+    Parsing begins at start_index, but matches can refer to earlier data.
+    """
+    data_len = len(data)
+    match_indexes = [0] * data_len
+    match_lengths = [0] * data_len
+    for i in range(start_index, data_len):
+        match_indexes[i], match_lengths[i] = find_longest_match(finder, i)
+
+    # Work backwards, finding the cheapest cost to encode the data from
+    # each position to the end.
+    costs = [0] * (data_len + 1)
+    lengths = [1] * data_len
+    for i in range(data_len - 1, start_index - 1, -1):
+        best_cost = costs[i + 1] + LZ_LITERAL_COST
+        best_length = 1
+        match_length = match_lengths[i]
+        if match_length >= LZ_PREFIX_MIN_LENGTH:
+            # Any length in the short range costs the same, so pick the
+            # one that leaves the cheapest remainder. Same for the long range.
+            short_max = min(match_length, LZ_SHORT_PREFIX_MAX_LENGTH)
+            short_costs = costs[i + LZ_PREFIX_MIN_LENGTH:i + short_max + 1]
+            cost = min(short_costs)
+            if cost + LZ_SHORT_PREFIX_COST < best_cost:
+                best_cost = cost + LZ_SHORT_PREFIX_COST
+                best_length = LZ_PREFIX_MIN_LENGTH + short_costs.index(cost)
+            if match_length > LZ_SHORT_PREFIX_MAX_LENGTH:
+                long_costs = costs[i + LZ_SHORT_PREFIX_MAX_LENGTH + 1:i + match_length + 1]
+                cost = min(long_costs)
+                if cost + LZ_LONG_PREFIX_COST < best_cost:
+                    best_cost = cost + LZ_LONG_PREFIX_COST
+                    best_length = LZ_SHORT_PREFIX_MAX_LENGTH + 1 + long_costs.index(cost)
+        costs[i] = best_cost
+        lengths[i] = best_length
+
+    # Walk forwards along the cheapest path to generate the commands.
+    i = start_index
+    while i < data_len:
+        length = lengths[i]
+        if length == 1:
+            yield data[i]
+        else:
+            yield ((length << LZ_OFFSET_BITS) | (i - match_indexes[i]))
+        i += length
+
+
+# Match finder backends. The numpy backend finds the matches for every
+# position at once with vectorized operations, instead of walking the hash
+# chains one position at a time. Both backends find exactly the same matches,
+# so the compressed output doesn't depend on which one is used. "auto" uses
+# the numpy backend if NumPy is installed, except for greedy parsing: it
+# skips over most positions, so finding the matches for every position
+# makes it slower, especially on long zero-padded runs.
+LZ_BACKEND_AUTO = "auto"
+LZ_BACKEND_PYTHON = "python"
+LZ_BACKEND_NUMPY = "numpy"
+LZ_BACKENDS = [
+    LZ_BACKEND_AUTO,
+    LZ_BACKEND_PYTHON,
+    LZ_BACKEND_NUMPY,
+]
+
+
+def get_backend(backend, level=None):
+    """
+    Gets the match finder backend to actually use for the given backend
+    setting and compression level. If it can't be used, then the program is
+    terminated.
+    """
+    if backend not in LZ_BACKENDS:
+        fatal_error("Invalid match finder backend '%s'. Valid backends are %s." % (backend, ", ".join(LZ_BACKENDS)))
+    if backend == LZ_BACKEND_AUTO:
+        if level == COMPRESS_LEVEL_GREEDY or not compression_numpy.is_available():
+            return LZ_BACKEND_PYTHON
+        return LZ_BACKEND_NUMPY
+    if backend == LZ_BACKEND_NUMPY and not compression_numpy.is_available():
+        fatal_error("The numpy match finder backend requires NumPy to be installed.")
+    return backend
+
+
+def get_commands(data, level=COMPRESS_LEVEL_GREEDY, window_size=LZ_WINDOW_SIZE, max_chain=LZ_MAX_CHAIN, start_index=0,
+                 backend=LZ_BACKEND_PYTHON):
+    """
+    Generates the LZ commands for the given data, using the given
+    compression level. Only the data from start_index onwards is parsed.
+    The commands are generated one at a time, so they don't all need to
+    be held in memory.
+    """
+    finder = init_match_finder(data, window_size, max_chain)
+    # Data before the window can never be copied from, so there's no
+    # need to add it to the hash chains.
+    finder["next_index"] = max(0, start_index - window_size)
+    if get_backend(backend, level) == LZ_BACKEND_NUMPY:
+        finder["match_indexes"] = []
+        finder["match_lengths"] = []
+    if level == COMPRESS_LEVEL_GREEDY:
+        return parse_greedy(data, finder, start_index)
+    elif level == COMPRESS_LEVEL_LAZY:
+        return parse_lazy(data, finder, start_index)
+    elif level == COMPRESS_LEVEL_OPTIMAL:
+        return parse_optimal(data, finder, start_index)
+    else:
+        fatal_error("Invalid compression level '%s'. Valid levels are %s." % (level, ", ".join(COMPRESS_LEVELS)))
+
+
+# Inputs are only split across worker processes in segments at least this
+# large. Smaller segments aren't worth the cost of starting a process and
+# sending the data back and forth.
+LZ_MIN_SEGMENT_SIZE = 0x10000
+
+
+def get_segment_commands(segment):
+    """
+    Parses one segment of the input in a worker process. The segment is a
+    tuple of (data, start_index, level, window_size, max_chain, backend),
+    where data begins with the window that precedes the segment.
+    """
+    data, start_index, level, window_size, max_chain, backend = segment
+    return list(get_commands(data, level, window_size, max_chain, start_index, backend))
+
+
+def get_commands_parallel(data, level, window_size, max_chain, workers, backend=LZ_BACKEND_PYTHON):
+    """
+    Generates the LZ commands for the given data, splitting the work
+    across a pool of worker processes. Copies can only reach window_size bytes
+    back, so each segment is parsed independently after being primed with the
+    window that precedes it. Matches never cross the end of a segment, so the
+    segments' commands can simply be joined together.
+    """
+    data_len = len(data)
+    segment_size = max(LZ_MIN_SEGMENT_SIZE, -(-data_len // workers))
+    segments = []
+    for start in range(0, data_len, segment_size):
+        end = min(start + segment_size, data_len)
+        window_start = max(0, start - window_size)
+        segments.append((bytes(data[window_start:end]), start - window_start, level, window_size, max_chain, backend))
+
+    if len(segments) <= 1:
+        yield from get_commands(data, level, window_size, max_chain, backend=backend)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(min(workers, len(segments))) as executor:
+        for segment_commands in executor.map(get_segment_commands, segments):
+            yield from segment_commands
+
+
+# Effort settings for time-budgeted compression, from most to least effort,
+# as tuples of (level, window_size, max_chain). Compression starts at the least
+# effort, then moves along the list whenever it falls behind or gets ahead of
+# its budget, up to the most effort the requested settings allow. Past the end
+# of the list, segments are just copied as immediate bytes, which is by far the
+# fastest option.
+BUDGET_EFFORTS = [
+    (COMPRESS_LEVEL_OPTIMAL, LZ_WINDOW_SIZE, LZ_MAX_CHAIN),
+    (COMPRESS_LEVEL_LAZY, LZ_WINDOW_SIZE, LZ_MAX_CHAIN),
+    (COMPRESS_LEVEL_GREEDY, LZ_WINDOW_SIZE, LZ_MAX_CHAIN),
+    (COMPRESS_LEVEL_GREEDY, LZ_WINDOW_SIZE, 16),
+    (COMPRESS_LEVEL_GREEDY, 0x400, 4),
+    (COMPRESS_LEVEL_GREEDY, 0x100, 1),
+]
+
+# Name used in the stats for data copied as immediate bytes.
+BUDGET_EFFORT_LITERAL = "literal"
+
+# Time-budgeted compression checks its progress, and adjusts its effort,
+# after every segment of this many bytes. Each segment has some fixed setup
+# cost, especially with the numpy backend, so they can't be too small.
+BUDGET_SEGMENT_SIZE = 0x10000
+
+# An effort setting whose time per byte hasn't been measured yet is first
+# used on a segment of only this many bytes, so a setting that's much slower
+# than estimated can't use up the budget before it's measured.
+BUDGET_PROBE_SIZE = 0x1000
+
+# Within a segment, the time is checked after every this many commands.
+BUDGET_CHECK_INTERVAL = 0x100
+
+# Until it's been measured, the time per byte of an effort setting is
+# estimated as this many times the time per byte of the setting below it.
+BUDGET_EFFORT_COST_FACTOR = 2.0
+
+# More effort barely helps on data that doesn't compress well, so the effort
+# is only raised after segments that compressed to at most this fraction
+# of their size. The time saved is spent on more compressible data instead.
+BUDGET_COMPRESSIBLE_RATIO = 0.9
+
+# Rough time it takes to encode one immediate byte. Time for this is set
+# aside for the rest of the data, so there's always time to finish it off
+# with immediate bytes.
+BUDGET_LITERAL_SECONDS_PER_BYTE = 0.25e-6
+
+
+def get_budget_efforts(level, window_size, max_chain):
+    """
+    Gets the effort settings that time-budgeted compression can use, without
+    ever putting in more effort than the given settings.
+    """
+    start = [effort_level for effort_level, _, _ in BUDGET_EFFORTS].index(level)
+    return [(effort_level, min(effort_window_size, window_size), min(effort_max_chain, max_chain))
+            for effort_level, effort_window_size, effort_max_chain in BUDGET_EFFORTS[start:]]
+
+
+def get_command_cost(command):
+    """
+    Gets the encoded size, in bits, of an LZ command.
+    """
+    if command < 0x100:
+        return LZ_LITERAL_COST
+    if command >> LZ_OFFSET_BITS <= LZ_SHORT_PREFIX_MAX_LENGTH:
+        return LZ_SHORT_PREFIX_COST
+    return LZ_LONG_PREFIX_COST
+
+
+def get_budget_effort_estimate(rates, effort):
+    """
+    Gets the estimated time per byte for the given effort setting, based on
+    the measured time per byte of the nearest measured setting.
+    """
+    for distance in range(len(rates)):
+        for other in (effort + distance, effort - distance):
+            if 0 <= other < len(rates) and rates[other] is not None:
+                return rates[other] * BUDGET_EFFORT_COST_FACTOR ** (other - effort)
+    return None
+
+
+def get_commands_budgeted(data, level, window_size, max_chain, time_budget, backend=LZ_BACKEND_PYTHON, stats=None):
+    """
+    Generates the LZ commands for the given data, aiming to finish within
+    time_budget seconds. The data is parsed in segments, like
+    get_commands_parallel(), timing each one. Parsing starts with the least
+    effort, on a small probe segment. After each segment, the next one uses
+    the most effort whose time per byte fits in the time left for the rest of
+    the data, and effort settings that haven't been timed yet are tried on a
+    probe segment first. Once the budget runs out, even in the middle of a
+    segment, the rest of the data is copied as immediate bytes. If stats is
+    given, the number of bytes parsed with each effort setting is added to
+    stats["effort_bytes"].
+    """
+    efforts = get_budget_efforts(level, window_size, max_chain)
+    # Measured time per byte for each effort setting, with copying immediate
+    # bytes as the last one.
+    rates = [None] * len(efforts) + [BUDGET_LITERAL_SECONDS_PER_BYTE]
+    effort = len(efforts) - 1
+    effort_bytes = {}
+    if stats is not None:
+        stats["effort_bytes"] = effort_bytes
+    data_len = len(data)
+    deadline = time.perf_counter() + time_budget
+    start = 0
+    while start < data_len:
+        segment_size = BUDGET_PROBE_SIZE if rates[effort] is None else BUDGET_SEGMENT_SIZE
+        end = min(start + segment_size, data_len)
+        segment_start_time = time.perf_counter()
+        if segment_start_time >= deadline - (data_len - start) * BUDGET_LITERAL_SECONDS_PER_BYTE:
+            effort_bytes[BUDGET_EFFORT_LITERAL] = effort_bytes.get(BUDGET_EFFORT_LITERAL, 0) + data_len - start
+            yield from data[start:]
+            return
+
+        cost = 0
+        if effort == len(efforts):
+            name = BUDGET_EFFORT_LITERAL
+            cost = (end - start) * LZ_LITERAL_COST
+            yield from data[start:end]
+        else:
+            # Parse the segment, primed with the window that precedes it.
+            name = "%s/%s/%s" % efforts[effort]
+            segment_level, segment_window_size, segment_max_chain = efforts[effort]
+            window_start = max(0, start - segment_window_size)
+            commands = get_commands(data[window_start:end], segment_level, segment_window_size, segment_max_chain,
+                                    start - window_start, backend)
+            i = start
+            out_of_time = False
+            for num_commands, command in enumerate(commands, 1):
+                cost += get_command_cost(command)
+                yield command
+                i += 1 if command < 0x100 else command >> LZ_OFFSET_BITS
+                if num_commands % BUDGET_CHECK_INTERVAL == 0 and time.perf_counter() >= deadline - (data_len - i) * BUDGET_LITERAL_SECONDS_PER_BYTE:
+                    # Out of time, so finish the segment with immediate
+                    # bytes. The next segment copies the rest of the data.
+                    commands.close()
+                    effort_bytes[name] = effort_bytes.get(name, 0) + i - start
+                    effort_bytes[BUDGET_EFFORT_LITERAL] = effort_bytes.get(BUDGET_EFFORT_LITERAL, 0) + end - i
+                    yield from data[i:end]
+                    out_of_time = True
+                    break
+            if out_of_time:
+                start = end
+                continue
+
+        effort_bytes[name] = effort_bytes.get(name, 0) + end - start
+        if end == data_len:
+            break
+
+        # Average this segment's time per byte into the measurements, then
+        # pick the most effort that fits in the time per byte that's left.
+        now = time.perf_counter()
+        seconds_per_byte = (now - segment_start_time) / (end - start)
+        if rates[effort] is None:
+            rates[effort] = seconds_per_byte
+        else:
+            rates[effort] = (rates[effort] + seconds_per_byte) / 2
+        budget_per_byte = (deadline - now) / (data_len - end)
+        # How compressible immediate bytes are isn't known, so more effort
+        # is always considered after them. More effort is also considered
+        # until every setting above this one has been timed.
+        if (effort == len(efforts) or (effort > 0 and rates[effort - 1] is None)
+                or cost / 8 <= (end - start) * BUDGET_COMPRESSIBLE_RATIO):
+            effort = 0
+        while effort < len(efforts) and get_budget_effort_estimate(rates, effort) > budget_per_byte:
+            effort += 1
+        start = end
+
+
+# Most bytes that one ctrl byte and its group of 8 commands can take up
+# in the compressed stream.
+MAX_GROUP_SIZE = 1 + 8 * 3
+
+# When encoding to a file, the output is written in blocks of about this size.
+ENCODE_BLOCK_SIZE = 0x10000
+
+
+def get_max_compressed_size(data_len):
+    """
+    Gets the largest possible compressed size for data of the given length,
+    not counting the header. This is when every byte is an immediate byte.
+    """
+    num_commands = data_len + 1
+    return num_commands + (num_commands + 7) // 8 + 2
+
+
+def encode_commands(commands, output, f=None, size_hint=ENCODE_BLOCK_SIZE):
+    """
+    Builds the raw compressed stream from the LZ commands, appending it to
+    the given output bytearray. The terminating command is added
+    automatically. The commands can be any iterable, such as one of the
+    parse generators, so the whole list of commands never has to exist at
+    once. The output is grown in blocks, starting with size_hint bytes.
+    If a writable file object f is given, each block is written to the file
+    instead of being kept in memory, and the number of bytes written is
+    returned. Otherwise, the output bytearray is returned.
+    """
+    pos = len(output)
+    output.extend(bytes(max(size_hint, MAX_GROUP_SIZE)))
+    capacity = len(output)
+    num_written = 0
 
-    # Build the raw compressed stream from the LZ commands.
     ctrl = 0x0
     ctrl_bit = 7
-    buff = []
-    for command in commands:
-        if command['type'] == 'copy':
-            buff.append(command['value'])
+    ctrl_pos = pos
+    pos += 1
+    for command in itertools.chain(commands, (LZ_TERMINATOR,)):
+        if command < 0x100:
+            output[pos] = command
+            pos += 1
         else:
             ctrl |= (1 << ctrl_bit)
-            p0 = ((command['offset'] >> 8) & 0xFF) << 4
-            p1 = command['offset'] & 0xFF
-            if command['length'] <= 16:
-                p0 |= (command['length'] - 1)
-
-            buff.append(p0)
-            buff.append(p1)
-            if command['length'] > 16:
-                if command['length'] - 17 > 255:
-                    fatal_error("Unexpected prefix length %s" % command['length'])
-                buff.append(command['length'] - 17)
+            offset = command & LZ_OFFSET_MASK
+            length = command >> LZ_OFFSET_BITS
+            p0 = (offset >> 4) & 0xF0
+            if length <= 16:
+                output[pos] = p0 | (length - 1)
+                output[pos + 1] = offset & 0xFF
+                pos += 2
+            else:
+                if length - 17 > 255:
+                    fatal_error("Unexpected prefix length %s" % length)
+                output[pos] = p0
+                output[pos + 1] = offset & 0xFF
+                output[pos + 2] = length - 17
+                pos += 3
 
         ctrl_bit -= 1
         if ctrl_bit < 0:
-            output.append(ctrl)
-            output.extend(buff)
+            output[ctrl_pos] = ctrl
             ctrl = 0x0
             ctrl_bit = 7
-            buff = []
+            # Make sure there's room for the next group.
+            if pos + MAX_GROUP_SIZE > capacity:
+                if f is not None:
+                    f.write(output[:pos])
+                    num_written += pos
+                    pos = 0
+                else:
+                    output.extend(bytes(max(ENCODE_BLOCK_SIZE, capacity // 2)))
+                    capacity = len(output)
+            ctrl_pos = pos
+            pos += 1
 
     if ctrl_bit != 7:
-        output.append(ctrl)
-        output.extend(buff)
+        output[ctrl_pos] = ctrl
+    else:
+        # The last group is empty, so drop its ctrl byte.
+        pos -= 1
+    del output[pos:]
 
+    if f is not None:
+        f.write(output)
+        return num_written + len(output)
     return output
+
+
+def init_output(data, compress_type):
+    """
+    Gets a new compressed output bytearray, containing just the header for
+    the given uncompressed data.
+    """
+    data_len = len(data)
+    if data_len > 0xFFFFFF:
+        fatal_error("Data is too large (%s bytes) to compress! Must be <= 0xFFFFFF bytes" % hex(data_len))
+
+    output = bytearray(4)
+    struct.pack_into(">I", output, 0, data_len)
+    # The uncompressed data length is only three bytes large, and we
+    # overwrite the first byte in the header with the compression type
+    output[0] = compress_type
+    return output
+
+
+def check_settings(level, window_size):
+    """
+    Checks that the given compression settings are valid. If they aren't,
+    then the program is terminated.
+    """
+    if level not in COMPRESS_LEVELS:
+        fatal_error("Invalid compression level '%s'. Valid levels are %s." % (level, ", ".join(COMPRESS_LEVELS)))
+    if window_size > LZ_MAX_WINDOW_SIZE:
+        fatal_error("LZ window size %s is too large. Must be <= %s" % (window_size, LZ_MAX_WINDOW_SIZE))
+
+
+def compress(data, compress_type=0x1, window_size=LZ_WINDOW_SIZE, max_chain=LZ_MAX_CHAIN, level=COMPRESS_LEVEL_GREEDY, workers=1, f=None,
+             backend=LZ_BACKEND_AUTO, time_budget=None, stats=None):
+    """
+    Compresses the given input bytearray.
+    Args:
+        data: the raw data bytearray to be compressed
+        compress_type: there are two types of compressed files; 0x1 and 0x2
+                       Type 0x1 is a plain compressed file.
+                       Type 0x2 is just like type 0x1, but there is a data table appended to the file.
+                           ToadsTool doesn't support type 0x2 right now, because the data table isn't fully
+                           understood. If you need to modify a type-2 compressed file, simply append the
+                           original datatable to the end of the resulting compressed file.
+        window_size: how far back (in bytes) to search for matches
+        max_chain: how many candidate matches to check at each position
+        level: one of COMPRESS_LEVELS, trading speed for compressed size
+        workers: number of processes to split the match finding across, for large inputs
+        f: optional writable file object. If given, the compressed data is written to it,
+           and the number of bytes written is returned instead of the compressed data.
+        backend: one of LZ_BACKENDS, choosing how matches are found. This doesn't affect the output.
+        time_budget: optional number of seconds to aim to finish within. The effort is lowered
+                     from the given settings as needed to keep up, so the output may be larger.
+                     workers is ignored when a time budget is given.
+        stats: optional dict. If given, it's filled in with the input and output sizes, the
+               compression ratio and the time taken. With a time budget, it also gets the
+               number of bytes compressed with each effort setting.
+    """
+    start_time = time.perf_counter()
+    output = init_output(data, compress_type)
+    check_settings(level, window_size)
+    backend = get_backend(backend, level)
+    if time_budget is not None and time_budget <= 0:
+        fatal_error("Compression time budget must be greater than 0 seconds.")
+
+    # Generate the LZ commands for copying immediate or pre-existing data,
+    # and build the raw compressed stream from them as they are generated.
+    if time_budget is not None:
+        commands = get_commands_budgeted(data, level, window_size, max_chain, time_budget, backend, stats)
+    elif workers > 1:
+        commands = get_commands_parallel(data, level, window_size, max_chain, workers, backend)
+    else:
+        commands = get_commands(data, level, window_size, max_chain, backend=backend)
+    if f is not None:
+        result = encode_commands(commands, output, f)
+        output_size = result
+    else:
+        result = encode_commands(commands, output, size_hint=get_max_compressed_size(len(data)))
+        output_size = len(result)
+
+    if stats is not None:
+        stats["input_size"] = len(data)
+        stats["output_size"] = output_size
+        stats["ratio"] = output_size / len(data) if len(data) > 0 else 1.0
+        stats["seconds"] = time.perf_counter() - start_time
+    return result
+
+
+def get_common_prefix_length(a, b):
+    """
+    Gets the number of bytes at the start of a and b that are equal.
+    """
+    low = 0
+    high = min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def get_common_suffix_length(a, b, max_length):
+    """
+    Gets the number of bytes at the end of a and b that are equal, up
+    to max_length.
+    """
+    low = 0
+    high = min(len(a), len(b), max_length)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def get_command_positions(commands):
+    """
+    Gets the input offset where each LZ command starts. The list has one
+    extra entry at the end, which is the length of the input.
+    """
+    positions = [0] * (len(commands) + 1)
+    position = 0
+    for i, command in enumerate(commands):
+        positions[i] = position
+        position += 1 if command < 0x100 else command >> LZ_OFFSET_BITS
+    positions[-1] = position
+    return positions
+
+
+def get_commands_incremental(data, stream, level, window_size, max_chain, backend=LZ_BACKEND_PYTHON):
+    """
+    Parses the given data into a list of LZ commands, reusing as much of a
+    previous compression's command stream as possible. Commands are reused
+    up to the first byte that changed. After the last changed byte, once the
+    data has matched the old data for a full window, the old commands can't
+    tell the difference, so the rest of them are reused as well.
+    """
+    old_data = stream["data"]
+    old_commands = stream["commands"]
+    positions = stream["positions"]
+    window_size = stream["window_size"]
+
+    # Find the region of the input that changed.
+    prefix_length = get_common_prefix_length(data, old_data)
+    if prefix_length == len(data) == len(old_data):
+        return list(old_commands)
+    suffix_length = get_common_suffix_length(data, old_data, min(len(data), len(old_data)) - prefix_length)
+    delta = len(old_data) - len(data)
+
+    # Reuse the old commands that end before the first changed byte.
+    head_end = bisect.bisect_right(positions, prefix_length) - 1
+    start_index = positions[head_end]
+
+    # Reuse the old commands that start at least one window past the
+    # last changed byte.
+    tail_start = bisect.bisect_left(positions, len(old_data) - suffix_length + window_size)
+    if tail_start < len(old_commands):
+        end_index = positions[tail_start] - delta
+    else:
+        tail_start = len(old_commands)
+        end_index = len(data)
+
+    # Parse the changed region. Matches must not run past the point where
+    # the old commands are reused, so only give the parser data up to there.
+    window_start = max(0, start_index - window_size)
+    middle = list(get_commands(data[window_start:end_index], level, window_size, max_chain, start_index - window_start, backend))
+    return old_commands[:head_end] + middle + old_commands[tail_start:]
+
+
+def compress_incremental(data, stream=None, compress_type=0x1, window_size=LZ_WINDOW_SIZE, max_chain=LZ_MAX_CHAIN, level=COMPRESS_LEVEL_GREEDY,
+                         backend=LZ_BACKEND_AUTO):
+    """
+    Compresses the given input bytearray, like compress(). If a command stream
+    from a previous compression is given, only the parts of the input that
+    changed since then are parsed again. Returns a tuple of the compressed
+    data and the new command stream, which can be passed to the next call.
+    The command stream is only reused if it was made with the same settings.
+    """
+    output = init_output(data, compress_type)
+    check_settings(level, window_size)
+    backend = get_backend(backend, level)
+
+    data = bytes(data)
+    if stream is not None and (stream["level"], stream["window_size"], stream["max_chain"]) == (level, window_size, max_chain):
+        commands = get_commands_incremental(data, stream, level, window_size, max_chain, backend)
+    else:
+        commands = list(get_commands(data, level, window_size, max_chain, backend=backend))
+
+    new_stream = {
+        "data": data,
+        "commands": commands,
+        "positions": get_command_positions(commands),
+        "level": level,
+        "window_size": window_size,
+        "max_chain": max_chain,
+    }
+    return encode_commands(commands, output), new_stream
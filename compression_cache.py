@@ -0,0 +1,290 @@
+# This file contains logic for caching compressed files on disk, so
+# files whose contents haven't changed don't need to be compressed again.
+# Cache entries are keyed by a hash of the uncompressed data and the
+# compression settings. When the cache grows past its size limit, the least
+# recently used entries are deleted.
+#
+# The cache also keeps the LZ command stream from the last time each file
+# was compressed, so a file with small changes can be recompressed
+# incrementally. Incremental output depends on the command stream it started
+# from, not just on the data, so its key also includes a hash of the stream.
+#
+# 'setup' also keeps the decompressed contents of the game's compressed files
+# in the cache, along with their checkpoint indexes, keyed by a hash of the
+# compressed data. Setting up another working directory from the same game
+# then doesn't need to decompress anything.
+
+import hashlib
+import os
+import pickle
+import shutil
+
+import compression
+
+# Bump this whenever the compressor's output changes for the same settings,
+# so stale entries are never used.
+CACHE_VERSION = 2
+
+# Default limit for the total size of the cache, in bytes.
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+
+CACHE_ENTRY_EXTENSION = ".bin"
+STREAM_EXTENSION = ".pickle"
+
+# Suffix of the cache key of a decompressed file's checkpoint index.
+CHECKPOINT_INDEX_KEY_SUFFIX = "-index"
+STREAMS_DIR = "streams"
+
+# Entries and command streams used by this process are also kept in memory,
+# so long-running commands like 'watch' don't need to read them back from
+# disk. Only the most recently stored entries are kept.
+MEMORY_CACHE_ENTRIES = 16
+memory_entries = {}
+memory_streams = {}
+
+
+def get_key(data, compress_type=0x1, level=compression.COMPRESS_LEVEL_GREEDY,
+            window_size=compression.LZ_WINDOW_SIZE, max_chain=compression.LZ_MAX_CHAIN, stream=None):
+    """
+    Gets the cache key for compressing the given data with the given settings.
+    If stream is given, the key is for recompressing the data incrementally
+    from that command stream.
+    """
+    settings = "%s:%s:%s:%s:%s" % (CACHE_VERSION, compress_type, level, window_size, max_chain)
+    h = hashlib.sha256(settings.encode("ASCII"))
+    h.update(data)
+    if stream is not None:
+        h.update(get_stream_hash(stream).encode("ASCII"))
+    return h.hexdigest()
+
+
+def get_stream_hash(stream):
+    """
+    Gets a hash of a command stream's data, commands and settings.
+    """
+    settings = "%s:%s:%s" % (stream["level"], stream["window_size"], stream["max_chain"])
+    h = hashlib.sha256(settings.encode("ASCII"))
+    h.update(stream["data"])
+    h.update(pickle.dumps(stream["commands"], protocol=pickle.HIGHEST_PROTOCOL))
+    return h.hexdigest()
+
+
+def get_decompress_key(data):
+    """
+    Gets the cache key for the decompressed contents of the given compressed
+    data.
+    """
+    h = hashlib.sha256(("%s:decompress" % CACHE_VERSION).encode("ASCII"))
+    h.update(data)
+    return h.hexdigest()
+
+
+def get_entry_filepath(cache_dir, key):
+    """
+    Gets the filepath of the cache entry for the given key. Entries are
+    spread across subdirectories named after the first two characters of
+    the key.
+    """
+    return os.path.join(cache_dir, key[:2], key + CACHE_ENTRY_EXTENSION)
+
+
+def load(cache_dir, key):
+    """
+    Gets the cached compressed data for the given key, or None if it's not
+    in the cache. The entry is marked as recently used.
+    """
+    entry_filepath = get_entry_filepath(cache_dir, key)
+    data = memory_entries.get(entry_filepath)
+    try:
+        if data is None:
+            with open(entry_filepath, "rb") as f:
+                data = f.read()
+        os.utime(entry_filepath)
+    except OSError:
+        return None
+    return data
+
+
+def store_memory_entry(entry_filepath, data):
+    """
+    Keeps a cache entry in memory, forgetting the oldest one if there are
+    too many.
+    """
+    memory_entries.pop(entry_filepath, None)
+    memory_entries[entry_filepath] = data
+    if len(memory_entries) > MEMORY_CACHE_ENTRIES:
+        del memory_entries[next(iter(memory_entries))]
+
+
+def store(cache_dir, key, data):
+    """
+    Stores compressed data in the cache under the given key. The entry is
+    written to a temporary file first, so concurrent readers never see a
+    partially-written entry.
+    """
+    entry_filepath = get_entry_filepath(cache_dir, key)
+    os.makedirs(os.path.dirname(entry_filepath), exist_ok=True)
+    temp_filepath = "%s.%s.tmp" % (entry_filepath, os.getpid())
+    with open(temp_filepath, "wb") as f:
+        f.write(data)
+    os.replace(temp_filepath, entry_filepath)
+    store_memory_entry(entry_filepath, data)
+
+
+def load_decompressed(cache_dir, data):
+    """
+    Gets the cached decompressed contents of the given compressed data, and
+    their checkpoint index file's contents, as a tuple. Returns None if
+    either isn't in the cache.
+    """
+    key = get_decompress_key(data)
+    decompressed_data = load(cache_dir, key)
+    index_data = load(cache_dir, key + CHECKPOINT_INDEX_KEY_SUFFIX)
+    if decompressed_data is None or index_data is None:
+        return None
+    return decompressed_data, index_data
+
+
+def store_decompressed(cache_dir, data, decompressed_data, index_data):
+    """
+    Stores the decompressed contents of the given compressed data in the
+    cache, along with their checkpoint index file's contents.
+    """
+    key = get_decompress_key(data)
+    store(cache_dir, key, decompressed_data)
+    store(cache_dir, key + CHECKPOINT_INDEX_KEY_SUFFIX, index_data)
+
+
+def get_entries(cache_dir):
+    """
+    Gets a list of all the cache entries and saved command streams, as
+    tuples of (last used time, size, filepath). Both count towards the
+    cache's size limit.
+    """
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+
+    for dirpath, _, filenames in os.walk(cache_dir):
+        for filename in filenames:
+            if not filename.endswith((CACHE_ENTRY_EXTENSION, STREAM_EXTENSION)):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            stat = os.stat(filepath)
+            entries.append((stat.st_mtime, stat.st_size, filepath))
+    return entries
+
+
+def evict(cache_dir, max_size=DEFAULT_CACHE_SIZE):
+    """
+    Deletes the least recently used cache entries until the total size of
+    the cache is at most max_size bytes. Returns the number of deleted entries.
+    """
+    entries = get_entries(cache_dir)
+    total_size = sum(size for _, size, _ in entries)
+    num_evicted = 0
+    for _, size, filepath in sorted(entries):
+        if total_size <= max_size:
+            break
+        os.remove(filepath)
+        memory_entries.pop(filepath, None)
+        memory_streams.pop(filepath, None)
+        total_size -= size
+        num_evicted += 1
+    return num_evicted
+
+
+def get_stats(cache_dir):
+    """
+    Gets the number of entries and saved command streams in the cache, and
+    their total size in bytes.
+    """
+    entries = get_entries(cache_dir)
+    return {
+        "entries": sum(1 for _, _, filepath in entries if filepath.endswith(CACHE_ENTRY_EXTENSION)),
+        "streams": sum(1 for _, _, filepath in entries if filepath.endswith(STREAM_EXTENSION)),
+        "size": sum(size for _, size, _ in entries),
+    }
+
+
+def clear(cache_dir):
+    """
+    Deletes every entry in the cache.
+    """
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    memory_entries.clear()
+    memory_streams.clear()
+
+
+def get_stream_filepath(cache_dir, name):
+    """
+    Gets the filepath of the saved command stream for the given file name.
+    """
+    return os.path.join(cache_dir, STREAMS_DIR, name.replace("/", "_") + STREAM_EXTENSION)
+
+
+def load_stream(cache_dir, name):
+    """
+    Gets the saved command stream for the given file name, or None if there
+    isn't one. The stream is marked as recently used.
+    """
+    stream_filepath = get_stream_filepath(cache_dir, name)
+    stream = memory_streams.get(stream_filepath)
+    try:
+        if stream is None:
+            with open(stream_filepath, "rb") as f:
+                stream = pickle.load(f)
+        os.utime(stream_filepath)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return None
+    if stream.get("version") != CACHE_VERSION:
+        return None
+    return stream
+
+
+def store_stream(cache_dir, name, stream):
+    """
+    Saves the command stream for the given file name, replacing the old one.
+    """
+    stream_filepath = get_stream_filepath(cache_dir, name)
+    os.makedirs(os.path.dirname(stream_filepath), exist_ok=True)
+    temp_filepath = "%s.%s.tmp" % (stream_filepath, os.getpid())
+    stream = dict(stream, version=CACHE_VERSION)
+    with open(temp_filepath, "wb") as f:
+        pickle.dump(stream, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_filepath, stream_filepath)
+    memory_streams[stream_filepath] = stream
+
+
+def compress(data, cache_dir, compress_type=0x1, level=compression.COMPRESS_LEVEL_GREEDY, stream_name=None, time_budget=None,
+             base_stream=None):
+    """
+    Compresses the given data, using the cached result if there is one.
+    If stream_name is given, the file is recompressed incrementally from its
+    saved command stream, and the new command stream is saved afterwards.
+    If base_stream is given instead, the file is recompressed incrementally
+    from that command stream, which isn't replaced.
+    With a time budget, a cached result is still used, but new results
+    depend on how fast the machine was, so they aren't cached.
+    Returns a tuple of the compressed data and whether it came from the cache.
+    """
+    stream = base_stream
+    if stream is None and stream_name is not None:
+        stream = load_stream(cache_dir, stream_name)
+    key = get_key(data, compress_type, level, stream=stream)
+    compressed_data = load(cache_dir, key)
+    if compressed_data is not None:
+        return compressed_data, True
+
+    if time_budget is not None:
+        return compression.compress(data, compress_type, level=level, time_budget=time_budget), False
+
+    if base_stream is None and stream_name is None:
+        compressed_data = compression.compress(data, compress_type, level=level)
+    else:
+        compressed_data, new_stream = compression.compress_incremental(data, stream, compress_type, level=level)
+        if base_stream is None:
+            store_stream(cache_dir, stream_name, new_stream)
+    store(cache_dir, key, compressed_data)
+    return compressed_data, False
@@ -0,0 +1,156 @@
+# This file contains an optional NumPy backend for the compressor's match
+# finder. Instead of walking the hash chains one position at a time, it
+# finds the longest match for every position of the input at once, using
+# vectorized operations. The matches are exactly the ones the hash-chain
+# match finder in compression.py would find, so the compressed output is
+# byte-identical either way.
+#
+# NumPy is not required. If it isn't installed, is_available() returns False
+# and the compressor uses the pure-Python match finder.
+
+import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import compression
+
+# Thresholds for counting the leading zero bytes in a 64-bit word. A word
+# has at least b leading zero bytes if it's less than 2^(64 - 8 * b).
+LEADING_ZERO_BYTE_THRESHOLDS = [1 << (64 - 8 * b) for b in range(1, 8)]
+
+
+def is_available():
+    """
+    Gets whether or not NumPy is installed.
+    """
+    return np is not None
+
+
+def get_words(arr):
+    """
+    Gets the big-endian 64-bit word that starts at every position of the
+    given uint8 array. Positions near the end are padded with zeros.
+    """
+    padded = np.concatenate((arr, np.zeros(8, dtype=np.uint8))).astype(np.uint64)
+    words = np.zeros(len(arr), dtype=np.uint64)
+    for i in range(8):
+        words |= padded[i:i + len(arr)] << np.uint64(56 - 8 * i)
+    return words
+
+
+def get_match_lengths(words, sources, targets, max_lengths):
+    """
+    Counts how many bytes match between each pair of source and target
+    positions, up to the pair's max length. Matches are compared 8 bytes at
+    a time, and only the pairs that are still matching are compared again.
+    """
+    lengths = np.zeros(len(sources), dtype=np.int32)
+    active = np.arange(len(sources), dtype=np.int32)
+    while len(active) > 0:
+        diff = words[sources[active] + lengths[active]] ^ words[targets[active] + lengths[active]]
+        equal = diff == 0
+        lengths[active[equal]] += 8
+
+        # For the pairs that stopped matching, add the matching bytes at the
+        # start of the word that differed.
+        stopped = active[~equal]
+        stopped_diff = diff[~equal]
+        for threshold in LEADING_ZERO_BYTE_THRESHOLDS:
+            lengths[stopped] += stopped_diff < np.uint64(threshold)
+
+        active = active[equal]
+        active = active[lengths[active] < max_lengths[active]]
+
+    return np.minimum(lengths, max_lengths)
+
+
+def find_matches(data, start_index, end_index, window_size, max_chain):
+    """
+    Finds the longest match for every position from start_index up to (but
+    not including) end_index. Returns two arrays: the start index of each
+    position's match, and its length (0 if there was no match). This gives
+    the same results as calling compression.find_longest_match() for each
+    position.
+    """
+    data_len = len(data)
+    all_indexes = np.arange(start_index, end_index, dtype=np.int64)
+    all_lengths = np.zeros(end_index - start_index, dtype=np.uint16)
+    # Only positions with enough bytes left for a minimum-length match are
+    # added to the hash chains, and data before the window is never used.
+    first_index = max(0, start_index - window_size)
+    last_index = min(end_index, data_len - compression.LZ_PREFIX_MIN_LENGTH + 1)
+    if last_index > start_index:
+        # Work on just the slice of the data the matches can touch, so
+        # positions are relative to first_index from here on.
+        arr = np.frombuffer(bytes(data[first_index:last_index + compression.LZ_PREFIX_MAX_LENGTH]), dtype=np.uint8)
+        words = get_words(arr)
+        positions = np.arange(last_index - first_index, dtype=np.int32)
+        keys = (arr[positions].astype(np.int64) << 16) | (arr[positions + 1].astype(np.int64) << 8) | arr[positions + 2]
+        hashes = (((keys * 2654435761) >> 16) & (compression.LZ_HASH_SIZE - 1)).astype(np.int32)
+        del keys
+        max_lengths = np.minimum(compression.LZ_PREFIX_MAX_LENGTH, data_len - first_index - positions).astype(np.int32)
+        best_indexes, best_lengths = find_chain_matches(arr, words, positions, hashes, max_lengths, window_size, max_chain)
+
+        # Fill in the results for the positions that were asked for.
+        found = best_lengths >= compression.LZ_PREFIX_MIN_LENGTH
+        found[:start_index - first_index] = False
+        all_indexes[positions[found] + first_index - start_index] = best_indexes[found] + first_index
+        all_lengths[positions[found] + first_index - start_index] = best_lengths[found]
+
+    # The results are returned as arrays rather than lists to keep memory
+    # use down, but they still give plain ints when indexed.
+    return array.array("q", all_indexes.tobytes()), array.array("H", all_lengths.tobytes())
+
+
+def find_chain_matches(arr, words, positions, hashes, max_lengths, window_size, max_chain):
+    """
+    Finds the longest match for each of the given positions among the
+    max_chain most recent earlier positions with the same hash, within the
+    window. Returns the start indexes and lengths of the best matches.
+    Positions without a match are given a length less than the minimum.
+    """
+    # Group the positions by hash, keeping each group in order. Then, the
+    # k-th most recent position in a position's hash chain is simply the
+    # position k places before it in the same group.
+    order = np.argsort(hashes, kind="stable").astype(np.int32)
+    sorted_hashes = hashes[order]
+    sorted_positions = positions[order]
+    best_lengths = np.full(len(positions), compression.LZ_PREFIX_MIN_LENGTH - 1, dtype=np.int32)
+    best_indexes = positions.copy()
+    # Ranks (indexes into the sorted order) of the positions that could
+    # still find a better match further along their chains. Once a position
+    # runs out of chain or window, or has the longest possible match, it
+    # stays that way, so the set only ever shrinks.
+    alive = np.arange(len(order), dtype=np.int32)
+    for k in range(1, max_chain + 1):
+        # Pair each position with the candidate k steps back in its chain,
+        # and drop the positions whose chains end before that.
+        alive = alive[alive >= k]
+        candidate_ranks = alive - k
+        valid = (sorted_hashes[candidate_ranks] == sorted_hashes[alive]) & (sorted_positions[alive] - sorted_positions[candidate_ranks] <= window_size)
+        alive = alive[valid]
+        targets = order[alive]
+        valid = best_lengths[targets] < max_lengths[targets]
+        alive = alive[valid]
+        if len(alive) == 0:
+            break
+
+        # Only do the full comparison for candidates that could beat the
+        # current best match.
+        targets = targets[valid]
+        candidates = sorted_positions[alive - k]
+        target_positions = positions[targets]
+        best = best_lengths[targets]
+        keep = arr[candidates + best] == arr[target_positions + best]
+        targets = targets[keep]
+        candidates = candidates[keep]
+
+        lengths = get_match_lengths(words, candidates, target_positions[keep], max_lengths[targets])
+        better = lengths > best_lengths[targets]
+        best_lengths[targets[better]] = lengths[better]
+        best_indexes[targets[better]] = candidates[better]
+
+    return best_indexes, best_lengths
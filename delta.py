@@ -0,0 +1,284 @@
+# This file contains logic for binary patch files, which hold the changes
+# between the game's original files and the files ToadsTool built, rather
+# than the files themselves. They're made by 'apply --patch-out' and applied
+# by the 'patch-apply' command.
+#
+# Each changed file is stored as a delta: a list of operations that build the
+# new file from the original one.
+#   copy: copy a run of bytes from the original file
+#   insert: insert new bytes
+# The original file is split into blocks, which are indexed by their
+# contents, so runs that are unchanged or only moved are found quickly. Runs
+# at the same offset as the last copy are checked first, which covers most
+# edits, since they usually don't move the data around them.
+#
+# Patch file layout (numbers are unsigned LEB128 varints):
+#   magic
+#   number of files
+#   for each file:
+#     filepath length, filepath (UTF-8)
+#     original size, original SHA-1 (20 bytes)
+#     new size, new SHA-1 (20 bytes)
+#     delta length, delta
+# Each delta operation starts with a varint of ((length - 1) << 1) | op. A copy
+# is followed by its original file offset, relative to the end of the last
+# copy, as a zigzag varint. An insert is followed by its bytes.
+
+import hashlib
+
+from util import fatal_error
+
+PATCH_MAGIC = b"TTPATCH1"
+
+DELTA_OP_COPY = 0
+DELTA_OP_INSERT = 1
+
+# Size of the blocks that the original file is indexed by. Unchanged runs
+# shorter than this are never found, and longer ones might not be (see below).
+DELTA_BLOCK_SIZE = 32
+
+# Where nothing matches, the target is checked at every byte for a block
+# past the end of the last copy, which finds where small edits end. After
+# that, it's checked this many bytes apart. That's one less than the block
+# size, so successive checks land on every alignment of the source's blocks,
+# and unchanged runs of about DELTA_BLOCK_SIZE * DELTA_SCAN_STEP bytes or
+# more are still found. The start of a run is then found by extending the
+# match backwards.
+DELTA_SCAN_STEP = DELTA_BLOCK_SIZE - 1
+
+# Matching runs are compared this many bytes at a time.
+DELTA_COMPARE_CHUNK_SIZE = 0x1000
+
+
+def write_varint(out, value):
+    """
+    Appends an unsigned integer to a bytearray as a LEB128 varint.
+    """
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, offset):
+    """
+    Reads a LEB128 varint from the data. Returns a tuple of the value and
+    the offset after it.
+    """
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            fatal_error("Patch file is truncated.")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, offset
+
+
+def get_match_length(source, source_index, target, target_index):
+    """
+    Counts how many bytes match between the source and target, starting at
+    the given indexes.
+    """
+    max_length = min(len(source) - source_index, len(target) - target_index)
+    length = 0
+    while length < max_length:
+        size = min(DELTA_COMPARE_CHUNK_SIZE, max_length - length)
+        if source[source_index + length:source_index + length + size] == target[target_index + length:target_index + length + size]:
+            length += size
+            continue
+
+        # Binary search for the first byte that differs within the chunk.
+        low = 0
+        high = size
+        while high - low > 1:
+            mid = (low + high) // 2
+            if source[source_index + length:source_index + length + mid] == target[target_index + length:target_index + length + mid]:
+                low = mid
+            else:
+                high = mid
+        return length + low
+    return length
+
+
+def get_block_index(source):
+    """
+    Gets a dict of the source's blocks, mapped to their first offsets.
+    """
+    index = {}
+    for offset in range(0, len(source) - DELTA_BLOCK_SIZE + 1, DELTA_BLOCK_SIZE):
+        index.setdefault(source[offset:offset + DELTA_BLOCK_SIZE], offset)
+    return index
+
+
+def get_delta(source, target):
+    """
+    Gets the delta that builds the target bytes from the source bytes.
+    """
+    # Blocks are used as dict keys, so they need to be immutable.
+    source = bytes(source)
+    target = bytes(target)
+    index = get_block_index(source)
+    delta = bytearray()
+    copy_end = 0
+    insert_start = 0
+    target_index = 0
+    shift = 0
+    while target_index + DELTA_BLOCK_SIZE <= len(target):
+        # Try continuing from the last copy's offset, then the same offset,
+        # then any block of the source with the same contents.
+        block = target[target_index:target_index + DELTA_BLOCK_SIZE]
+        source_index = None
+        for candidate in (target_index + shift, target_index, index.get(block)):
+            if candidate is not None and 0 <= candidate and source[candidate:candidate + DELTA_BLOCK_SIZE] == block:
+                source_index = candidate
+                break
+        if source_index is None:
+            target_index += 1 if target_index - insert_start < DELTA_BLOCK_SIZE else DELTA_SCAN_STEP
+            continue
+
+        length = get_match_length(source, source_index, target, target_index)
+        # The match might have started in the bytes that were going to
+        # be inserted.
+        while target_index > insert_start and source_index > 0 and source[source_index - 1] == target[target_index - 1]:
+            source_index -= 1
+            target_index -= 1
+            length += 1
+
+        if target_index > insert_start:
+            write_insert(delta, target[insert_start:target_index])
+        write_varint(delta, ((length - 1) << 1) | DELTA_OP_COPY)
+        relative_offset = source_index - copy_end
+        write_varint(delta, relative_offset * 2 if relative_offset >= 0 else -relative_offset * 2 - 1)
+        copy_end = source_index + length
+        shift = source_index - target_index
+        target_index += length
+        insert_start = target_index
+
+    if insert_start < len(target):
+        write_insert(delta, target[insert_start:])
+    return delta
+
+
+def write_insert(delta, data):
+    """
+    Appends an insert operation for the given bytes to a delta.
+    """
+    write_varint(delta, ((len(data) - 1) << 1) | DELTA_OP_INSERT)
+    delta.extend(data)
+
+
+def apply_delta(source, delta):
+    """
+    Builds the target bytes from the source bytes and a delta.
+    """
+    target = bytearray()
+    copy_end = 0
+    offset = 0
+    while offset < len(delta):
+        value, offset = read_varint(delta, offset)
+        length = (value >> 1) + 1
+        if value & 1 == DELTA_OP_COPY:
+            relative_offset, offset = read_varint(delta, offset)
+            source_index = copy_end + (relative_offset >> 1 if relative_offset & 1 == 0 else -((relative_offset + 1) >> 1))
+            if source_index < 0 or source_index + length > len(source):
+                fatal_error("Patch copies bytes from outside the original file.")
+            target.extend(source[source_index:source_index + length])
+            copy_end = source_index + length
+        else:
+            if offset + length > len(delta):
+                fatal_error("Patch file is truncated.")
+            target.extend(delta[offset:offset + length])
+            offset += length
+    return target
+
+
+def make_entry(filepath, source, target):
+    """
+    Gets a patch entry that turns the source file contents into the target
+    file contents.
+    """
+    return {
+        "filepath": filepath,
+        "source_size": len(source),
+        "source_hash": hashlib.sha1(source).digest(),
+        "target_size": len(target),
+        "target_hash": hashlib.sha1(target).digest(),
+        "delta": get_delta(source, target),
+    }
+
+
+def apply_entry(entry, source):
+    """
+    Builds a patch entry's new file contents from the original file contents.
+    The original file must be the one the patch was made from.
+    """
+    if len(source) != entry["source_size"] or hashlib.sha1(source).digest() != entry["source_hash"]:
+        fatal_error("'%s' isn't the file this patch was made from." % entry["filepath"])
+    target = apply_delta(source, entry["delta"])
+    if len(target) != entry["target_size"] or hashlib.sha1(target).digest() != entry["target_hash"]:
+        fatal_error("Patch for '%s' is corrupt." % entry["filepath"])
+    return target
+
+
+def is_patched(entry, data):
+    """
+    Gets whether or not the given file contents are already the patch
+    entry's new file contents.
+    """
+    return len(data) == entry["target_size"] and hashlib.sha1(data).digest() == entry["target_hash"]
+
+
+def save(filepath, entries):
+    """
+    Writes patch entries to a patch file.
+    """
+    data = bytearray(PATCH_MAGIC)
+    write_varint(data, len(entries))
+    for entry in entries:
+        name = entry["filepath"].encode("UTF-8")
+        write_varint(data, len(name))
+        data.extend(name)
+        write_varint(data, entry["source_size"])
+        data.extend(entry["source_hash"])
+        write_varint(data, entry["target_size"])
+        data.extend(entry["target_hash"])
+        write_varint(data, len(entry["delta"]))
+        data.extend(entry["delta"])
+    with open(filepath, "wb") as f:
+        f.write(data)
+    return len(data)
+
+
+def load(filepath):
+    """
+    Reads the patch entries from a patch file.
+    """
+    with open(filepath, "rb") as f:
+        data = f.read()
+    if not data.startswith(PATCH_MAGIC):
+        fatal_error("'%s' isn't a ToadsTool patch file." % filepath)
+
+    entries = []
+    num_entries, offset = read_varint(data, len(PATCH_MAGIC))
+    for _ in range(num_entries):
+        entry = {}
+        name_length, offset = read_varint(data, offset)
+        entry["filepath"] = data[offset:offset + name_length].decode("UTF-8")
+        offset += name_length
+        entry["source_size"], offset = read_varint(data, offset)
+        entry["source_hash"] = data[offset:offset + 20]
+        offset += 20
+        entry["target_size"], offset = read_varint(data, offset)
+        entry["target_hash"] = data[offset:offset + 20]
+        offset += 20
+        delta_length, offset = read_varint(data, offset)
+        entry["delta"] = data[offset:offset + delta_length]
+        if len(entry["delta"]) != delta_length:
+            fatal_error("Patch file is truncated.")
+        offset += delta_length
+        entries.append(entry)
+    return entries
@@ -0,0 +1,236 @@
+# This file contains logic for reading and writing GameCube disc images
+# (.iso/.gcm files) directly, so the game's filesystem doesn't need to be
+# extracted first. The image is mapped into memory, and its files are found
+# through the disc header and the FST (file system table), using the same
+# filepaths as an extracted filesystem, such as "sys/main.dol" and
+# "files/B/U/C".
+#
+# Files are written back in place when they fit in their slot, meaning they
+# don't run into the next file on the disc. Otherwise, they're moved into
+# free disc space, and the FST or disc header is updated to point to them.
+
+import mmap
+import os
+import struct
+
+import patch
+from util import fatal_error
+
+# The disc header has this magic word at offset 0x1C on every GameCube disc.
+DISC_MAGIC = 0xC2339F3D
+DISC_MAGIC_OFFSET = 0x1C
+
+# Size of a GameCube disc. Files can't be moved past the end of it.
+DISC_SIZE = 0x57058000
+
+# Files that are moved are aligned to this many bytes.
+DISC_ALIGNMENT = 0x8000
+
+# Disc header fields.
+HEADER_DOL_OFFSET = 0x420
+HEADER_FST_OFFSET = 0x424
+HEADER_FST_SIZE = 0x428
+
+# The system files at the start of the disc, as (offset, size). The
+# apploader's size is read from its own header.
+BOOT_AREA = (0x0, 0x440)
+BI2_AREA = (0x440, 0x2000)
+APPLOADER_OFFSET = 0x2440
+APPLOADER_HEADER_SIZE = 0x20
+
+# A .dol file's header lists the file offsets of its 7 text sections and 11
+# data sections, followed by their sizes.
+DOL_NUM_SECTIONS = 18
+DOL_SECTION_SIZES_OFFSET = 0x90
+
+FST_ENTRY_SIZE = 0xC
+
+
+def is_image(filepath):
+    """
+    Gets whether or not the given filepath is a GameCube disc image.
+    """
+    if not os.path.isfile(filepath):
+        return False
+    with open(filepath, "rb") as f:
+        header = f.read(DISC_MAGIC_OFFSET + 4)
+    return len(header) == DISC_MAGIC_OFFSET + 4 and struct.unpack_from(">I", header, DISC_MAGIC_OFFSET)[0] == DISC_MAGIC
+
+
+def open_image(filepath):
+    """
+    Opens a disc image and reads its file table. Returns a disc object.
+    """
+    if not is_image(filepath):
+        fatal_error("'%s' isn't a GameCube disc image." % filepath)
+
+    disc = {
+        "filepath": filepath,
+        "data": None,
+        "files": {},
+    }
+    map_image(disc)
+    data = disc["data"]
+
+    # files maps filepaths to entries of shape:
+    #    {
+    #        "offset": int,
+    #        "size": int,
+    #        "fst_index": int, or None for system files
+    #    }
+    apploader_size, apploader_trailer_size = struct.unpack_from(">II", data, APPLOADER_OFFSET + 0x14)
+    dol_offset, fst_offset, fst_size = struct.unpack_from(">III", data, HEADER_DOL_OFFSET)
+    system_files = {
+        "sys/boot.bin": BOOT_AREA,
+        "sys/bi2.bin": BI2_AREA,
+        "sys/apploader.img": (APPLOADER_OFFSET, APPLOADER_HEADER_SIZE + apploader_size + apploader_trailer_size),
+        "sys/main.dol": (dol_offset, get_dol_size(data, dol_offset)),
+        "sys/fst.bin": (fst_offset, fst_size),
+    }
+    for name, (offset, size) in system_files.items():
+        disc["files"][name] = {"offset": offset, "size": size, "fst_index": None}
+    read_fst(disc, fst_offset)
+    return disc
+
+
+def map_image(disc):
+    """
+    Maps the disc image into memory, replacing the old mapping if there is
+    one. Only the parts of the image that are read are loaded.
+    """
+    if disc["data"] is not None:
+        disc["data"].close()
+    with open(disc["filepath"], "rb") as f:
+        disc["data"] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def close(disc):
+    """
+    Closes the disc image.
+    """
+    if disc["data"] is not None:
+        disc["data"].close()
+        disc["data"] = None
+
+
+def get_dol_size(data, dol_offset):
+    """
+    Gets the size of the .dol file at the given offset. The disc doesn't
+    record it, so it's the end of the .dol's last section.
+    """
+    size = DOL_SECTION_SIZES_OFFSET + DOL_NUM_SECTIONS * 4
+    for i in range(DOL_NUM_SECTIONS):
+        section_offset = struct.unpack_from(">I", data, dol_offset + i * 4)[0]
+        section_size = struct.unpack_from(">I", data, dol_offset + DOL_SECTION_SIZES_OFFSET + i * 4)[0]
+        if section_size > 0:
+            size = max(size, section_offset + section_size)
+    return size
+
+
+def read_fst(disc, fst_offset):
+    """
+    Reads every file entry from the FST into the disc object.
+    The FST is a flat list of 12-byte entries, followed by a table of
+    null-terminated names. The first entry is the root directory, and its
+    last field is the total number of entries. Other entries are either:
+        file: flags 0, name offset, file offset, file size
+        directory: flags 1, name offset, parent index, index after its last entry
+    """
+    data = disc["data"]
+    num_entries = struct.unpack_from(">I", data, fst_offset + 0x8)[0]
+    names_offset = fst_offset + num_entries * FST_ENTRY_SIZE
+
+    # Stack of (directory path, index after the directory's last entry).
+    dirs = [("files/", num_entries)]
+    for i in range(1, num_entries):
+        while i >= dirs[-1][1]:
+            dirs.pop()
+        entry_offset = fst_offset + i * FST_ENTRY_SIZE
+        flags_and_name, value_1, value_2 = struct.unpack_from(">III", data, entry_offset)
+        name_offset = names_offset + (flags_and_name & 0xFFFFFF)
+        name = data[name_offset:data.find(b"\0", name_offset)].decode("shift_jis")
+        filepath = dirs[-1][0] + name
+        if flags_and_name >> 24 == 1:
+            dirs.append((filepath + "/", value_2))
+        else:
+            disc["files"][filepath] = {"offset": value_1, "size": value_2, "fst_index": i}
+
+
+def has_file(disc, filepath):
+    """
+    Gets whether or not the disc has a file at the given filepath.
+    """
+    return filepath in disc["files"]
+
+
+def read_file(disc, filepath):
+    """
+    Reads a file from the disc. Only the file's own part of the image is read.
+    """
+    if filepath not in disc["files"]:
+        fatal_error("File '%s' doesn't exist in disc image '%s'." % (filepath, disc["filepath"]))
+    entry = disc["files"][filepath]
+    return disc["data"][entry["offset"]:entry["offset"] + entry["size"]]
+
+
+def find_free_offset(regions, size):
+    """
+    Finds the first aligned offset where `size` bytes fit between the given
+    used regions of the disc, which are (start, end) tuples.
+    """
+    offset = 0
+    for start, end in sorted(regions):
+        if start == end:
+            continue
+        if offset + size <= start:
+            return offset
+        offset = max(offset, (end + DISC_ALIGNMENT - 1) // DISC_ALIGNMENT * DISC_ALIGNMENT)
+    if offset + size > DISC_SIZE:
+        fatal_error("Not enough free disc space for %s bytes." % size)
+    return offset
+
+
+def write_files(disc, new_files):
+    """
+    Writes files to the disc image, given as a dict of filepaths to their new
+    contents. A file is written in place if it fits before the next file on
+    the disc. Otherwise, it's moved to free disc space. Only the bytes that
+    change are written. Returns the list of filepaths that were moved.
+    """
+    fst_offset = disc["files"]["sys/fst.bin"]["offset"]
+    regions = {filepath: (entry["offset"], entry["offset"] + entry["size"]) for filepath, entry in disc["files"].items()}
+    disc_patch = patch.init()
+    moved = []
+    for filepath in sorted(new_files):
+        data = new_files[filepath]
+        if filepath not in disc["files"]:
+            fatal_error("File '%s' doesn't exist in disc image '%s'." % (filepath, disc["filepath"]))
+        entry = disc["files"][filepath]
+        if entry["fst_index"] is None and filepath != "sys/main.dol":
+            fatal_error("Can't write system file '%s' to a disc image." % filepath)
+
+        del regions[filepath]
+        offset = entry["offset"]
+        end = offset + len(data)
+        if any(start < end and offset < region_end for start, region_end in regions.values()):
+            offset = find_free_offset(regions.values(), len(data))
+            moved.append(filepath)
+        regions[filepath] = (offset, offset + len(data))
+        patch.write(disc_patch, offset, data)
+
+        # Point the disc header or FST entry to the file's new location.
+        if entry["fst_index"] is None:
+            patch.pack_into(">I", disc_patch, HEADER_DOL_OFFSET, offset)
+        else:
+            patch.pack_into(">II", disc_patch, fst_offset + entry["fst_index"] * FST_ENTRY_SIZE + 0x4, offset, len(data))
+        entry["offset"] = offset
+        entry["size"] = len(data)
+
+    # Grow the image if a file was moved past its end.
+    image_size = max(len(disc["data"]), max(end for _, end in regions.values()))
+    if image_size > len(disc["data"]):
+        disc_patch["size"] = image_size
+    close(disc)
+    patch.apply_to_file(disc_patch, disc["filepath"])
+    map_image(disc)
+    return moved
@@ -1,55 +1,232 @@
 # This file contains logic for managing known free space in the game's
 # memory layout.
+#
+# Data is allocated in two steps. alloc() and alloc_string() only record what
+# needs to be stored, and where its pointer is. Once everything is allocated,
+# get_layout() places it all at once, which lets it save space:
+#   - Identical data is only stored once. Injected data is read-only, so the
+#     pointers can share it.
+#   - A C string that is the end of a longer one points into the longer one,
+#     since it ends with the same null terminator. For example, "Rings" can
+#     point to the end of "Ring Attack: Rings".
+#   - Each piece of data goes into the free gap that it fits best, across
+#     every sector, so the padding left by aligned data is filled in by later,
+#     smaller data.
+# Data is placed in the order it was first allocated, so the layout only
+# changes where the allocations do.
 
 from util import fatal_error
 
-# We'll just handle one chunk of free space for now.
+# Each sector is a chunk of free memory that's added to the .dol file as one
+# of its data sections (dol_section is the section's index in the .dol
+# header, counting the 7 text sections first).
 sector_0 = {
     "address": 0x80530000,
     "size": 0x20000,
+    "dol_section": 8,
 }
 
+SECTORS = [sector_0]
+
 POINTER_TYPE_NORMAL = "normal"
 POINTER_TYPE_TEXT_TABLE = "text_table"
 
-def init():
+def init(sectors=None):
     """
-    Gets an initial free space object.
+    Gets an initial free space object for the given sectors, which default
+    to every known sector.
     """
-    # sector contains info about the destination for in-game memory.
+    # sectors is an array of the sectors that data can be placed in.
     # allocs is an array of allocated data of shape:
     #    {
-    #        "offset": int,
     #        "pointer": int,
     #        "pointer_type": string,
     #        "data": byte[],
+    #        "alignment": int,
+    #        "is_string": bool,
     #    }
     return {
-        "sector": sector_0,
+        "sectors": SECTORS if sectors is None else sectors,
         "allocs": [],
     }
 
 
-def alloc(space, data, pointer, pointer_type=POINTER_TYPE_NORMAL):
+def alloc(space, data, pointer, pointer_type=POINTER_TYPE_NORMAL, alignment=1):
+    """
+    Allocates the given data array to known free space. Its address must be
+    a multiple of alignment. The data isn't placed until get_layout() is
+    called, and data that's identical to another allocation shares its
+    space.
+    """
+    return add_alloc(space, data, pointer, pointer_type, alignment, False)
+
+
+def alloc_string(space, data, pointer, pointer_type=POINTER_TYPE_NORMAL):
     """
-    Allocates the given data array to known free space. We don't free
-    data from this space, so data can be alloc'd contiguously.
+    Allocates the given null-terminated C string to known free space. Like
+    alloc(), but the string can also share the end of a longer string.
     """
-    if len(space["allocs"]) == 0:
-        offset = 0
-    else:
-        last_alloc = space["allocs"][-1]
-        offset = last_alloc["offset"] + len(last_alloc["data"])
+    if len(data) == 0 or data[-1] != 0:
+        fatal_error("Can't allocate string %r, since it isn't null-terminated." % bytes(data))
+    return add_alloc(space, data, pointer, pointer_type, 1, True)
 
-    if offset + len(data) > space["sector"]["size"]:
-        fatal_error("Failed to allocate %s bytes of data to free space." % len(data))
 
+def add_alloc(space, data, pointer, pointer_type, alignment, is_string):
+    """
+    Records an allocation in the free space object.
+    """
+    if alignment < 1:
+        fatal_error("Invalid free-space alignment %s." % alignment)
     space["allocs"].append({
-        "address": space["sector"]["address"] + offset,
-        "offset": offset,
         "pointer": pointer,
         "pointer_type": pointer_type,
-        "data": data,
+        "data": bytes(data),
+        "alignment": alignment,
+        "is_string": is_string,
     })
-
     return space
+
+
+def get_layout(space):
+    """
+    Places every allocation in the free space. Returns a layout object
+    of shape:
+        {
+            "allocs": array of {"pointer", "pointer_type", "address"}, in
+                      the order they were allocated,
+            "sectors": array of {"sector", "data", "num_blocks"}, in the
+                       order of the free space's sectors, where data is the
+                       sector's contents up to its last used byte,
+            "requested_size": total size of every allocation,
+        }
+    If the data doesn't fit, then the program is terminated.
+    """
+    # Group identical data. Strings and other data are kept apart, since
+    # only strings can be merged into other strings.
+    blocks = {}
+    for alloc in space["allocs"]:
+        key = (alloc["data"], alloc["is_string"])
+        if key in blocks:
+            blocks[key]["alignment"] = max(blocks[key]["alignment"], alloc["alignment"])
+        else:
+            blocks[key] = {
+                "data": alloc["data"],
+                "alignment": alloc["alignment"],
+                "is_string": alloc["is_string"],
+                "parent": None,
+                "parent_offset": 0,
+            }
+
+    # Merge each string into the longest string that ends with it. Longer
+    # strings are handled first, so every string that can hold others is
+    # already known.
+    suffixes = {}
+    strings = [block for block in blocks.values() if block["is_string"]]
+    for block in sorted(strings, key=lambda block: (-len(block["data"]), block["data"])):
+        data = block["data"]
+        if data in suffixes:
+            block["parent"], block["parent_offset"] = suffixes[data]
+            continue
+        for i in range(len(data)):
+            suffixes.setdefault(data[i:], (block, i))
+
+    # Place the blocks that hold their own data, in the order they were
+    # first allocated.
+    gaps = [(sector_index, 0, sector["size"]) for sector_index, sector in enumerate(space["sectors"])]
+    used_ends = [0] * len(space["sectors"])
+    num_blocks = [0] * len(space["sectors"])
+    for block in blocks.values():
+        if block["parent"] is not None:
+            continue
+        gap_index, offset = find_best_gap(space, gaps, len(block["data"]), block["alignment"])
+        if gap_index is None:
+            fatal_error("Failed to allocate %s bytes of data to free space. %s" % (len(block["data"]), get_usage_summary(space, used_ends)))
+
+        sector_index, start, end = gaps.pop(gap_index)
+        data_end = offset + len(block["data"])
+        if data_end < end:
+            gaps.insert(gap_index, (sector_index, data_end, end))
+        if start < offset:
+            gaps.insert(gap_index, (sector_index, start, offset))
+        block["sector_index"] = sector_index
+        block["offset"] = offset
+        used_ends[sector_index] = max(used_ends[sector_index], data_end)
+        num_blocks[sector_index] += 1
+
+    sectors = []
+    for sector_index, sector in enumerate(space["sectors"]):
+        sectors.append({
+            "sector": sector,
+            "data": bytearray(used_ends[sector_index]),
+            "num_blocks": num_blocks[sector_index],
+        })
+    for block in blocks.values():
+        if block["parent"] is None:
+            data = sectors[block["sector_index"]]["data"]
+            data[block["offset"]:block["offset"] + len(block["data"])] = block["data"]
+
+    allocs = []
+    for alloc in space["allocs"]:
+        block = blocks[(alloc["data"], alloc["is_string"])]
+        offset = block["parent_offset"]
+        if block["parent"] is not None:
+            block = block["parent"]
+        offset += block["offset"]
+        allocs.append({
+            "pointer": alloc["pointer"],
+            "pointer_type": alloc["pointer_type"],
+            "address": space["sectors"][block["sector_index"]]["address"] + offset,
+        })
+
+    return {
+        "allocs": allocs,
+        "sectors": sectors,
+        "requested_size": sum(len(alloc["data"]) for alloc in space["allocs"]),
+    }
+
+
+def find_best_gap(space, gaps, size, alignment):
+    """
+    Finds the free gap that fits `size` bytes at the given alignment with
+    the fewest bytes to spare. Ties go to the earliest gap. Returns a tuple
+    of the gap's index and the offset to place the data at, or (None, None)
+    if no gap fits.
+    """
+    best_index = None
+    best_offset = None
+    best_spare = None
+    for i, (sector_index, start, end) in enumerate(gaps):
+        address = space["sectors"][sector_index]["address"]
+        offset = -(-(address + start) // alignment) * alignment - address
+        spare = end - offset - size
+        if spare >= 0 and (best_spare is None or spare < best_spare):
+            best_index = i
+            best_offset = offset
+            best_spare = spare
+    return best_index, best_offset
+
+
+def get_usage_summary(space, used_ends):
+    """
+    Gets a one-line summary of how much of each sector is used.
+    """
+    return ", ".join("0x%X: 0x%X of 0x%X bytes used" % (sector["address"], used_end, sector["size"])
+                     for sector, used_end in zip(space["sectors"], used_ends))
+
+
+def get_report(layout):
+    """
+    Gets the lines of a report on how much free space a layout uses, and how
+    much sharing data saved.
+    """
+    lines = []
+    used_size = 0
+    for sector_layout in layout["sectors"]:
+        sector = sector_layout["sector"]
+        used_size += len(sector_layout["data"])
+        lines.append("Free space 0x%X: 0x%X of 0x%X bytes used (%.1f%%), %s block(s)" % (
+            sector["address"], len(sector_layout["data"]), sector["size"],
+            100 * len(sector_layout["data"]) / sector["size"], sector_layout["num_blocks"]))
+    lines.append("Free space: %s allocation(s) of 0x%X bytes stored in 0x%X bytes (0x%X bytes saved by sharing)" % (
+        len(layout["allocs"]), layout["requested_size"], used_size, max(0, layout["requested_size"] - used_size)))
+    return lines
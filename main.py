@@ -1,382 +1,1532 @@
 import argparse
 import csv
 import json
+import mmap
 import os
 import shutil
-import struct
 import sys
+import time
 
 import compression
+import compression_cache
+import delta
+import disc
 import tt_config
 import files
 import freespace
+import manifest
+import patch
+import records
+import rings
+import text_table
+import util
 from util import *
 
 
+# Checkpoint indexes for the original compressed overlays are saved next to
+# the decompressed overlays in the working directory, with this extension.
+CHECKPOINT_INDEX_EXTENSION = ".idx"
+
+# Data sections added to the .dol file for free space start at a multiple of
+# this many bytes.
+DOL_SECTION_ALIGNMENT = 0x20
+
+# 'batch-build' saves the command streams of the game's original overlays in
+# the compression cache under their filepaths with this prefix.
+BATCH_BASELINE_STREAM_PREFIX = "baseline/"
+
+# 'watch' checks the working directory for changes this often, in seconds.
+WATCH_INTERVAL = 0.5
+# 'watch' waits until the working directory hasn't changed for this long
+# before rebuilding, since editors often save a file in several steps.
+WATCH_DEBOUNCE_TIME = 0.2
+
+# Game filesystem objects opened by 'setup' in this process, keyed by the
+# input path.
+setup_games = {}
+
+# Text tables of the working .dol file opened by 'setup' in this process,
+# keyed by the .dol file's path.
+setup_text_tables = {}
+
+# Baseline that 'batch-build' builds variants against in this process.
+batch_baseline = None
+
+# Contents of the working directory files read by this process, keyed by
+# filepath, along with the size and modification time they had.
+work_files = {}
+
+
+def read_work_file(work_filepath):
+    """
+    Reads a file from the working directory. The contents are kept in memory,
+    so they're only read again once the file changes.
+    """
+    stat = os.stat(work_filepath)
+    cached = work_files.get(work_filepath)
+    if cached is not None and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+    with open(work_filepath, mode="rb") as f:
+        data = f.read()
+    work_files[work_filepath] = ((stat.st_size, stat.st_mtime_ns), data)
+    return data
+
+
+def init_stage(stage_dir=None, build_manifest=None, force=False, quiet=False):
+    """
+    Gets an initial stage object, which collects the files produced by
+    'stage'. If stage_dir is given, the files are written to it, and files
+    that the build manifest says are up to date are skipped, unless force is
+    True. Otherwise, every file is kept in memory, keyed by its original
+    filepath, so 'build' can pass them straight to 'apply'. Staging into the
+    same in-memory stage object again only redoes the files whose inputs
+    changed. If quiet is True, staged files aren't logged.
+    """
+    return {
+        "dir": stage_dir,
+        "manifest": build_manifest,
+        "force": force,
+        "quiet": quiet,
+        "files": {},
+        "records": {},
+    }
+
+
+def is_staged_file_unchanged(stage, original_filepath, record):
+    """
+    Gets whether or not a staged file is already up to date in the
+    staging directory or the in-memory stage, so it doesn't need to be
+    produced again.
+    """
+    if stage["force"]:
+        return False
+    if stage["dir"] is None:
+        previous_record = stage["records"].get(original_filepath)
+        if previous_record is None or (previous_record["inputs"], previous_record["config"]) != (record["inputs"], record["config"]):
+            return False
+        if not stage["quiet"]:
+            print_info("Skipped unchanged '%s' (in memory)" % original_filepath)
+        return True
+    stage_filepath = os.path.join(stage["dir"], original_filepath)
+    if len(manifest.get_changes(stage["manifest"], manifest.SECTION_STAGE, original_filepath, record, stage_filepath)) > 0:
+        return False
+    print_info("Skipped unchanged '%s'" % stage_filepath)
+    return True
+
+
+def write_staged_file(stage, original_filepath, data, record, work_filepath):
+    """
+    Adds a file produced by 'stage', built from the given working directory
+    file, to the stage object.
+    """
+    if stage["dir"] is None:
+        stage["files"][original_filepath] = data
+        stage["records"][original_filepath] = record
+        if not stage["quiet"]:
+            print_info("Staged '%s' in memory" % work_filepath)
+        return
+
+    stage_filepath = os.path.join(stage["dir"], original_filepath)
+    os.makedirs(os.path.dirname(stage_filepath), exist_ok=True)
+    with open(stage_filepath, "wb") as f:
+        f.write(data)
+    manifest.update(stage["manifest"], manifest.SECTION_STAGE, original_filepath, record, stage_filepath)
+    print_info("Staged '%s' as '%s'" % (work_filepath, stage_filepath))
+
+
+def stage_patched_file(stage, original_filepath, file_patch, record, work_dir, base_file):
+    """
+    Adds a file produced by patching the given working directory file to the
+    stage object. If the staged copy was built from the same file and every
+    byte its last patch changed is rewritten by this one, then it's patched in
+    place, so only the edited fields are read and written. Otherwise, the whole
+    file is patched in memory and staged.
+    """
+    work_filepath = os.path.join(work_dir, base_file)
+    record = dict(record, patch=patch.get_ranges(file_patch))
+    if stage["dir"] is not None and not stage["force"]:
+        stage_filepath = os.path.join(stage["dir"], original_filepath)
+        entry = manifest.get_patch_entry(stage["manifest"], manifest.SECTION_STAGE, original_filepath, record, base_file, stage_filepath)
+        if entry is not None:
+            new_size = entry["output_size"] if file_patch["size"] is None else file_patch["size"]
+            if patch.covers(file_patch, entry["patch"], entry["output_size"], new_size):
+                num_changed = patch.apply_to_file(file_patch, stage_filepath)
+                manifest.update(stage["manifest"], manifest.SECTION_STAGE, original_filepath, record, stage_filepath, hash_output=False)
+                print_info("Patched %s byte(s) of '%s' in place" % (num_changed, stage_filepath))
+                return
+
+    data = bytearray(read_work_file(work_filepath))
+    patch.apply(file_patch, data)
+    write_staged_file(stage, original_filepath, data, record, work_filepath)
+
+
+def open_game(input_path):
+    """
+    Gets a game filesystem object for the -i/--input-dir path, which is
+    either the game's extracted filesystem or a disc image.
+    """
+    if os.path.isdir(input_path):
+        return {"dir": input_path, "disc": None}
+    if disc.is_image(input_path):
+        return {"dir": None, "disc": disc.open_image(input_path)}
+    fatal_error("'%s' is neither a directory nor a GameCube disc image." % input_path)
+
+
+def close_game(game):
+    """
+    Closes the game filesystem's disc image, if it has one.
+    """
+    if game["disc"] is not None:
+        disc.close(game["disc"])
+
+
+def get_game_filepath(game, original_filepath):
+    """
+    Gets the path of a file in the game's filesystem, for messages and the
+    build manifest. Files in a disc image are shown as "<image>:<filepath>".
+    """
+    if game["disc"] is None:
+        return os.path.join(game["dir"], original_filepath)
+    return "%s:%s" % (game["disc"]["filepath"], original_filepath)
+
+
+def has_game_file(game, original_filepath):
+    """
+    Gets whether or not a file exists in the game's filesystem.
+    """
+    if game["disc"] is not None:
+        return disc.has_file(game["disc"], original_filepath)
+    return os.path.isfile(os.path.join(game["dir"], original_filepath))
+
+
+def read_game_file(game, original_filepath):
+    """
+    Gets the contents of a file in the game's filesystem. Extracted files
+    are mapped into memory rather than read, so only the parts that are used
+    are loaded.
+    """
+    if game["disc"] is not None:
+        return disc.read_file(game["disc"], original_filepath)
+    with open(os.path.join(game["dir"], original_filepath), "rb") as f:
+        # Empty files can't be mapped.
+        if os.fstat(f.fileno()).st_size == 0:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def get_game_file_changes(build_manifest, game, original_filepath, record):
+    """
+    Gets a list of reasons why a file in the game's filesystem is out of
+    date, compared to the given apply record.
+    """
+    output_filepath = get_game_filepath(game, original_filepath)
+    if game["disc"] is None:
+        return manifest.get_changes(build_manifest, manifest.SECTION_APPLY, original_filepath, record, output_filepath)
+
+    def read_output():
+        if not disc.has_file(game["disc"], original_filepath):
+            return None
+        return disc.read_file(game["disc"], original_filepath)
+
+    return manifest.get_changes(build_manifest, manifest.SECTION_APPLY, original_filepath, record, output_filepath, read_output)
+
+
+def get_setup_game(input_dir):
+    """
+    Gets the game filesystem object for 'setup' to read from. Each process
+    opens the game once, and keeps it open until it exits.
+    """
+    if input_dir not in setup_games:
+        setup_games[input_dir] = open_game(input_dir)
+    return setup_games[input_dir]
+
+
+def get_setup_text_table(work_dir):
+    """
+    Gets the text table of the working .dol file for 'setup' to read from.
+    Each process maps the .dol file and indexes its text table once.
+    """
+    dol_filepath = os.path.join(work_dir, tt_config.dol_file)
+    if dol_filepath not in setup_text_tables:
+        with open(dol_filepath, mode="rb") as f:
+            dol = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        setup_text_tables[dol_filepath] = text_table.open_table(dol)
+    return setup_text_tables[dol_filepath]
+
+
 def setup_dol(input_dir, work_dir):
     """
     Extracts the main .dol file into the working directory.
+    Returns the list of files that were written.
     """
+    game = get_setup_game(input_dir)
     original_filepath = files.get_original_filepath(tt_config.dol_file)
-    input_filepath = os.path.join(input_dir, original_filepath)
     work_filepath = os.path.join(work_dir, tt_config.dol_file)
     os.makedirs(os.path.dirname(work_filepath), exist_ok=True)
-    shutil.copy(input_filepath, work_filepath)
-    print_info("Setup '%s'" % work_filepath)
+    with open(work_filepath, "wb") as f:
+        f.write(read_game_file(game, original_filepath))
+    return [work_filepath]
+
+
+def get_dol_record(work_dir, free_space):
+    """
+    Gets the build manifest record for the staged .dol file. It depends on
+    everything that was allocated in free space.
+    """
+    return manifest.get_record(work_dir, [tt_config.dol_file], free_space)
 
 
-def stage_dol(work_dir, stage_dir, free_space):
+def stage_dol(work_dir, stage, free_space):
     """
     Injects modifications into the game's free space by adding
-    custom Data section(s) into the .dol file.
+    custom Data section(s) into the .dol file. It's skipped if nothing
+    it depends on changed since it was last staged.
     """
     # We won't get too clever for now, so we'll make some assumptions
     # about the .dol--namely, that it's a vanilla .dol from MGTT.
-
-    # Read the existing .dol file contents.
     work_filepath = os.path.join(work_dir, tt_config.dol_file)
-    with open(work_filepath, mode="rb") as f:
-        dol = bytearray(f.read())
+    original_filepath = files.get_original_filepath(tt_config.dol_file)
+    record = get_dol_record(work_dir, free_space)
+    if is_staged_file_unchanged(stage, original_filepath, record):
+        return
 
-    # Append the injected data to the end of the .dol file.
-    # Calculate the total size of the injected data along the way.
-    data_size = 0
-    for alloc in free_space["allocs"]:
-        data_size += len(alloc["data"])
-        dol.extend(alloc["data"])
+    # Place everything in free space, and append each used sector to the end
+    # of the .dol file as a new data section.
+    layout = freespace.get_layout(free_space)
+    file_size = os.path.getsize(work_filepath)
+    sections = []
+    for sector_layout in layout["sectors"]:
+        if len(sector_layout["data"]) == 0:
+            continue
+        section_offset = (file_size + DOL_SECTION_ALIGNMENT - 1) // DOL_SECTION_ALIGNMENT * DOL_SECTION_ALIGNMENT
+        sections.append((sector_layout, section_offset))
+        file_size = section_offset + len(sector_layout["data"])
+    dol_patch = patch.init(file_size)
+    for sector_layout, section_offset in sections:
+        data = sector_layout["data"]
+        patch.write(dol_patch, section_offset, data)
 
-    # Write the DOL header attributes for the new data section that
-    # we just appended to the file.
-    struct.pack_into(">I", dol, 0x20, 0x15E7C0) # address in .dol
-    struct.pack_into(">I", dol, 0x68, free_space["sector"]["address"]) # in-game memory address
-    struct.pack_into(">I", dol, 0xB0, data_size) # section size
+        # Write the DOL header attributes for the new data section that
+        # we just appended to the file.
+        section = sector_layout["sector"]["dol_section"]
+        patch.pack_into(">I", dol_patch, section * 4, section_offset) # address in .dol
+        patch.pack_into(">I", dol_patch, 0x48 + section * 4, sector_layout["sector"]["address"]) # in-game memory address
+        patch.pack_into(">I", dol_patch, 0x90 + section * 4, len(data)) # section size
 
     # Update the pointers in the .dol to the injected data so the game
     # knows to look for our injected data, rather than the original data.
-    for alloc in free_space["allocs"]:
+    for alloc in layout["allocs"]:
         pointer_type = alloc["pointer_type"]
         if pointer_type == freespace.POINTER_TYPE_TEXT_TABLE:
-            # 0x801431CC is the start of the in-memory string table. The string table
-            # first lists the offsets of all string ids from the start of
-            # this table. For example, if an entry is the value 0x100, then
-            # the contents of the string lives at 0x801431CC + 0x100.
-            text_offset = (alloc["address"]) - 0x801431CC
-            struct.pack_into(">i", dol, alloc["pointer"], text_offset)
+            # The pointer is the string's entry in the in-memory string table,
+            # which lists the offsets of all string ids from the start of
+            # the table (0x801431CC). For example, if an entry is the value
+            # 0x100, then the contents of the string lives at 0x801431CC + 0x100.
+            text_offset = (alloc["address"]) - tt_config.dol_text_table["address"]
+            patch.pack_into(">i", dol_patch, alloc["pointer"], text_offset)
         else:
             fatal_error("Unhandled free-space pointer type '%s'" % pointer_type)
 
-    # Write the .dol file to the staging directory.
-    original_filepath = files.get_original_filepath(tt_config.dol_file)
-    stage_filepath = os.path.join(stage_dir, original_filepath)
-    os.makedirs(os.path.dirname(stage_filepath), exist_ok=True)
-    with open(stage_filepath, "wb") as f:
-        f.write(dol)
-
-    print_info("Staged '%s' as '%s'" % (work_filepath, stage_filepath))
+    for line in freespace.get_report(layout):
+        print_info(line)
+    stage_patched_file(stage, original_filepath, dol_patch, record, work_dir, tt_config.dol_file)
 
 
-def setup_overlays(input_dir, work_dir):
+def setup_overlay(input_dir, work_dir, overlay, cache_dir=None):
     """
-    Extracts the code overlay files into the working directory.
-    Also extracts any relevant data that resides in the overlay files.
+    Extracts a code overlay file into the working directory. If cache_dir
+    isn't None, the decompressed overlay is reused from the compression
+    cache when possible, and saved there otherwise.
+    Returns the list of files that were written.
     """
-    for overlay in tt_config.overlay_files:
-        original_filepath = files.get_original_filepath(overlay)
-        input_filepath = os.path.join(input_dir, original_filepath)
-        work_filepath = os.path.join(work_dir, overlay)
-        os.makedirs(os.path.dirname(work_filepath), exist_ok=True)
-        with open(input_filepath, "rb") as f:
-            decompressed_overlay = compression.decompress(bytearray(f.read()))
-        with open(work_filepath, "wb") as f:
-            f.write(decompressed_overlay)
-
-        print_info("Setup '%s'" % work_filepath)
-
-    # Extract the character stats into JSON files.
-    overlay_work_filepath = os.path.join(work_dir, tt_config.character_stats["golf_overlay_file"]["overlay_file"])
-    with open(overlay_work_filepath, "rb") as f:
-        data = f.read()
+    game = get_setup_game(input_dir)
+    original_filepath = files.get_original_filepath(overlay)
+    work_filepath = os.path.join(work_dir, overlay)
+    index_filepath = work_filepath + CHECKPOINT_INDEX_EXTENSION
+    os.makedirs(os.path.dirname(work_filepath), exist_ok=True)
+    data = read_game_file(game, original_filepath)
+    cached = None if cache_dir is None else compression_cache.load_decompressed(cache_dir, data)
+    if cached is not None:
+        for filepath, file_data in zip((work_filepath, index_filepath), cached):
+            with open(filepath, "wb") as f:
+                f.write(file_data)
+        return [work_filepath, index_filepath]
+
+    # Stream the decompressed overlay into the working directory, and
+    # save a checkpoint index for the original compressed file, so parts
+    # of it can be read later without decompressing the whole thing.
+    checkpoints = []
+    chunks = []
+    with open(work_filepath, "wb") as out:
+        for chunk in compression.iter_decompress(data, checkpoints=checkpoints):
+            out.write(chunk)
+            if cache_dir is not None:
+                chunks.append(chunk)
+    compression.save_checkpoint_index(index_filepath, data, checkpoints)
+    if cache_dir is not None:
+        with open(index_filepath, "rb") as f:
+            compression_cache.store_decompressed(cache_dir, data, b"".join(chunks), f.read())
+    return [work_filepath, index_filepath]
 
+
+def setup_character_stats(input_dir, work_dir):
+    """
+    Extracts the character stats from the golf overlay file into a JSON
+    file. The overlay's checkpoint index must have been saved already.
+    Returns the list of files that were written.
+    """
+    # Only the stats table is decompressed, starting from the nearest
+    # checkpoint.
+    game = get_setup_game(input_dir)
+    overlay_file = tt_config.character_stats["golf_overlay_file"]["overlay_file"]
+    index_filepath = os.path.join(work_dir, overlay_file) + CHECKPOINT_INDEX_EXTENSION
     base_offset = tt_config.character_stats["golf_overlay_file"]["offset"]
     id_order = tt_config.character_stats["character_id_stats_order"]
+    compressed_data = read_game_file(game, files.get_original_filepath(overlay_file))
+    checkpoints = compression.load_checkpoint_index(index_filepath, compressed_data)
+    schema = tt_config.character_stats["golf_overlay_file"]["record"]
+    data = compression.read_at(compressed_data, base_offset, len(id_order) * schema["size"], checkpoints)
+
     character_stats = []
-    for i in range(len(id_order)):
-        character_id = id_order[i]
-        offset = base_offset + i * 0x1C
-        stats = {}
-        stats["_label"] = tt_config.character_stats["character_labels"][character_id]
-        stats["drive_distance"] = struct.unpack_from(">I", data, offset)[0]
-        stats["shot_loft"] = struct.unpack_from(">i", data, offset + 0x4)[0]
-        if struct.unpack_from(">I", data, offset + 0x8)[0] == 0:
-            stats["shot_curve_direction"] = "draw"
-        else:
-            stats["shot_curve_direction"] = "fade"
-        stats["shot_curve_amount"] = struct.unpack_from(">I", data, offset + 0xC)[0]
-        stats["impact"] = struct.unpack_from(">i", data, offset + 0x10)[0]
-        stats["control"] = struct.unpack_from(">i", data, offset + 0x14)[0]
-        stats["spin"] = struct.unpack_from(">i", data, offset + 0x18)[0]
+    for character_id, record in zip(id_order, records.unpack_table(schema, data, 0, len(id_order))):
+        stats = {"_label": tt_config.character_stats["character_labels"][character_id]}
+        stats.update(record)
         character_stats.append(stats)
 
     work_stats_filepath = os.path.join(work_dir, tt_config.character_stats["work_file"])
     os.makedirs(os.path.dirname(work_stats_filepath), exist_ok=True)
     with open(work_stats_filepath, "w") as f:
         json.dump(character_stats, f, indent=2)
+    return [work_stats_filepath]
 
-    print_info("Setup '%s'" % work_stats_filepath)
+
+def get_overlays_record(work_dir):
+    """
+    Gets the build manifest record for the staged overlay files. Both
+    overlays are built from the same inputs.
+    """
+    input_filepaths = tt_config.overlay_files + [tt_config.character_stats["work_file"]]
+    return manifest.get_record(work_dir, input_filepaths, [tt_config.overlay_files, tt_config.character_stats])
 
 
-def stage_overlays(work_dir, stage_dir):
+def stage_overlays(work_dir, stage):
     """
-    Injects modifications into the game's overlay files.
+    Injects modifications into the game's overlay files. They're skipped
+    if nothing they depend on changed since they were last staged.
     """
-    # We will write the character stats data into the two overlay files that
-    # contain the data.
+    record = get_overlays_record(work_dir)
     golf_overlay_file = tt_config.character_stats["golf_overlay_file"]["overlay_file"]
-    golf_work_filepath = os.path.join(work_dir, golf_overlay_file)
-    with open(golf_work_filepath, mode="rb") as f:
-        golf_overlay = bytearray(f.read())
-
     menu_overlay_file = tt_config.character_stats["character_select"]["overlay_file"]
-    menu_work_filepath = os.path.join(work_dir, menu_overlay_file)
-    with open(menu_work_filepath, mode="rb") as f:
-        menu_overlay = bytearray(f.read())
+    unchanged = {overlay: is_staged_file_unchanged(stage, files.get_original_filepath(overlay), record) for overlay in (golf_overlay_file, menu_overlay_file)}
+    if all(unchanged.values()):
+        return
+
+    # We will write the character stats data into the two overlay files that
+    # contain the data. Only the stats fields are patched.
+    golf_patch = patch.init()
+    menu_patch = patch.init()
 
     work_stats_filepath = os.path.join(work_dir, tt_config.character_stats["work_file"])
     with open(work_stats_filepath) as f:
         character_stats = json.load(f)
 
+    # The menu's table also lists each entry's index and character id.
     id_order = tt_config.character_stats["character_id_stats_order"]
-    golf_base_offset = tt_config.character_stats["golf_overlay_file"]["offset"]
-    menu_base_offset = tt_config.character_stats["character_select"]["offset"]
-    for i, stats in enumerate(character_stats):
-        character_id = id_order[i]
-        # Write the golf overlay character stats data.
-        offset = golf_base_offset + i * 0x1C
-        struct.pack_into(">I", golf_overlay, offset, stats["drive_distance"])
-        struct.pack_into(">i", golf_overlay, offset + 0x4, stats["shot_loft"])
-        if stats["shot_curve_direction"] == "draw":
-            struct.pack_into(">I", golf_overlay, offset + 0x8, 0x0)
-        else:
-            struct.pack_into(">I", golf_overlay, offset + 0x8, 0x1)
-        struct.pack_into(">I", golf_overlay, offset + 0xC, stats["shot_curve_amount"])
-        struct.pack_into(">i", golf_overlay, offset + 0x10, stats["impact"])
-        struct.pack_into(">i", golf_overlay, offset + 0x14, stats["control"])
-        struct.pack_into(">i", golf_overlay, offset + 0x18, stats["spin"])
-
-        # Write the menu overlay character stats data.
-        offset = menu_base_offset + i * 0xA
-        struct.pack_into(">B", menu_overlay, offset, i)
-        struct.pack_into(">B", menu_overlay, offset + 0x1, character_id)
-        struct.pack_into(">H", menu_overlay, offset + 0x2, stats["drive_distance"])
-        struct.pack_into(">b", menu_overlay, offset + 0x4, stats["shot_loft"])
-        if stats["shot_curve_direction"] == "draw":
-            struct.pack_into(">B", menu_overlay, offset + 0x5, 0)
-        else:
-            struct.pack_into(">B", menu_overlay, offset + 0x5, 1)
-        struct.pack_into(">B", menu_overlay, offset + 0x6, stats["shot_curve_amount"])
-        struct.pack_into(">b", menu_overlay, offset + 0x7, stats["impact"])
-        struct.pack_into(">b", menu_overlay, offset + 0x8, stats["control"])
-        struct.pack_into(">b", menu_overlay, offset + 0x9, stats["spin"])
-
-    with open(golf_work_filepath, "wb") as f:
-        f.write(golf_overlay)
+    menu_stats = [dict(stats, index=i, character_id=id_order[i]) for i, stats in enumerate(character_stats)]
+    golf_config = tt_config.character_stats["golf_overlay_file"]
+    menu_config = tt_config.character_stats["character_select"]
+    patch.write(golf_patch, golf_config["offset"], records.pack_table(golf_config["record"], character_stats))
+    patch.write(menu_patch, menu_config["offset"], records.pack_table(menu_config["record"], menu_stats))
 
-    with open(menu_work_filepath, "wb") as f:
-        f.write(menu_overlay)
+    # The patched overlays go straight to the stage. The working overlays
+    # are left as they were extracted.
+    if not unchanged[menu_overlay_file]:
+        stage_patched_file(stage, files.get_original_filepath(menu_overlay_file), menu_patch, record, work_dir, menu_overlay_file)
+    if not unchanged[golf_overlay_file]:
+        stage_patched_file(stage, files.get_original_filepath(golf_overlay_file), golf_patch, record, work_dir, golf_overlay_file)
 
-    for overlay in tt_config.overlay_files:
-        work_filepath = os.path.join(work_dir, overlay)
-        original_filepath = files.get_original_filepath(overlay)
-        stage_filepath = os.path.join(stage_dir, original_filepath)
-        os.makedirs(os.path.dirname(stage_filepath), exist_ok=True)
-        shutil.copy(work_filepath, stage_filepath)
-        print_info("Staged '%s' as '%s'" % (work_filepath, stage_filepath))
 
-
-def setup_ring_attack(input_dir, work_dir):
+def setup_ring_attack_hole(input_dir, work_dir, hole):
     """
-    Extracts all the Ring Attack files into the working directory.
-    They are transformed into JSON files for easier editing.
+    Extracts a hole's Ring Attack file into the working directory. It's
+    transformed into a JSON file for easier editing, along with the hole's
+    title from the .dol file, which must have been extracted already.
+    Returns the list of files that were written.
     """
-    # Read the game .dol file contents.
-    dol_filepath = os.path.join(work_dir, tt_config.dol_file)
-    with open(dol_filepath, mode="rb") as f:
-        dol = f.read()
+    game = get_setup_game(input_dir)
+    # Read the rings definition file.
+    toadstool_filepath = hole["file"]
+    original_filepath = files.get_original_filepath(toadstool_filepath)
+    data = read_game_file(game, original_filepath)
+    ring_attack_data = {
+        "rings": records.unpack_table(tt_config.ring_attack_ring_record, data),
+    }
 
-    for hole in tt_config.ring_attack_holes:
-        ring_attack_data = {
-            "rings": [],
-        }
+    # Read the hole's title from the text table in the game .dol file.
+    table = get_setup_text_table(work_dir)
+    ring_attack_data["title"] = text_table.get_string(table, text_table.get_string_id(table, hole["dolTitlePointer"]))
+
+    # Write the parsed ring definition file as JSON.
+    work_filepath = os.path.join(work_dir, toadstool_filepath)
+    os.makedirs(os.path.dirname(work_filepath), exist_ok=True)
+    with open(work_filepath, "w") as f:
+        json.dump(ring_attack_data, f, indent=2)
+    return [work_filepath]
 
-        # Read the rings definition file.
-        toadstool_filepath = hole["file"]
-        original_filepath = files.get_original_filepath(toadstool_filepath)
-        filepath = os.path.join(input_dir, original_filepath)
-        with open(filepath, mode="rb") as f:
-            data = f.read()
 
-        # Parse the ring data from the file.
-        num_rings = struct.unpack_from(">I", data, 0)[0]
-        for i in range(num_rings):
-            offset = (i * 7 * 4) + 4
-            ring_attack_data["rings"].append({
-                "x": struct.unpack_from(">f", data, offset)[0],
-                "y": struct.unpack_from(">f", data, offset + 0x04)[0],
-                "z": struct.unpack_from(">f", data, offset + 0x08)[0],
-                "rotationX": struct.unpack_from(">f", data, offset + 0x0C)[0],
-                "rotationY": struct.unpack_from(">f", data, offset + 0x10)[0],
-                "scaleX": struct.unpack_from(">f", data, offset + 0x14)[0],
-                "scaleY": struct.unpack_from(">f", data, offset + 0x18)[0],
-            })
-
-        # Read the hole's title.
-        # 0x1401CC is the start of the string table. The string table
-        # first lists the offsets of all string ids from the start of
-        # this table. For example, if an entry is the value 0x100, then
-        # the contents of the string lives at 0x1401CC + 0x100.
-        offset = struct.unpack_from(">I", dol, hole["dolTitlePointer"])[0]
-        title_address = 0x1401CC + offset
-        ring_attack_data["title"] = read_c_ascii_string(dol, title_address)
-
-        # Write the parsed ring definition file as JSON.
-        work_filepath = os.path.join(work_dir, toadstool_filepath)
-        os.makedirs(os.path.dirname(work_filepath), exist_ok=True)
-        with open(work_filepath, "w") as f:
-            json.dump(ring_attack_data, f, indent=2)
-
-        print_info("Setup '%s'" % work_filepath)
-
-
-def stage_ring_attack(work_dir, stage_dir, free_space):
+def alloc_ring_attack_titles(work_dir, free_space):
     """
-    Converts the Ring Attack files into their original file formats
-    and saves them into the staging directory.
+    Writes every Ring Attack hole's title to free space.
     """
     for hole in tt_config.ring_attack_holes:
-        # Read the ring attack JSON file.
-        toadstool_filepath = hole["file"]
-        work_filepath = os.path.join(work_dir, toadstool_filepath)
+        work_filepath = os.path.join(work_dir, hole["file"])
         with open(work_filepath) as f:
             ring_attack_data = json.load(f)
 
-        # Convert to the original binary data format.
-        num_rings = len(ring_attack_data["rings"])
-        file_length = 4 + num_rings * 0x1C
-        data = bytearray(file_length)
-        struct.pack_into(">I", data, 0, num_rings)
-        for i, ring in enumerate(ring_attack_data["rings"]):
-            offset = 4 + i * 0x1C
-            struct.pack_into(">fffffff", data, offset,
-                ring["x"],
-                ring["y"],
-                ring["z"],
-                ring["rotationX"],
-                ring["rotationY"],
-                ring["scaleX"],
-                ring["scaleY"])
-
-        # Write the binary data file to the staging directory.
-        original_filepath = files.get_original_filepath(toadstool_filepath)
-        stage_filepath = os.path.join(stage_dir, original_filepath)
-        os.makedirs(os.path.dirname(stage_filepath), exist_ok=True)
-        with open(stage_filepath, "wb") as f:
-            f.write(data)
+        title_string = text_table.encode_string(ring_attack_data["title"])
+        freespace.alloc_string(free_space, title_string, hole["dolTitlePointer"], pointer_type=freespace.POINTER_TYPE_TEXT_TABLE)
+
+
+def get_ring_attack_title_ids(table):
+    """
+    Gets the set of string ids of the Ring Attack hole titles.
+    """
+    return {text_table.get_string_id(table, hole["dolTitlePointer"]) for hole in tt_config.ring_attack_holes}
+
+
+def setup_text_table(input_dir, work_dir):
+    """
+    Extracts every string of the .dol file's text table into a JSON file,
+    keyed by string id, except for the Ring Attack hole titles. The .dol
+    file must have been extracted already. Returns the list of files that
+    were written.
+    """
+    table = get_setup_text_table(work_dir)
+    strings = text_table.get_strings(table, get_ring_attack_title_ids(table))
+    work_filepath = os.path.join(work_dir, tt_config.dol_text_table["work_file"])
+    os.makedirs(os.path.dirname(work_filepath), exist_ok=True)
+    with open(work_filepath, "w") as f:
+        json.dump(strings, f, indent=2)
+    return [work_filepath]
+
+
+def alloc_text_strings(work_dir, free_space):
+    """
+    Writes the strings that were edited in the text table's JSON file to
+    free space. Working directories that were set up before the text table
+    was extracted don't have the file, so nothing is written.
+    """
+    work_filepath = os.path.join(work_dir, tt_config.dol_text_table["work_file"])
+    if not os.path.exists(work_filepath):
+        return
+    with open(work_filepath) as f:
+        strings = json.load(f)
+
+    # Compare each string to the original in the working .dol file.
+    dol_filepath = os.path.join(work_dir, tt_config.dol_file)
+    with open(dol_filepath, mode="rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dol:
+        table = text_table.open_table(dol)
+        title_ids = get_ring_attack_title_ids(table)
+        for key, value in strings.items():
+            string_id = int(key)
+            if not 0 <= string_id < text_table.get_num_strings(table):
+                fatal_error("Unknown string id %s in '%s'." % (key, work_filepath))
+            if string_id in title_ids:
+                fatal_error("String %s in '%s' is a Ring Attack hole title. Edit it in the hole's file instead." % (key, work_filepath))
+            if value != text_table.get_string(table, string_id):
+                freespace.alloc_string(free_space, text_table.encode_string(value), text_table.get_entry_file_offset(table, string_id),
+                                       pointer_type=freespace.POINTER_TYPE_TEXT_TABLE)
+
+
+def get_free_space(work_dir):
+    """
+    Allocates everything that 'stage' injects into the game's free space.
+    The .dol file depends on all of it, even when only some of the other
+    files are restaged.
+    """
+    free_space = freespace.init()
+    alloc_ring_attack_titles(work_dir, free_space)
+    alloc_text_strings(work_dir, free_space)
+    return free_space
 
-        # Write the data to free space.
-        title_string = to_c_ascii_string(ring_attack_data["title"])
-        freespace.alloc(free_space, title_string, hole["dolTitlePointer"], pointer_type=freespace.POINTER_TYPE_TEXT_TABLE)
 
-        print_info("Staged '%s' as '%s'" % (work_filepath, stage_filepath))
+def get_ring_attack_record(work_dir, hole):
+    """
+    Gets the build manifest record for a hole's staged Ring Attack file.
+    """
+    return manifest.get_record(work_dir, [hole["file"]], [hole, tt_config.ring_attack_ring_record])
 
 
-def command_setup(input_dir, work_dir):
+def get_ring_attack_file(work_dir, hole):
+    """
+    Converts a hole's Ring Attack file into its original file format.
+    Returns the file's contents.
+    """
+    # Read the ring attack JSON file.
+    work_filepath = os.path.join(work_dir, hole["file"])
+    with open(work_filepath) as f:
+        ring_attack_data = json.load(f)
+
+    # Convert to the original binary data format.
+    return records.pack_table(tt_config.ring_attack_ring_record, ring_attack_data["rings"])
+
+
+def stage_ring_attack(work_dir, stage, jobs=1):
+    """
+    Converts the Ring Attack files into their original file formats
+    and saves them into the stage. Files whose JSON didn't change since
+    they were last staged are skipped. The files are converted by `jobs`
+    worker processes, but saved in order.
+    """
+    changed_holes = []
+    for hole in tt_config.ring_attack_holes:
+        original_filepath = files.get_original_filepath(hole["file"])
+        record = get_ring_attack_record(work_dir, hole)
+        if not is_staged_file_unchanged(stage, original_filepath, record):
+            changed_holes.append((hole, original_filepath, record))
+
+    results = run_parallel(get_ring_attack_file, [(work_dir, hole) for hole, _, _ in changed_holes], jobs)
+    errors = ["%s ('%s')" % (error, hole["file"]) for (hole, _, _), (_, error) in zip(changed_holes, results) if error is not None]
+    if len(errors) > 0:
+        fatal_error("Failed to stage %s file(s).\n%s" % (len(errors), "\n".join(errors)))
+    for (hole, original_filepath, record), (data, _) in zip(changed_holes, results):
+        write_staged_file(stage, original_filepath, data, record, os.path.join(work_dir, hole["file"]))
+
+
+def command_setup(input_dir, work_dir, jobs=1, cache_dir=None, cache_size=compression_cache.DEFAULT_CACHE_SIZE, force=False):
     """
     Runs the ToadsTool 'setup' command.
     This setup a working directory and extract files from the game's
-    filesystem. In some cases, the files will be transformed into
-    a more friendly data format.
+    filesystem, which is either extracted into input_dir, or a disc image.
+    In some cases, the files will be transformed into a more friendly
+    data format. Files that don't depend on each other are extracted by
+    `jobs` worker processes.
+    Files whose game files and settings didn't change since they were last
+    set up are skipped. Working files that were edited since they were set
+    up are never overwritten, unless force is True, which also sets up
+    every file again. Decompressed overlays are shared through the
+    compression cache, unless cache_dir is None.
     """
-    assert_dir_exists(input_dir)
+    game = get_setup_game(input_dir)
     os.makedirs(work_dir, exist_ok=True)
-    setup_dol(input_dir, work_dir)
-    setup_overlays(input_dir, work_dir)
-    setup_ring_attack(input_dir, work_dir)
+    setup_manifest = manifest.load(work_dir, manifest.SETUP_MANIFEST_FILENAME)
+
+    # Check every unit before writing anything, so nothing is set up if
+    # any edited file would be overwritten.
+    phases = get_setup_units(input_dir, work_dir, cache_dir)
+    plans = [[get_setup_plan(setup_manifest, game, work_dir, unit, force) for unit in units] for units in phases]
+    edited = [filepath for phase_plans in plans for plan in phase_plans if plan["run"] for filepath in plan["edited"]]
+    if len(edited) > 0 and not force:
+        fatal_error("Setup would overwrite %s working file(s) that were edited, or weren't set up by this version of ToadsTool:\n%s\n"
+                    "Use -f/--force to overwrite them." % (len(edited), "\n".join(edited)))
+
+    # The .dol file and the overlays are set up first, since the other
+    # files are read from them.
+    for units, phase_plans in zip(phases, plans):
+        run_setup_units(setup_manifest, work_dir, units, phase_plans, jobs)
+
+    for game in setup_games.values():
+        close_game(game)
+    setup_games.clear()
+    for table in setup_text_tables.values():
+        table["dol"].close()
+    setup_text_tables.clear()
+    if cache_dir is not None:
+        compression_cache.evict(cache_dir, cache_size)
     print_info("Setup successfully completed! Wahoo!")
 
 
-def command_stage(work_dir, stage_dir):
+def get_setup_units(input_dir, work_dir, cache_dir):
+    """
+    Gets the units that 'setup' runs, as a list of phases. Every unit of a
+    phase can run at the same time, but only after the units of the
+    previous phases. Units are dicts of shape:
+        {
+            "task": tuple of (function, args...),
+            "inputs": array of the game's original filepaths that it reads,
+            "outputs": array of the working files it writes, relative to work_dir,
+            "config": the settings that its output depends on,
+        }
+    """
+    dol_filepath = files.get_original_filepath(tt_config.dol_file)
+    first_phase = [{
+        "task": (setup_dol, input_dir, work_dir),
+        "inputs": [dol_filepath],
+        "outputs": [tt_config.dol_file],
+        "config": None,
+    }]
+    for overlay in tt_config.overlay_files:
+        first_phase.append({
+            "task": (setup_overlay, input_dir, work_dir, overlay, cache_dir),
+            "inputs": [files.get_original_filepath(overlay)],
+            "outputs": [overlay, overlay + CHECKPOINT_INDEX_EXTENSION],
+            "config": None,
+        })
+
+    golf_overlay_file = tt_config.character_stats["golf_overlay_file"]["overlay_file"]
+    second_phase = [
+        {
+            "task": (setup_character_stats, input_dir, work_dir),
+            "inputs": [files.get_original_filepath(golf_overlay_file)],
+            "outputs": [tt_config.character_stats["work_file"]],
+            "config": tt_config.character_stats,
+        },
+        {
+            "task": (setup_text_table, input_dir, work_dir),
+            "inputs": [dol_filepath],
+            "outputs": [tt_config.dol_text_table["work_file"]],
+            "config": [tt_config.dol_text_table, tt_config.ring_attack_holes],
+        },
+    ]
+    for hole in tt_config.ring_attack_holes:
+        second_phase.append({
+            "task": (setup_ring_attack_hole, input_dir, work_dir, hole),
+            "inputs": [files.get_original_filepath(hole["file"]), dol_filepath],
+            "outputs": [hole["file"]],
+            "config": [hole, tt_config.ring_attack_ring_record, tt_config.dol_text_table],
+        })
+    return [first_phase, second_phase]
+
+
+def get_game_file_hash(game, original_filepath):
+    """
+    Gets the hash of a file in the game's filesystem.
+    """
+    if game["disc"] is None:
+        return manifest.get_file_hash(os.path.join(game["dir"], original_filepath))
+    return manifest.get_data_hash(disc.read_file(game["disc"], original_filepath))
+
+
+def get_setup_plan(setup_manifest, game, work_dir, unit, force):
+    """
+    Works out whether a 'setup' unit needs to run. Returns a dict of shape:
+        {
+            "record": the unit's setup manifest record,
+            "run": whether it needs to run,
+            "edited": array of the existing working files it writes that
+                      weren't last written by 'setup',
+        }
+    """
+    record = {
+        "inputs": {filepath: get_game_file_hash(game, filepath) for filepath in unit["inputs"]},
+        "config": manifest.get_config_hash([unit["task"][0].__name__, unit["config"]]),
+    }
+    run = force
+    edited = []
+    for output in unit["outputs"]:
+        output_filepath = os.path.join(work_dir, output)
+        entry = setup_manifest[manifest.SECTION_SETUP].get(output)
+        if not os.path.exists(output_filepath):
+            run = True
+        elif entry is None or manifest.get_output_change(entry, output_filepath) is not None:
+            edited.append(output_filepath)
+        if entry is None or entry["inputs"] != record["inputs"] or entry["config"] != record["config"]:
+            run = True
+    return {"record": record, "run": run, "edited": edited}
+
+
+def run_setup_units(setup_manifest, work_dir, units, plans, jobs):
+    """
+    Runs the 'setup' units that need to run in `jobs` worker processes, and
+    records the files they wrote in the setup manifest. The files are logged
+    in the order of the units, so the output is the same however many jobs
+    there are. If any unit fails, the program is terminated with every
+    unit's error, once the others have been recorded.
+    """
+    ran = [(unit, plan) for unit, plan in zip(units, plans) if plan["run"]]
+    results = run_tasks([unit["task"] for unit, _ in ran], jobs)
+    written = {}
+    for (unit, plan), (work_filepaths, error) in zip(ran, results):
+        if error is None:
+            for output in unit["outputs"]:
+                manifest.update(setup_manifest, manifest.SECTION_SETUP, output, plan["record"], os.path.join(work_dir, output))
+            written[id(unit)] = work_filepaths
+    manifest.save(work_dir, setup_manifest, manifest.SETUP_MANIFEST_FILENAME)
+
+    errors = [error for _, error in results if error is not None]
+    if len(errors) > 0:
+        fatal_error("Failed to set up %s file(s).\n%s" % (len(errors), "\n".join(errors)))
+    for unit, plan in zip(units, plans):
+        if plan["run"]:
+            for work_filepath in written[id(unit)]:
+                print_info("Setup '%s'" % work_filepath)
+        else:
+            for output in unit["outputs"]:
+                print_info("Skipped unchanged '%s'" % os.path.join(work_dir, output))
+
+
+def command_stage(work_dir, stage_dir, force=False, jobs=1):
     """
     Processes the working directory files into the game's original
-    file formats and writes them to the staging directory.
+    file formats and writes them to the staging directory. Only the files
+    whose inputs changed since they were last staged are rewritten, unless
+    force is True. Files are converted by `jobs` worker processes.
     """
     assert_dir_exists(work_dir)
     os.makedirs(stage_dir, exist_ok=True)
-    free_space = freespace.init()
-    stage_ring_attack(work_dir, stage_dir, free_space)
-    stage_overlays(work_dir, stage_dir)
-    stage_dol(work_dir, stage_dir, free_space)
+    build_manifest = manifest.load(stage_dir)
+    stage = init_stage(stage_dir, build_manifest, force)
+    stage_files(work_dir, stage, jobs)
+    manifest.save(stage_dir, build_manifest)
     print_info("Stage successfully completed! Wahoo!")
 
 
-def command_apply(stage_dir, input_dir):
+def stage_files(work_dir, stage, jobs=1):
+    """
+    Processes the working directory files into the game's original file
+    formats, adding them to the given stage object. The Ring Attack files
+    are converted by `jobs` worker processes. The .dol file is staged last,
+    once everything has been allocated in free space.
+    """
+    free_space = get_free_space(work_dir)
+    stage_ring_attack(work_dir, stage, jobs)
+    stage_overlays(work_dir, stage)
+    stage_dol(work_dir, stage, free_space)
+
+
+def get_stage_records(work_dir):
+    """
+    Gets the build manifest record of every file that 'stage' writes, as
+    tuples of (original filepath, record).
+    """
+    free_space = get_free_space(work_dir)
+    records = []
+    for hole in tt_config.ring_attack_holes:
+        records.append((files.get_original_filepath(hole["file"]), get_ring_attack_record(work_dir, hole)))
+    overlays_record = get_overlays_record(work_dir)
+    for overlay in tt_config.overlay_files:
+        records.append((files.get_original_filepath(overlay), overlays_record))
+    records.append((files.get_original_filepath(tt_config.dol_file), get_dol_record(work_dir, free_space)))
+    return records
+
+
+def apply_file(stage_filepath, data, temp_filepath, is_compressed, compress_level, cache_dir, stream_name, compress_budget=None):
+    """
+    Compresses or copies one staged file into the given temporary file.
+    The staged file's contents are given as data, or read
+    from stage_filepath if data is None. Compressed data is reused from the
+    compression cache when possible, unless cache_dir is None. Otherwise, the
+    file is recompressed incrementally from its last command stream, saved in
+    the cache under stream_name. If compress_budget is given, compression aims
+    to finish within that many seconds, lowering its effort as needed.
+    Returns a tuple of the temporary file's path, so it can be moved into place
+    once every file has been processed, whether the compressed data came from
+    the cache, and the file's uncompressed and compressed sizes (None if it
+    isn't compressed). This runs in a worker process during 'apply'.
+    """
+    cached = False
+    sizes = None
+    try:
+        if is_compressed:
+            if data is None:
+                with open(stage_filepath, "rb") as f:
+                    data = f.read()
+            data = bytearray(data)
+            if cache_dir is None:
+                compressed_data = compression.compress(data, level=compress_level, time_budget=compress_budget)
+            else:
+                compressed_data, cached = compression_cache.compress(data, cache_dir, level=compress_level, stream_name=stream_name,
+                                                                     time_budget=compress_budget)
+            with open(temp_filepath, "wb") as f:
+                f.write(compressed_data)
+            sizes = (len(data), len(compressed_data))
+        elif data is None:
+            shutil.copy(stage_filepath, temp_filepath)
+        else:
+            with open(temp_filepath, "wb") as f:
+                f.write(data)
+    except BaseException:
+        if os.path.exists(temp_filepath):
+            os.remove(temp_filepath)
+        raise
+
+    return temp_filepath, cached, sizes
+
+
+def get_compress_budgets(sizes, compress_budget, jobs):
+    """
+    Splits a total compression time budget between files of the given sizes,
+    in proportion to their sizes. Files are compressed `jobs` at a time, so
+    each one can take a bigger share of the total, up to all of it.
+    """
+    total_size = max(1, sum(sizes))
+    return [min(compress_budget, compress_budget * min(jobs, len(sizes)) * size / total_size) for size in sizes]
+
+
+def get_apply_config(original_filepath, compress_level, compress_budget):
+    """
+    Gets the settings that applying a staged file to the game's filesystem
+    depends on. Compressed files depend on the compression settings.
+    """
+    if files.is_compressed(original_filepath):
+        return {"compress_level": compress_level, "compress_budget": compress_budget}
+    return {}
+
+
+def command_apply(stage_dir, input_dir, compress_level=compression.COMPRESS_LEVEL_GREEDY, jobs=1,
+                  cache_dir=None, cache_size=compression_cache.DEFAULT_CACHE_SIZE, compress_budget=None, force=False,
+                  staged_files=None, patch_filepath=None):
     """
     Copies files from the staging directory into the game's extracted
     filesystem. If a file is missing from the staging directory, it is
-    silently ignored. Also applies compression to the file, if necessary.
+    silently ignored. Also applies compression to the file, if necessary,
+    using the given compression level. Compressed files are cached in
+    cache_dir, unless it is None. Files are processed by `jobs` worker
+    processes, and none of them are written unless all of them succeed.
+    If compress_budget is given, compressing all the files aims to take at
+    most that many seconds, giving up some compression to get there.
+    Files that are unchanged since they were last applied are skipped,
+    unless force is True. If staged_files is given, it maps original
+    filepaths to staged file contents held in memory, which are used instead
+    of the staging directory's copies. If input_dir is a disc image, the
+    files are written into it directly. If patch_filepath is given, the game's
+    files are left as they are, and a patch file with the changes to them is
+    written there instead. Returns the original filepaths of the files that
+    were applied.
     """
-    assert_dirs_exist(stage_dir, input_dir)
+    assert_dir_exists(stage_dir)
+    if compress_budget is not None and compress_budget <= 0:
+        fatal_error("Compression time budget must be greater than 0 seconds.")
+    game = open_game(input_dir)
+    build_manifest = manifest.load(stage_dir)
+    if staged_files is None:
+        staged_files = {}
     
     # Simply copy all the files we're aware of.
+    apply_args = []
+    records = []
+    sizes = []
     for original_filepath in files.get_original_filepaths():
         stage_filepath = os.path.join(stage_dir, original_filepath)
-        if not os.path.exists(stage_filepath):
-            print(stage_filepath)
+        data = staged_files.get(original_filepath)
+        config = get_apply_config(original_filepath, compress_level, compress_budget)
+        if data is not None:
+            source = "%s (in memory)" % original_filepath
+            record = manifest.get_data_record({original_filepath: data}, config)
+            sizes.append(len(data))
+        elif os.path.exists(stage_filepath):
+            source = stage_filepath
+            record = manifest.get_record(stage_dir, [original_filepath], config)
+            sizes.append(os.path.getsize(stage_filepath))
+        else:
             # Silently ignore files that don't exist in the staging directory.
             continue
 
-        output_filepath = os.path.join(input_dir, original_filepath)
-        if files.is_compressed(original_filepath):
-            print_info("Compressing '%s'" % stage_filepath)
-            with open(stage_filepath, "rb") as f:
-                compressed_data = compression.compress(bytearray(f.read()))
-            with open(output_filepath, "wb") as f:
-                f.write(compressed_data)
+        if patch_filepath is None and not force and len(get_game_file_changes(build_manifest, game, original_filepath, record)) == 0:
+            print_info("Skipped unchanged '%s'" % source)
+            sizes.pop()
+            continue
+
+        # Files are processed into temporary files first. For a disc
+        # image or a patch file, they're kept in the staging directory until
+        # they're written out.
+        if game["disc"] is None and patch_filepath is None:
+            temp_filepath = os.path.join(input_dir, original_filepath) + ".tmp"
+        else:
+            temp_filepath = stage_filepath + ".tmp"
+            os.makedirs(os.path.dirname(temp_filepath), exist_ok=True)
+
+        is_compressed = files.is_compressed(original_filepath)
+        if is_compressed:
+            print_info("Compressing '%s'" % source)
+        apply_args.append((stage_filepath, data, temp_filepath, is_compressed, compress_level, cache_dir, original_filepath, None))
+        records.append((source, record))
+
+    if compress_budget is not None:
+        compressed = [i for i, args in enumerate(apply_args) if args[3]]
+        budgets = get_compress_budgets([sizes[i] for i in compressed], compress_budget, jobs)
+        for i, budget in zip(compressed, budgets):
+            apply_args[i] = apply_args[i][:-1] + (budget,)
+
+    start_time = time.perf_counter()
+    results = run_parallel(apply_file, apply_args, jobs)
+    seconds = time.perf_counter() - start_time
+    errors = [error for _, error in results if error is not None]
+    if len(errors) > 0:
+        for result, _ in results:
+            if result is not None:
+                os.remove(result[0])
+        close_game(game)
+        fatal_error("Failed to apply %s file(s). No files were applied.\n%s" % (len(errors), "\n".join(errors)))
+
+    if patch_filepath is not None:
+        write_patch_file(game, patch_filepath, [(args[6], temp_filepath) for args, ((temp_filepath, _, _), _) in zip(apply_args, results)])
+        close_game(game)
+        if cache_dir is not None:
+            compression_cache.evict(cache_dir, cache_size)
+        print_info("Apply successfully completed! Wahoo!")
+        return [args[6] for args in apply_args]
+
+    # Write all the files into the disc image at once, so the FST is only
+    # updated once.
+    disc_files = {}
+    if game["disc"] is not None:
+        for args, ((temp_filepath, _, _), _) in zip(apply_args, results):
+            with open(temp_filepath, "rb") as f:
+                disc_files[args[6]] = f.read()
+            os.remove(temp_filepath)
+        for original_filepath in disc.write_files(game["disc"], disc_files):
+            print_info("Moved '%s' to free disc space, since it no longer fits in its slot" % get_game_filepath(game, original_filepath))
+
+    total_size = 0
+    total_compressed_size = 0
+    for args, ((temp_filepath, cached, file_sizes), _), (source, record) in zip(apply_args, results, records):
+        original_filepath = args[6]
+        output_filepath = get_game_filepath(game, original_filepath)
+        if game["disc"] is None:
+            os.replace(temp_filepath, output_filepath)
+            manifest.update(build_manifest, manifest.SECTION_APPLY, original_filepath, record, output_filepath)
         else:
-            shutil.copy(stage_filepath, output_filepath)
+            manifest.update(build_manifest, manifest.SECTION_APPLY, original_filepath, record, output_filepath, output_data=disc_files[original_filepath])
+        if cached:
+            print_info("Used cached compressed data for '%s'" % source)
+        if file_sizes is not None:
+            size, compressed_size = file_sizes
+            total_size += size
+            total_compressed_size += compressed_size
+            print_info("Compressed '%s': %s -> %s bytes (%.1f%%)" % (source, size, compressed_size, 100.0 * compressed_size / max(1, size)))
+        print_info("Applied '%s' to '%s" % (source, output_filepath))
 
-        print_info("Applied '%s' to '%s" % (stage_filepath, output_filepath))
+    if total_size > 0:
+        print_info("Compressed %s -> %s bytes in total (%.1f%%)" % (total_size, total_compressed_size, 100.0 * total_compressed_size / total_size))
+    if compress_budget is not None:
+        print_info("Processed files in %.2f s, with a compression budget of %.2f s" % (seconds, compress_budget))
+
+    close_game(game)
+    manifest.save(stage_dir, build_manifest)
+    if cache_dir is not None:
+        compression_cache.evict(cache_dir, cache_size)
 
     print_info("Apply successfully completed! Wahoo!")
+    return [args[6] for args in apply_args]
 
 
-def command_build(work_dir, stage_dir, input_dir):
+def write_patch_file(game, patch_filepath, temp_files):
     """
-    Simply runs the "stage" command followed by the "apply" command.
+    Writes a patch file with the changes between the game's files and the
+    given processed files, as tuples of (original filepath, temporary file
+    path). The temporary files are deleted afterwards.
     """
-    assert_dirs_exist(work_dir, stage_dir, input_dir)
-    command_stage(work_dir, stage_dir)
-    command_apply(stage_dir, input_dir)
+    entries = []
+    for original_filepath, temp_filepath in temp_files:
+        with open(temp_filepath, "rb") as f:
+            data = f.read()
+        os.remove(temp_filepath)
+        original_data = read_game_file(game, original_filepath) if has_game_file(game, original_filepath) else b""
+        if len(original_data) == len(data) and original_data[:] == data:
+            print_info("Skipped unchanged '%s'" % get_game_filepath(game, original_filepath))
+            continue
+        entry = delta.make_entry(original_filepath, original_data, data)
+        print_info("Added '%s' to patch: %s byte delta" % (original_filepath, len(entry["delta"])))
+        entries.append(entry)
+
+    patch_size = delta.save(patch_filepath, entries)
+    print_info("Wrote %s changed file(s) to patch '%s' (%s bytes)" % (len(entries), patch_filepath, patch_size))
+
+
+def command_patch_apply(patch_filepath, input_dir):
+    """
+    Runs the ToadsTool 'patch-apply' command, which applies a patch file
+    made by 'apply --patch-out' to the game's filesystem. Each file must be
+    the original the patch was made from, or already patched. None of the
+    files are written unless all of them can be patched.
+    """
+    assert_file_exists(patch_filepath)
+    game = open_game(input_dir)
+    new_files = {}
+    for entry in delta.load(patch_filepath):
+        original_filepath = entry["filepath"]
+        original_data = read_game_file(game, original_filepath) if has_game_file(game, original_filepath) else b""
+        if delta.is_patched(entry, original_data):
+            print_info("Skipped already patched '%s'" % get_game_filepath(game, original_filepath))
+            continue
+        new_files[original_filepath] = delta.apply_entry(entry, original_data)
+
+    if game["disc"] is not None:
+        disc.write_files(game["disc"], new_files)
+    else:
+        for original_filepath, data in new_files.items():
+            output_filepath = get_game_filepath(game, original_filepath)
+            with open(output_filepath + ".tmp", "wb") as f:
+                f.write(data)
+        for original_filepath in new_files:
+            output_filepath = get_game_filepath(game, original_filepath)
+            os.replace(output_filepath + ".tmp", output_filepath)
+    for original_filepath in new_files:
+        print_info("Patched '%s'" % get_game_filepath(game, original_filepath))
+    close_game(game)
+    print_info("Patch successfully applied! Wahoo!")
+
+
+def command_build(work_dir, stage_dir, input_dir, compress_level=compression.COMPRESS_LEVEL_GREEDY, jobs=1,
+                  cache_dir=None, cache_size=compression_cache.DEFAULT_CACHE_SIZE, compress_budget=None, force=False,
+                  keep_stage=False, patch_filepath=None):
+    """
+    Runs the "stage" command followed by the "apply" command. Unless
+    keep_stage is True, the staged files are passed straight from one to the
+    other in memory, rather than being written to the staging directory and
+    read back. The staging directory still holds the build manifest.
+    """
+    assert_dir_exists(work_dir)
+    if keep_stage:
+        command_stage(work_dir, stage_dir, force, jobs)
+        command_apply(stage_dir, input_dir, compress_level, jobs, cache_dir, cache_size, compress_budget, force, patch_filepath=patch_filepath)
+    else:
+        os.makedirs(stage_dir, exist_ok=True)
+        stage = init_stage()
+        stage_files(work_dir, stage, jobs)
+        command_apply(stage_dir, input_dir, compress_level, jobs, cache_dir, cache_size, compress_budget, force, stage["files"], patch_filepath)
     print_info("Build successfully completed! Wahoo!")
 
 
+def load_batch_baseline(input_dir, compress_level=compression.COMPRESS_LEVEL_GREEDY, cache_dir=None):
+    """
+    Loads the baseline that every 'batch-build' variant is built against.
+    The decompressed overlays are reused from the compression cache when
+    'setup' left them there, and are decompressed once otherwise. Returns a
+    dict of shape:
+        {
+            "game_files": dict of original filepaths to the game's original
+                          file contents,
+            "work_files": dict of the .dol and overlay working filepaths,
+                          relative to the working directory, to tuples of
+                          the contents 'setup' extracts and their hash,
+            "streams": dict of original filepaths to the command streams
+                       of the decompressed overlays, empty if cache_dir is
+                       None,
+        }
+    """
+    game = open_game(input_dir)
+    game_files = {}
+    for original_filepath in files.get_original_filepaths():
+        if has_game_file(game, original_filepath):
+            game_files[original_filepath] = bytes(read_game_file(game, original_filepath))
+    close_game(game)
+
+    work_files = {}
+    for work_file in [tt_config.dol_file] + tt_config.overlay_files:
+        data = game_files[files.get_original_filepath(work_file)]
+        if files.is_compressed(files.get_original_filepath(work_file)):
+            cached = None if cache_dir is None else compression_cache.load_decompressed(cache_dir, data)
+            data = bytes(compression.decompress(data) if cached is None else cached[0])
+        work_files[work_file] = (data, manifest.get_data_hash(data))
+
+    # Every variant's overlays are recompressed incrementally from the
+    # baseline's command streams, rather than from each other's, so each
+    # variant's output doesn't depend on which variants were built first.
+    streams = {}
+    for overlay in tt_config.overlay_files if cache_dir is not None else []:
+        original_filepath = files.get_original_filepath(overlay)
+        data = work_files[overlay][0]
+        stream_name = BATCH_BASELINE_STREAM_PREFIX + original_filepath
+        stream = compression_cache.load_stream(cache_dir, stream_name)
+        if stream is None or stream["data"] != data or stream["level"] != compress_level:
+            _, stream = compression.compress_incremental(bytearray(data), level=compress_level)
+            compression_cache.store_stream(cache_dir, stream_name, stream)
+        streams[original_filepath] = stream
+    return {"game_files": game_files, "work_files": work_files, "streams": streams}
+
+
+def use_batch_baseline(work_dir, baseline):
+    """
+    Makes staging use the baseline's contents for the .dol and overlays in
+    the working directory that are unchanged since 'setup' extracted them,
+    according to the setup manifest, so they're neither read nor hashed
+    again. Returns the number of files that use the baseline.
+    """
+    setup_manifest = manifest.load(work_dir, manifest.SETUP_MANIFEST_FILENAME)
+    num_shared = 0
+    for work_file, (data, data_hash) in baseline["work_files"].items():
+        work_filepath = os.path.join(work_dir, work_file)
+        entry = setup_manifest[manifest.SECTION_SETUP].get(work_file)
+        if entry is None or entry["output"] != data_hash or manifest.get_output_change(entry, work_filepath) is not None:
+            continue
+        stat_key = (entry["output_size"], entry["output_mtime"])
+        work_files[work_filepath] = (stat_key, data)
+        manifest.file_hashes[work_filepath] = (stat_key, data_hash)
+        num_shared += 1
+    return num_shared
+
+
+def init_batch_worker(baseline):
+    """
+    Sets the baseline that this process builds 'batch-build' variants
+    against. It runs once in each worker process, so the baseline is only
+    sent to each worker once, rather than with every variant.
+    """
+    global batch_baseline
+    batch_baseline = baseline
+
+
+def build_variant(work_dir, patch_filepath, compress_level, cache_dir):
+    """
+    Builds one 'batch-build' variant against the baseline given to
+    init_batch_worker(). Its working directory is staged in memory, and a
+    patch file with the changes to the baseline's game files is written.
+    Nothing is logged, so variants built at the same time don't mix their
+    output. Returns a tuple of the number of changed files, the patch file's
+    size, and the number of working files that used the baseline. This runs
+    in a worker process during 'batch-build'.
+    """
+    baseline = batch_baseline
+    verbose = not util.quiet
+    util.quiet = True
+    try:
+        num_shared = use_batch_baseline(work_dir, baseline)
+        stage = init_stage(quiet=True)
+        stage_files(work_dir, stage)
+
+        entries = []
+        for original_filepath in files.get_original_filepaths():
+            data = stage["files"].get(original_filepath)
+            if data is None:
+                continue
+            if files.is_compressed(original_filepath):
+                if cache_dir is None:
+                    data = compression.compress(bytearray(data), level=compress_level)
+                else:
+                    data, _ = compression_cache.compress(bytearray(data), cache_dir, level=compress_level,
+                                                         base_stream=baseline["streams"].get(original_filepath))
+            original_data = baseline["game_files"].get(original_filepath, b"")
+            if original_data != data:
+                entries.append(delta.make_entry(original_filepath, original_data, data))
+
+        if os.path.dirname(patch_filepath) != "":
+            os.makedirs(os.path.dirname(patch_filepath), exist_ok=True)
+        patch_size = delta.save(patch_filepath, entries)
+    finally:
+        util.quiet = not verbose
+        # Worker processes build many variants, so don't keep this one's
+        # files around.
+        work_files.clear()
+        for table in setup_text_tables.values():
+            table["dol"].close()
+        setup_text_tables.clear()
+    return len(entries), patch_size, num_shared
+
+
+def command_batch_build(variants, input_dir, compress_level=compression.COMPRESS_LEVEL_GREEDY, jobs=1,
+                        cache_dir=None, cache_size=compression_cache.DEFAULT_CACHE_SIZE):
+    """
+    Runs the ToadsTool 'batch-build' command, which builds many variants of
+    the game at once, given as tuples of (working directory, patch filepath).
+    Each variant is built into its own patch file, like 'build --patch-out',
+    so the game's files are left as they are. The game's original files and
+    the decompressed .dol and overlays are loaded once and shared by every
+    variant, as is the compression cache, unless cache_dir is None. Variants
+    are built by `jobs` worker processes. One failing variant doesn't stop
+    the others from being built.
+    """
+    if len(variants) == 0:
+        fatal_error("The 'batch-build' command needs at least one --variant.")
+    patch_filepaths = [os.path.realpath(patch_filepath) for _, patch_filepath in variants]
+    if len(set(patch_filepaths)) != len(patch_filepaths):
+        fatal_error("Every variant needs its own patch file.")
+    for work_dir, _ in variants:
+        assert_dir_exists(work_dir)
+
+    start_time = time.perf_counter()
+    baseline = load_batch_baseline(input_dir, compress_level, cache_dir)
+    print_info("Loaded the baseline from '%s'" % input_dir)
+    results = run_parallel(build_variant, [(work_dir, patch_filepath, compress_level, cache_dir) for work_dir, patch_filepath in variants], jobs,
+                           init_batch_worker, (baseline,))
+    seconds = time.perf_counter() - start_time
+
+    errors = []
+    for (work_dir, patch_filepath), (result, error) in zip(variants, results):
+        if error is not None:
+            errors.append("%s ('%s')" % (error, work_dir))
+            continue
+        num_changed, patch_size, num_shared = result
+        print_info("Built '%s' into patch '%s': %s changed file(s), %s bytes (%s of %s binaries shared with the baseline)" % (
+            work_dir, patch_filepath, num_changed, patch_size, num_shared, len(baseline["work_files"])))
+    if cache_dir is not None:
+        compression_cache.evict(cache_dir, cache_size)
+
+    num_built = len(variants) - len(errors)
+    print_info("Built %s variant(s) in %.2f s (%.1f variants per minute)" % (num_built, seconds, 60.0 * num_built / max(seconds, 0.001)))
+    if len(errors) > 0:
+        fatal_error("Failed to build %s of %s variant(s).\n%s" % (len(errors), len(variants), "\n".join(errors)))
+    print_info("Batch build successfully completed! Wahoo!")
+
+
+def get_work_snapshot(work_dir):
+    """
+    Gets the size and modification time of every file in the working
+    directory, keyed by filepath.
+    """
+    snapshot = {}
+    for dirpath, _, filenames in os.walk(work_dir):
+        for filename in filenames:
+            filepath = os.path.join(dirpath, filename)
+            try:
+                stat = os.stat(filepath)
+            except FileNotFoundError:
+                continue
+            snapshot[filepath] = (stat.st_size, stat.st_mtime_ns)
+    return snapshot
+
+
+def wait_for_work_changes(work_dir, snapshot, interval):
+    """
+    Waits until the working directory changes from the given snapshot, and
+    then until it stops changing. Returns the new snapshot.
+    """
+    new_snapshot = snapshot
+    while new_snapshot == snapshot:
+        time.sleep(interval)
+        new_snapshot = get_work_snapshot(work_dir)
+    while True:
+        time.sleep(WATCH_DEBOUNCE_TIME)
+        settled_snapshot = get_work_snapshot(work_dir)
+        if settled_snapshot == new_snapshot:
+            return new_snapshot
+        new_snapshot = settled_snapshot
+
+
+def command_watch(work_dir, stage_dir, input_dir, compress_level=compression.COMPRESS_LEVEL_GREEDY, jobs=1,
+                  cache_dir=None, cache_size=compression_cache.DEFAULT_CACHE_SIZE, compress_budget=None, interval=WATCH_INTERVAL):
+    """
+    Runs the ToadsTool 'watch' command, which builds once, and then rebuilds
+    whenever a file in the working directory changes, until it's stopped
+    with Ctrl+C. Between rebuilds, the working files, the staged files and
+    the compressor's command streams are kept in memory, so only the outputs
+    affected by a change are redone. Rebuilds compress in this process, so
+    those stay warm, rather than in `jobs` worker processes like the first
+    build.
+    """
+    assert_dir_exists(work_dir)
+    os.makedirs(stage_dir, exist_ok=True)
+    stage = init_stage()
+    stage_files(work_dir, stage, jobs)
+    command_apply(stage_dir, input_dir, compress_level, jobs, cache_dir, cache_size, compress_budget, staged_files=stage["files"])
+    stage["quiet"] = True
+
+    snapshot = get_work_snapshot(work_dir)
+    print_info("Watching '%s' for changes. Press Ctrl+C to stop." % work_dir)
+    try:
+        while True:
+            new_snapshot = wait_for_work_changes(work_dir, snapshot, interval)
+            changed_filepaths = sorted(filepath for filepath in set(snapshot) | set(new_snapshot) if snapshot.get(filepath) != new_snapshot.get(filepath))
+            snapshot = new_snapshot
+            print_info("Changed: %s" % ", ".join(os.path.relpath(filepath, work_dir) for filepath in changed_filepaths))
+
+            start_time = time.perf_counter()
+            verbose = not util.quiet
+            util.quiet = True
+            try:
+                stage_files(work_dir, stage)
+                applied = command_apply(stage_dir, input_dir, compress_level, 1, cache_dir, cache_size, compress_budget, staged_files=stage["files"])
+            except (Exception, SystemExit) as e:
+                # Keep watching, so the mistake can be fixed.
+                print(get_error_message(e))
+                continue
+            finally:
+                util.quiet = not verbose
+            seconds = time.perf_counter() - start_time
+            if len(applied) == 0:
+                print_info("Nothing to rebuild (%.3f s)" % seconds)
+            else:
+                print_info("Rebuilt %s in %.3f s" % (", ".join(applied), seconds))
+    except KeyboardInterrupt:
+        print_info("Stopped watching '%s'" % work_dir)
+
+
+def command_status(work_dir, stage_dir, input_dir=None, compress_level=compression.COMPRESS_LEVEL_GREEDY, compress_budget=None):
+    """
+    Runs the ToadsTool 'status' command, which lists the files that 'stage'
+    would rewrite in the staging directory, and why, and how much free space
+    the injected data uses. If input_dir is given,
+    it also lists the files that 'build' would rewrite in the game's
+    filesystem with the given compression settings.
+    """
+    assert_dir_exists(work_dir)
+    build_manifest = manifest.load(stage_dir)
+    if len(build_manifest[manifest.SECTION_STAGE]) == 0:
+        print("No files have been staged to '%s'." % stage_dir)
+    else:
+        num_dirty = 0
+        stage_records = get_stage_records(work_dir)
+        for original_filepath, record in stage_records:
+            stage_filepath = os.path.join(stage_dir, original_filepath)
+            changes = manifest.get_changes(build_manifest, manifest.SECTION_STAGE, original_filepath, record, stage_filepath)
+            if len(changes) > 0:
+                num_dirty += 1
+                print("stage: %s (%s)" % (stage_filepath, ", ".join(changes)))
+        print("%s of %s staged file(s) out of date." % (num_dirty, len(stage_records)))
+
+    free_space = get_free_space(work_dir)
+    for line in freespace.get_report(freespace.get_layout(free_space)):
+        print(line)
+
+    if input_dir is None:
+        return
+
+    # Stage everything in memory, like 'build' does, and compare that to
+    # what was last applied. Staging the .dol prints the free space report,
+    # which was just printed above, so staging is kept quiet.
+    game = open_game(input_dir)
+    stage = init_stage(quiet=True)
+    verbose = not util.quiet
+    util.quiet = True
+    try:
+        stage_files(work_dir, stage)
+    finally:
+        util.quiet = not verbose
+    num_dirty = 0
+    num_files = 0
+    for original_filepath in files.get_original_filepaths():
+        config = get_apply_config(original_filepath, compress_level, compress_budget)
+        if original_filepath in stage["files"]:
+            record = manifest.get_data_record({original_filepath: stage["files"][original_filepath]}, config)
+        elif os.path.exists(os.path.join(stage_dir, original_filepath)):
+            record = manifest.get_record(stage_dir, [original_filepath], config)
+        else:
+            continue
+        num_files += 1
+        changes = get_game_file_changes(build_manifest, game, original_filepath, record)
+        if len(changes) > 0:
+            num_dirty += 1
+            print("build: %s (%s)" % (get_game_filepath(game, original_filepath), ", ".join(changes)))
+    close_game(game)
+    print("%s of %s game file(s) out of date." % (num_dirty, num_files))
+
+
+def command_cache(cache_dir, action):
+    """
+    Runs the ToadsTool 'cache' command, which manages the compression cache.
+    The 'stats' action prints the cache's size, including the saved command
+    streams, and the 'clear' action deletes every cache entry.
+    """
+    if action == "stats":
+        stats = compression_cache.get_stats(cache_dir)
+        print("Cache directory: %s" % cache_dir)
+        print("Entries: %s" % stats["entries"])
+        print("Command streams: %s" % stats["streams"])
+        print("Size: %.2f MB" % (stats["size"] / (1024 * 1024)))
+    elif action == "clear":
+        compression_cache.clear(cache_dir)
+        print_info("Cleared compression cache '%s'" % cache_dir)
+    else:
+        fatal_error("Invalid cache action '%s'. Valid actions are 'stats' and 'clear'." % action)
+
+
+def command_rings(work_dir, action, transform, courses=None, hole_numbers=None, dry_run=False):
+    """
+    Runs the ToadsTool 'rings' command, which edits Ring Attack rings in
+    bulk. The 'transform' action applies the given transform to the rings
+    of the selected holes in the working directory, all at once. If dry_run
+    is True, the files aren't written.
+    """
+    if action != "transform":
+        fatal_error("Invalid rings action '%s'. The valid action is 'transform'." % action)
+    assert_dir_exists(work_dir)
+
+    # Load every selected hole's rings into one table.
+    start_time = time.perf_counter()
+    holes = rings.select_holes(courses, hole_numbers)
+    hole_data = []
+    table = []
+    hole_indexes = []
+    for hole_index, hole in enumerate(holes):
+        with open(os.path.join(work_dir, hole["file"])) as f:
+            ring_attack_data = json.load(f)
+        hole_data.append(ring_attack_data)
+        for ring in ring_attack_data["rings"]:
+            table.extend(ring[field] for field in rings.RING_FIELDS)
+            hole_indexes.append(hole_index)
+
+    table = rings.transform_table(table, hole_indexes, len(holes), transform)
+
+    # Write the transformed rings back into each hole's JSON file.
+    i = 0
+    for hole, ring_attack_data in zip(holes, hole_data):
+        for ring in ring_attack_data["rings"]:
+            ring.update(zip(rings.RING_FIELDS, table[i:i + len(rings.RING_FIELDS)]))
+            i += len(rings.RING_FIELDS)
+        work_filepath = os.path.join(work_dir, hole["file"])
+        if not dry_run:
+            with open(work_filepath, "w") as f:
+                json.dump(ring_attack_data, f, indent=2)
+        print_info("Transformed %s ring(s) in '%s'" % (len(ring_attack_data["rings"]), work_filepath))
+
+    print_info("Transformed %s ring(s) in %s hole(s) in %.3f seconds%s" % (
+        len(hole_indexes), len(holes), time.perf_counter() - start_time, " (dry run, nothing was written)" if dry_run else ""))
+
+
+def assert_input_dir_given(input_dir, command):
+    """
+    Checks that the input directory option was given, since most
+    commands need it.
+    """
+    if input_dir is None:
+        fatal_error("The -i/--input-dir option is required for the '%s' command." % command)
+
+
 if __name__ == "__main__":
     default_work_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "work")
     default_stage_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "stage")
+    default_cache_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cache")
 
     argparser = argparse.ArgumentParser("ToadsTool - Mario Golf Toadstool Tour Editor")
-    argparser.add_argument("command", help="The ToadsTool command to run ('setup', 'stage', 'apply', 'build')")
-    argparser.add_argument("-i", "--input-dir", help="Directory of the MGTT ISO's extracted filesystem", required=True)
+    argparser.add_argument("command", help="The ToadsTool command to run ('setup', 'stage', 'apply', 'build', 'batch-build', 'watch', 'status', 'cache', 'patch-apply', 'rings')")
+    argparser.add_argument("action", nargs="?", help="The action for the 'cache' command ('stats', 'clear') or the 'rings' command ('transform'), or the patch file for the 'patch-apply' command")
+    argparser.add_argument("-i", "--input-dir", help="Directory of the MGTT ISO's extracted filesystem, or the .iso/.gcm disc image itself. Required by 'setup', 'apply', 'build' and 'batch-build'. Optional for 'status'")
     argparser.add_argument("-w", "--work-dir", help="Working directory of the ToadsTool data files. Defaults to \"%s\"" % default_work_dir, default=default_work_dir)
     argparser.add_argument("-s", "--stage-dir", help="Staging directory of the ToadsTool data files. Defaults to \"%s\"" % default_stage_dir, default=default_stage_dir)
+    argparser.add_argument("-c", "--compress-level", help="Compression level used by 'apply', 'build' and 'batch-build'. 'greedy' is fastest, 'optimal' gives the smallest files. Defaults to \"%s\"" % compression.COMPRESS_LEVEL_GREEDY, choices=compression.COMPRESS_LEVELS, default=compression.COMPRESS_LEVEL_GREEDY)
+    argparser.add_argument("-j", "--jobs", help="Number of files to process in parallel during 'setup', 'stage', 'apply' and 'build', or variants during 'batch-build'. Defaults to 1", type=int, default=1)
+    argparser.add_argument("--cache-dir", help="Directory of the compression cache. Defaults to \"%s\"" % default_cache_dir, default=default_cache_dir)
+    argparser.add_argument("--cache-size", help="Maximum size of the compression cache, in MB. Defaults to %s" % (compression_cache.DEFAULT_CACHE_SIZE // (1024 * 1024)), type=int, default=compression_cache.DEFAULT_CACHE_SIZE // (1024 * 1024))
+    argparser.add_argument("--compress-budget", help="Aim to finish compressing during 'apply' and 'build' within this many seconds, giving up some compression if needed", type=float)
+    argparser.add_argument("--no-cache", help="Don't use the compression cache during 'setup', 'apply', 'build' and 'batch-build'", action="store_true")
+    argparser.add_argument("--keep-stage", help="Also write the staged files to the staging directory during 'build'. Otherwise, they're only kept in memory", action="store_true")
+    argparser.add_argument("--patch-out", help="Write a patch file with the changes to the game's files during 'apply' and 'build', instead of changing the files themselves")
+    argparser.add_argument("--variant", help="Working directory of a variant for 'batch-build', and the patch file to build it into. Give it once per variant", nargs=2, metavar=("WORK_DIR", "PATCH_FILE"), action="append", default=[])
+    argparser.add_argument("--watch-interval", help="How often 'watch' checks the working directory for changes, in seconds. Defaults to %s" % WATCH_INTERVAL, type=float, default=WATCH_INTERVAL)
+    argparser.add_argument("--course", help="Only transform the rings of this course during 'rings transform', such as \"blooper_bay\". Can be given more than once. Defaults to every course", action="append")
+    argparser.add_argument("--hole", help="Only transform the rings of this hole number (0-5) of each course during 'rings transform'. Can be given more than once. Defaults to every hole", type=int, action="append")
+    argparser.add_argument("--translate", help="Move the rings by X Y Z during 'rings transform'", type=float, nargs=3, metavar=("X", "Y", "Z"))
+    argparser.add_argument("--scale", help="Scale the ring positions by X Y Z around the pivot during 'rings transform'", type=float, nargs=3, metavar=("X", "Y", "Z"))
+    argparser.add_argument("--rotate", help="Rotate the ring positions by this many degrees around the vertical (Y) axis through the pivot during 'rings transform'", type=float, metavar="DEGREES")
+    argparser.add_argument("--pivot", help="Point to scale and rotate the rings around during 'rings transform'. Defaults to the center of each hole's rings", type=float, nargs=3, metavar=("X", "Y", "Z"))
+    argparser.add_argument("--ring-rotate", help="Add X Y to each ring's rotationX and rotationY during 'rings transform'", type=float, nargs=2, metavar=("X", "Y"))
+    argparser.add_argument("--ring-scale", help="Multiply each ring's scaleX and scaleY by X Y during 'rings transform'", type=float, nargs=2, metavar=("X", "Y"))
+    argparser.add_argument("--clamp-scale", help="Clamp each ring's scaleX and scaleY between MIN and MAX during 'rings transform'", type=float, nargs=2, metavar=("MIN", "MAX"))
+    argparser.add_argument("--dry-run", help="Show what 'rings transform' would change without writing any files", action="store_true")
+    argparser.add_argument("-f", "--force", help="Rebuild every file during 'setup', 'stage', 'apply' and 'build', even if it's up to date. 'setup' also overwrites working files that were edited", action="store_true")
     args = argparser.parse_args()
-    
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    cache_size = args.cache_size * 1024 * 1024
+    if args.command in ("setup", "apply", "build", "batch-build", "watch", "patch-apply"):
+        assert_input_dir_given(args.input_dir, args.command)
+
     if args.command == "setup":
-        command_setup(args.input_dir, args.work_dir)
+        command_setup(args.input_dir, args.work_dir, args.jobs, cache_dir, cache_size, args.force)
     elif args.command == "stage":
-        command_stage(args.work_dir, args.stage_dir)
+        command_stage(args.work_dir, args.stage_dir, args.force, args.jobs)
     elif args.command == "apply":
-        command_apply(args.stage_dir, args.input_dir)
+        command_apply(args.stage_dir, args.input_dir, args.compress_level, args.jobs, cache_dir, cache_size, args.compress_budget, args.force,
+                      patch_filepath=args.patch_out)
     elif args.command == "build":
-        command_build(args.work_dir, args.stage_dir, args.input_dir)
+        command_build(args.work_dir, args.stage_dir, args.input_dir, args.compress_level, args.jobs, cache_dir, cache_size, args.compress_budget, args.force,
+                      args.keep_stage, args.patch_out)
+    elif args.command == "batch-build":
+        command_batch_build(args.variant, args.input_dir, args.compress_level, args.jobs, cache_dir, cache_size)
+    elif args.command == "watch":
+        command_watch(args.work_dir, args.stage_dir, args.input_dir, args.compress_level, args.jobs, cache_dir, cache_size, args.compress_budget,
+                      args.watch_interval)
+    elif args.command == "status":
+        command_status(args.work_dir, args.stage_dir, args.input_dir, args.compress_level, args.compress_budget)
+    elif args.command == "cache":
+        command_cache(args.cache_dir, args.action)
+    elif args.command == "patch-apply":
+        if args.action is None:
+            fatal_error("The 'patch-apply' command needs a patch file.")
+        command_patch_apply(args.action, args.input_dir)
+    elif args.command == "rings":
+        transform = rings.init_transform(args.translate, args.scale, args.rotate, args.pivot, args.ring_rotate, args.ring_scale, args.clamp_scale)
+        command_rings(args.work_dir, args.action, transform, args.course, args.hole, args.dry_run)
     else:
-        fatal_error("Invalid command '%s'. Valid commands are 'setup', 'stage', 'apply', and 'build'." % args.command)
+        fatal_error("Invalid command '%s'. Valid commands are 'setup', 'stage', 'apply', 'build', 'batch-build', 'watch', 'status', 'cache', 'patch-apply', and 'rings'." % args.command)
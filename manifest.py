@@ -0,0 +1,221 @@
+# This file contains logic for the build manifest, which records what each
+# staged and applied file was built from. 'stage' and 'apply' use it to only
+# rebuild the files whose inputs changed since the last time. 'setup' keeps
+# a manifest of its own in the working directory, for the files it extracts.
+#
+# Every file's entry is a record of:
+#   "inputs": hashes of the files it was built from
+#   "config": hash of the ToadsTool settings it was built with
+#   "output": hash of the file that was written
+# A file needs rebuilding if any of these no longer match. The output's size
+# and modification time are recorded too, so unchanged outputs don't need to
+# be read again to check their hash. Files that are built by patching a base
+# file also record the ranges they patched, so later builds can patch the
+# output in place instead of rewriting it.
+
+import hashlib
+import json
+import os
+
+MANIFEST_VERSION = 2
+MANIFEST_FILENAME = "toadstool_manifest.json"
+SETUP_MANIFEST_FILENAME = "toadstool_setup.json"
+
+# Sections of the manifest, for the outputs of 'stage', 'apply' and 'setup'.
+SECTION_STAGE = "stage"
+SECTION_APPLY = "apply"
+SECTION_SETUP = "setup"
+
+# Hashes of the files hashed by this process, keyed by filepath, along with
+# the size and modification time they had. Long-running commands like
+# 'watch' only need to hash the files that changed since.
+file_hashes = {}
+
+
+def get_file_hash(filepath):
+    """
+    Gets the hash of the given file's contents, or None if it doesn't exist.
+    """
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    cached = file_hashes.get(filepath)
+    if cached is not None and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+
+    h = hashlib.sha1()
+    try:
+        with open(filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(0x100000), b""):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    file_hashes[filepath] = ((stat.st_size, stat.st_mtime_ns), h.hexdigest())
+    return h.hexdigest()
+
+
+def get_data_hash(data):
+    """
+    Gets the hash of the given in-memory file contents. It's the same as
+    get_file_hash() for a file with these contents.
+    """
+    return hashlib.sha1(data).hexdigest()
+
+
+def get_config_hash(config):
+    """
+    Gets the hash of a JSON-friendly settings value. Byte strings are
+    hashed as hex.
+    """
+    def encode_bytes(value):
+        if isinstance(value, (bytes, bytearray)):
+            return value.hex()
+        raise TypeError("Can't hash config value of type %s" % type(value).__name__)
+
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=encode_bytes).encode("UTF-8")).hexdigest()
+
+
+def get_record(base_dir, input_filepaths, config):
+    """
+    Gets the manifest record for a file built from the given input files,
+    relative to base_dir, and the given settings. The record's output hash
+    isn't known until the file is written.
+    """
+    return {
+        "inputs": {filepath: get_file_hash(os.path.join(base_dir, filepath)) for filepath in input_filepaths},
+        "config": get_config_hash(config),
+    }
+
+
+def get_data_record(inputs, config):
+    """
+    Gets the manifest record for a file built from in-memory inputs, given
+    as a dict of names to file contents, and the given settings.
+    """
+    return {
+        "inputs": {name: get_data_hash(data) for name, data in inputs.items()},
+        "config": get_config_hash(config),
+    }
+
+
+def get_manifest_filepath(stage_dir, filename=MANIFEST_FILENAME):
+    """
+    Gets the filepath of the build manifest. It lives in the staging
+    directory, since 'apply' only ever copies the game's own files out of it.
+    The setup manifest lives in the working directory instead.
+    """
+    return os.path.join(stage_dir, filename)
+
+
+def load(stage_dir, filename=MANIFEST_FILENAME):
+    """
+    Loads the build manifest. If there isn't one, or it was made by a
+    different version of ToadsTool, then an empty manifest is returned,
+    so everything is rebuilt.
+    """
+    try:
+        with open(get_manifest_filepath(stage_dir, filename)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = None
+    if manifest is None or manifest.get("version") != MANIFEST_VERSION:
+        manifest = {"version": MANIFEST_VERSION}
+    for section in (SECTION_STAGE, SECTION_APPLY, SECTION_SETUP):
+        manifest.setdefault(section, {})
+    return manifest
+
+
+def save(stage_dir, manifest, filename=MANIFEST_FILENAME):
+    """
+    Saves the build manifest. It's written to a temporary file first, so an
+    interrupted build never leaves a partially-written manifest behind.
+    """
+    manifest_filepath = get_manifest_filepath(stage_dir, filename)
+    temp_filepath = manifest_filepath + ".tmp"
+    with open(temp_filepath, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(temp_filepath, manifest_filepath)
+
+
+def get_changes(manifest, section, name, record, output_filepath, read_output=None):
+    """
+    Gets a list of reasons why the named output is out of date, compared to
+    the given record of what it would be built from now. The list is empty
+    if the output is up to date. If read_output is given, the output isn't
+    a file of its own, such as a file inside a disc image. Then, it's called
+    to get the output's contents, or None if it doesn't exist.
+    """
+    entry = manifest[section].get(name)
+    if entry is None:
+        return ["never built"]
+
+    changes = []
+    for filepath, file_hash in sorted(record["inputs"].items()):
+        if entry["inputs"].get(filepath) != file_hash:
+            changes.append("'%s' changed" % filepath)
+    if entry["config"] != record["config"]:
+        changes.append("config changed")
+    output_change = get_output_change(entry, output_filepath, read_output)
+    if output_change is not None:
+        changes.append(output_change)
+    return changes
+
+
+def get_output_change(entry, output_filepath, read_output=None):
+    """
+    Gets the reason why the output no longer matches what the manifest entry
+    recorded, or None if it still does. Outputs that were patched in place
+    have no recorded hash, so any change to their size or modification time
+    counts as a modification. Outputs given by read_output are always hashed.
+    """
+    if read_output is not None:
+        data = read_output()
+        if data is None:
+            return "output is missing"
+        if get_data_hash(data) != entry["output"]:
+            return "output was modified"
+        return None
+
+    try:
+        stat = os.stat(output_filepath)
+    except FileNotFoundError:
+        return "output is missing"
+    if (stat.st_size, stat.st_mtime_ns) != (entry["output_size"], entry["output_mtime"]):
+        if entry["output"] is None or get_file_hash(output_filepath) != entry["output"]:
+            return "output was modified"
+    return None
+
+
+def get_patch_entry(manifest, section, name, record, base_filepath, output_filepath):
+    """
+    Gets the manifest entry of the named output, if it can be brought up to
+    date by patching it in place, or None if it has to be rebuilt. That's the
+    case when it was last built by patching the same base input file, and it
+    hasn't been modified since. The entry's "patch" holds the ranges that
+    were patched last time.
+    """
+    entry = manifest[section].get(name)
+    if entry is None or "patch" not in entry:
+        return None
+    if entry["inputs"].get(base_filepath) != record["inputs"].get(base_filepath):
+        return None
+    if get_output_change(entry, output_filepath) is not None:
+        return None
+    return entry
+
+
+def update(manifest, section, name, record, output_filepath, hash_output=True, output_data=None):
+    """
+    Records that the named output was just built from the given record. If
+    hash_output is False, the output isn't read back to hash it, which is
+    used when it was only patched in place. If output_data is given, it's the
+    contents of an output that isn't a file of its own.
+    """
+    if output_data is not None:
+        manifest[section][name] = dict(record, output=get_data_hash(output_data), output_size=len(output_data), output_mtime=None)
+        return
+
+    stat = os.stat(output_filepath)
+    output_hash = get_file_hash(output_filepath) if hash_output else None
+    manifest[section][name] = dict(record, output=output_hash, output_size=stat.st_size, output_mtime=stat.st_mtime_ns)
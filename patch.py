@@ -0,0 +1,131 @@
+# This file contains logic for patching files in place. A patch is a list of
+# edits to a file, each being bytes to write at an offset, and optionally a
+# new size for the file. Edits are packed with the same struct formats used
+# to write into a buffer, but a patch can also be applied straight to a file
+# on disk through mmap. Then, only the pages holding edited fields are read,
+# and only the ones whose bytes actually change are written back, so the I/O
+# scales with the size of the edits rather than the size of the file.
+
+import bisect
+import mmap
+import os
+import struct
+
+from util import fatal_error
+
+
+def init(size=None):
+    """
+    Gets an initial patch object. If size is given, the patched file is
+    truncated or zero-extended to that many bytes before it's edited.
+    """
+    # edits is an array of (offset, bytes) tuples, applied in order.
+    return {
+        "size": size,
+        "edits": [],
+    }
+
+
+def write(patch, offset, data):
+    """
+    Adds an edit that writes the given bytes at the offset.
+    """
+    patch["edits"].append((offset, bytes(data)))
+
+
+def pack_into(fmt, patch, offset, *values):
+    """
+    Adds an edit that packs the given values at the offset. This works like
+    struct.pack_into(), but for a patch instead of a buffer.
+    """
+    write(patch, offset, struct.pack(fmt, *values))
+
+
+def get_ranges(patch):
+    """
+    Gets the sorted list of [start, end) ranges that the patch writes to.
+    Overlapping and adjacent edits are merged into one range.
+    """
+    ranges = []
+    for offset, data in sorted(patch["edits"]):
+        end = offset + len(data)
+        if len(ranges) > 0 and offset <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([offset, end])
+    return ranges
+
+
+def covers(patch, ranges, old_size, new_size):
+    """
+    Gets whether or not the patch rewrites every byte that an earlier patch,
+    which wrote the given ranges, could have changed. The file was old_size
+    bytes after the earlier patch, and is new_size bytes after this one. If
+    so, applying this patch over the earlier one gives the same file as
+    applying it to the original.
+    """
+    written = get_ranges(patch)
+    starts = [start for start, _ in written]
+    changed = [(start, min(end, new_size)) for start, end in ranges if start < new_size]
+    if new_size > old_size:
+        # The file was extended with zeros, which the patch must fill in.
+        changed.append((old_size, new_size))
+    for start, end in changed:
+        i = bisect.bisect_right(starts, start) - 1
+        if i < 0 or written[i][1] < end:
+            return False
+    return True
+
+
+def check_edit_bounds(offset, data, size):
+    """
+    Checks that an edit fits inside a file of the given size. If it doesn't,
+    then the program is terminated.
+    """
+    if offset < 0 or offset + len(data) > size:
+        fatal_error("Patch of %s bytes at offset 0x%X is outside the file's 0x%X bytes." % (len(data), offset, size))
+
+
+def apply(patch, buff):
+    """
+    Applies the patch to a bytearray, in place.
+    """
+    if patch["size"] is not None:
+        if len(buff) < patch["size"]:
+            buff.extend(bytes(patch["size"] - len(buff)))
+        else:
+            del buff[patch["size"]:]
+    for offset, data in patch["edits"]:
+        check_edit_bounds(offset, data, len(buff))
+        buff[offset:offset + len(data)] = data
+
+
+def apply_to_file(patch, filepath):
+    """
+    Applies the patch to a file on disk, in place. Edits that wouldn't change
+    the file's contents aren't written. Returns the number of bytes changed.
+    """
+    with open(filepath, "r+b") as f:
+        size = os.fstat(f.fileno()).st_size
+        if patch["size"] is not None and patch["size"] != size:
+            f.truncate(patch["size"])
+            size = patch["size"]
+        if size == 0:
+            # Empty files can't be mapped, and there's nothing to edit.
+            for offset, data in patch["edits"]:
+                check_edit_bounds(offset, data, size)
+            return 0
+
+        num_changed = 0
+        with mmap.mmap(f.fileno(), 0) as mapped:
+            for offset, data in patch["edits"]:
+                check_edit_bounds(offset, data, size)
+                end = offset + len(data)
+                if mapped[offset:end] != data:
+                    mapped[offset:end] = data
+                    num_changed += len(data)
+            # Flush the edited pages now, so the file's modification time
+            # is settled before it's recorded in the build manifest.
+            if num_changed > 0:
+                mapped.flush()
+    return num_changed
@@ -0,0 +1,147 @@
+# This file contains logic for reading and writing tables of binary records,
+# such as the character stats tables in the overlays, using record schemas
+# declared in tt_config. A schema lists a record's fields in order, along
+# with their struct format characters, so adding a new table only needs a
+# schema:
+#    {
+#        "name": string, unique among schemas,
+#        "byte_order": struct byte order character, such as ">",
+#        "size": int, the size of one record in bytes,
+#        "count_type": optional struct format character of a record count
+#                      that comes right before the table,
+#        "fields": array of {
+#            "name": string,
+#            "type": struct format character,
+#            "values": optional array of names for the values 0, 1, 2...,
+#                      where larger values get the last name, like the
+#                      game treats any nonzero curve direction as fade,
+#        },
+#    }
+# Each schema is compiled into a struct.Struct once. Whole tables are then
+# decoded with one iter_unpack() call, and encoded with one pack() call.
+
+import struct
+
+from util import fatal_error
+
+# Compiled schemas, keyed by schema name.
+compiled_schemas = {}
+
+# Compiled structs for whole tables, keyed by (schema name, record count).
+table_structs = {}
+
+
+def compile_schema(schema):
+    """
+    Gets the compiled form of a record schema, compiling it if this is the
+    first time it's used. The compiled schema is a dict of shape:
+        {
+            "schema": the record schema,
+            "struct": struct.Struct of one record,
+            "count_struct": struct.Struct of the record count, or None,
+            "names": array of the field names,
+            "enums": array of the fields with named values,
+        }
+    """
+    if schema["name"] in compiled_schemas:
+        return compiled_schemas[schema["name"]]
+
+    record_format = schema["byte_order"] + "".join(field["type"] for field in schema["fields"])
+    record_struct = struct.Struct(record_format)
+    if record_struct.size != schema["size"]:
+        fatal_error("Record schema '%s' is 0x%X bytes, but should be 0x%X bytes." % (schema["name"], record_struct.size, schema["size"]))
+    count_struct = None
+    if "count_type" in schema:
+        count_struct = struct.Struct(schema["byte_order"] + schema["count_type"])
+
+    compiled = {
+        "schema": schema,
+        "struct": record_struct,
+        "count_struct": count_struct,
+        "names": [field["name"] for field in schema["fields"]],
+        "enums": [field for field in schema["fields"] if "values" in field],
+    }
+    compiled_schemas[schema["name"]] = compiled
+    return compiled
+
+
+def get_table_struct(schema, count):
+    """
+    Gets a struct.Struct for a table of `count` records, so the whole table
+    can be packed in one call.
+    """
+    key = (schema["name"], count)
+    if key not in table_structs:
+        table_structs[key] = struct.Struct(schema["byte_order"] + compile_schema(schema)["struct"].format[1:] * count)
+    return table_structs[key]
+
+
+def decode_record(compiled, values):
+    """
+    Converts a tuple of a record's unpacked values into a dict of its fields.
+    """
+    record = dict(zip(compiled["names"], values))
+    for field in compiled["enums"]:
+        record[field["name"]] = field["values"][min(record[field["name"]], len(field["values"]) - 1)]
+    return record
+
+
+def encode_record(compiled, record):
+    """
+    Converts a dict of a record's fields into a list of values to pack.
+    Keys that aren't fields of the schema are ignored.
+    """
+    try:
+        values = [record[name] for name in compiled["names"]]
+    except KeyError as e:
+        fatal_error("'%s' record is missing %s." % (compiled["schema"]["name"], e))
+    for field in compiled["enums"]:
+        i = compiled["names"].index(field["name"])
+        if values[i] not in field["values"]:
+            fatal_error("Invalid value '%s' for '%s'. Expected one of: %s" % (values[i], field["name"], ", ".join(field["values"])))
+        values[i] = field["values"].index(values[i])
+    return values
+
+
+def unpack_table(schema, data, offset=0, count=None):
+    """
+    Reads a table of records from the data at the given offset. Returns a
+    list of dicts of the records' fields. If the schema has a record count,
+    it's read from the data, and count doesn't need to be given.
+    """
+    compiled = compile_schema(schema)
+    if compiled["count_struct"] is not None:
+        count = compiled["count_struct"].unpack_from(data, offset)[0]
+        offset += compiled["count_struct"].size
+    end = offset + compiled["struct"].size * count
+    if end > len(data):
+        fatal_error("'%s' table of %s records at offset 0x%X runs past the end of the data." % (schema["name"], count, offset))
+    # The view is released right away, so mapped data can be closed after.
+    with memoryview(data)[offset:end] as view:
+        return [decode_record(compiled, values) for values in compiled["struct"].iter_unpack(view)]
+
+
+def pack_table(schema, records):
+    """
+    Gets the bytes of a table of the given records, which are dicts of their
+    fields. If the schema has a record count, it's written first.
+    """
+    compiled = compile_schema(schema)
+    values = []
+    for record in records:
+        values.extend(encode_record(compiled, record))
+
+    try:
+        data = get_table_struct(schema, len(records)).pack(*values)
+    except struct.error:
+        # Find the record that doesn't fit, to point to it in the error.
+        for i, record in enumerate(records):
+            try:
+                compiled["struct"].pack(*encode_record(compiled, record))
+            except struct.error as e:
+                fatal_error("Can't write '%s' record %s: %s" % (schema["name"], i, e))
+        raise
+
+    if compiled["count_struct"] is not None:
+        data = compiled["count_struct"].pack(len(records)) + data
+    return data
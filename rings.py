@@ -0,0 +1,201 @@
+# This file contains logic for transforming Ring Attack rings in bulk, such
+# as moving, scaling or rotating every ring of a course at once, for the
+# 'rings transform' command.
+#
+# The rings of every selected hole are loaded into one table, with a row of
+# 7 values per ring, in the order of the ring record's fields (x, y, z,
+# rotationX, rotationY, scaleX, scaleY). Then the transform is applied to
+# every row at once:
+#   1. The ring positions are scaled and rotated around a pivot, which is
+#      each hole's center (the average of its ring positions) by default.
+#   2. The ring positions are translated.
+#   3. The rings' own rotations are offset, and their sizes are scaled and
+#      clamped.
+# The results are rounded to 32-bit floats, since that's how the game's
+# files store them, so the JSON files hold exactly what will be built.
+#
+# If NumPy is installed, the table is transformed with vectorized operations.
+# Otherwise, it's transformed one row at a time. Both do the same floating
+# point operations in the same order, so the results are identical.
+
+import math
+import struct
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import tt_config
+from util import fatal_error
+
+RING_FIELDS = [field["name"] for field in tt_config.ring_attack_ring_record["fields"]]
+
+# The largest value a 32-bit float can hold.
+FLOAT32_MAX = struct.unpack(">f", b"\x7f\x7f\xff\xff")[0]
+
+
+def is_numpy_available():
+    """
+    Gets whether or not NumPy is installed.
+    """
+    return np is not None
+
+
+def init_transform(translate=None, scale=None, rotate=None, pivot=None, ring_rotate=None, ring_scale=None, clamp_scale=None):
+    """
+    Gets a transform object. Every argument is optional:
+        translate: (x, y, z) to add to the ring positions
+        scale: (x, y, z) to multiply the ring positions by, around the pivot
+        rotate: degrees to rotate the ring positions by around the vertical
+                (y) axis, around the pivot
+        pivot: (x, y, z) to scale and rotate around. Defaults to each
+               hole's center
+        ring_rotate: (x, y) to add to the rings' rotationX and rotationY
+        ring_scale: (x, y) to multiply the rings' scaleX and scaleY by
+        clamp_scale: (min, max) to clamp the rings' scaleX and scaleY to
+    """
+    scale = (1.0, 1.0, 1.0) if scale is None else scale
+    angle = math.radians(0.0 if rotate is None else rotate)
+    rotation = [
+        [math.cos(angle), 0.0, math.sin(angle)],
+        [0.0, 1.0, 0.0],
+        [-math.sin(angle), 0.0, math.cos(angle)],
+    ]
+    if clamp_scale is not None and clamp_scale[0] > clamp_scale[1]:
+        fatal_error("Invalid scale clamp range %s to %s." % tuple(clamp_scale))
+
+    # matrix is the rotation times the scale, applied to positions relative
+    # to the pivot.
+    return {
+        "matrix": [[rotation[row][col] * scale[col] for col in range(3)] for row in range(3)],
+        "translate": (0.0, 0.0, 0.0) if translate is None else tuple(translate),
+        "pivot": None if pivot is None else tuple(pivot),
+        "ring_rotate": (0.0, 0.0) if ring_rotate is None else tuple(ring_rotate),
+        "ring_scale": (1.0, 1.0) if ring_scale is None else tuple(ring_scale),
+        "clamp_scale": None if clamp_scale is None else tuple(clamp_scale),
+    }
+
+
+def get_hole_course(hole):
+    """
+    Gets the name of the course that a Ring Attack hole belongs to.
+    """
+    return hole["file"].split("/")[0]
+
+
+def get_hole_number(hole):
+    """
+    Gets a Ring Attack hole's number within its course, starting from 0.
+    """
+    return int(hole["file"].rsplit("_", 1)[1].split(".")[0])
+
+
+def select_holes(courses=None, hole_numbers=None):
+    """
+    Gets the Ring Attack holes in the given courses, with the given hole
+    numbers. Either can be None to select every course or hole number.
+    """
+    known_courses = []
+    for hole in tt_config.ring_attack_holes:
+        if get_hole_course(hole) not in known_courses:
+            known_courses.append(get_hole_course(hole))
+    for course in courses if courses is not None else []:
+        if course not in known_courses:
+            fatal_error("Unknown course '%s'. Valid courses are: %s" % (course, ", ".join(known_courses)))
+
+    holes = []
+    for hole in tt_config.ring_attack_holes:
+        if courses is not None and get_hole_course(hole) not in courses:
+            continue
+        if hole_numbers is not None and get_hole_number(hole) not in hole_numbers:
+            continue
+        holes.append(hole)
+    return holes
+
+
+def transform_table(rows, hole_indexes, num_holes, transform):
+    """
+    Transforms a table of rings. rows is a flat list of the rings' values,
+    7 per ring, and hole_indexes is the index of the hole that each ring
+    belongs to. Returns the transformed rows in the same form, rounded to
+    32-bit floats.
+    """
+    if is_numpy_available():
+        rows = transform_table_numpy(rows, hole_indexes, num_holes, transform)
+    else:
+        rows = transform_table_python(rows, hole_indexes, num_holes, transform)
+
+    if any(not abs(value) <= FLOAT32_MAX for value in rows):
+        fatal_error("Transformed rings are out of range for the game's 32-bit floats.")
+    return list(struct.unpack(">%sf" % len(rows), struct.pack(">%sf" % len(rows), *rows)))
+
+
+def get_pivots_python(rows, hole_indexes, num_holes, transform):
+    """
+    Gets the pivot of each hole.
+    """
+    if transform["pivot"] is not None:
+        return [transform["pivot"]] * num_holes
+    sums = [[0.0, 0.0, 0.0] for _ in range(num_holes)]
+    counts = [0] * num_holes
+    for i, hole_index in enumerate(hole_indexes):
+        for col in range(3):
+            sums[hole_index][col] += rows[i * 7 + col]
+        counts[hole_index] += 1
+    return [[value / max(1, count) for value in hole_sums] for hole_sums, count in zip(sums, counts)]
+
+
+def transform_table_python(rows, hole_indexes, num_holes, transform):
+    """
+    Transforms a table of rings one ring at a time.
+    """
+    pivots = get_pivots_python(rows, hole_indexes, num_holes, transform)
+    matrix = transform["matrix"]
+    translate = transform["translate"]
+    ring_rotate = transform["ring_rotate"]
+    ring_scale = transform["ring_scale"]
+    clamp_scale = transform["clamp_scale"]
+    out = []
+    for i, hole_index in enumerate(hole_indexes):
+        row = rows[i * 7:i * 7 + 7]
+        pivot = pivots[hole_index]
+        offsets = [row[col] - pivot[col] for col in range(3)]
+        for col in range(3):
+            out.append(matrix[col][0] * offsets[0] + matrix[col][1] * offsets[1] + matrix[col][2] * offsets[2] + pivot[col] + translate[col])
+        for col in range(2):
+            out.append(row[3 + col] + ring_rotate[col])
+        for col in range(2):
+            value = row[5 + col] * ring_scale[col]
+            if clamp_scale is not None:
+                value = min(max(value, clamp_scale[0]), clamp_scale[1])
+            out.append(value)
+    return out
+
+
+def transform_table_numpy(rows, hole_indexes, num_holes, transform):
+    """
+    Transforms a table of rings with vectorized NumPy operations.
+    """
+    table = np.array(rows, dtype=np.float64).reshape(-1, 7)
+    indexes = np.array(hole_indexes, dtype=np.intp)
+    if transform["pivot"] is not None:
+        pivots = np.tile(np.array(transform["pivot"], dtype=np.float64), (num_holes, 1))
+    else:
+        # bincount() adds up the values in order, like the pure-Python sums.
+        counts = np.maximum(np.bincount(indexes, minlength=num_holes), 1)
+        pivots = np.stack([np.bincount(indexes, weights=table[:, col], minlength=num_holes) / counts for col in range(3)], axis=1)
+    pivot_rows = pivots[indexes]
+
+    matrix = transform["matrix"]
+    translate = transform["translate"]
+    offsets = [table[:, col] - pivot_rows[:, col] for col in range(3)]
+    out = np.empty_like(table)
+    for col in range(3):
+        out[:, col] = matrix[col][0] * offsets[0] + matrix[col][1] * offsets[1] + matrix[col][2] * offsets[2] + pivot_rows[:, col] + translate[col]
+    for col in range(2):
+        out[:, 3 + col] = table[:, 3 + col] + transform["ring_rotate"][col]
+        out[:, 5 + col] = table[:, 5 + col] * transform["ring_scale"][col]
+    if transform["clamp_scale"] is not None:
+        out[:, 5:7] = np.minimum(np.maximum(out[:, 5:7], transform["clamp_scale"][0]), transform["clamp_scale"][1])
+    return out.ravel().tolist()
@@ -0,0 +1,199 @@
+import pytest
+
+import benchmark
+import compression
+
+LEVELS = compression.COMPRESS_LEVELS
+WINDOW_SIZES = [1, 0x100, compression.LZ_MAX_WINDOW_SIZE]
+MAX_CHAINS = [1, 16, compression.LZ_MAX_CHAIN]
+
+
+@pytest.fixture(scope="module")
+def overlay_data():
+    return benchmark.make_overlay_data(0x2000)
+
+
+@pytest.mark.parametrize("level", LEVELS)
+@pytest.mark.parametrize("window_size", WINDOW_SIZES)
+@pytest.mark.parametrize("max_chain", MAX_CHAINS)
+def test_round_trip(overlay_data, level, window_size, max_chain):
+    compressed = compression.compress(overlay_data, window_size=window_size, max_chain=max_chain, level=level)
+    assert compression.get_decompressed_size(compressed) == len(overlay_data)
+    assert compression.decompress(compressed) == overlay_data
+
+
+@pytest.mark.parametrize("level", LEVELS)
+@pytest.mark.parametrize("data", [
+    b"",
+    b"\x01",
+    b"\x01\x02\x03",
+    bytes(0x1000),
+    b"abc" * 0x300,
+    bytes(range(256)) * 20,
+])
+def test_round_trip_edge_cases(level, data):
+    compressed = compression.compress(data, level=level)
+    assert compression.decompress(compressed) == data
+
+
+def test_levels_compress_better(overlay_data):
+    sizes = [len(compression.compress(overlay_data, level=level)) for level in LEVELS]
+    assert sizes == sorted(sizes, reverse=True)
+    assert sizes[0] < len(overlay_data)
+
+
+def test_larger_window_compresses_better(overlay_data):
+    sizes = [len(compression.compress(overlay_data, window_size=window_size)) for window_size in WINDOW_SIZES]
+    assert sizes == sorted(sizes, reverse=True)
+
+
+def test_invalid_settings(overlay_data):
+    with pytest.raises(SystemExit):
+        compression.compress(overlay_data, level="fastest")
+    with pytest.raises(SystemExit):
+        compression.compress(overlay_data, window_size=compression.LZ_MAX_WINDOW_SIZE + 1)
+
+
+def test_decompress_overlapping_copies():
+    # Runs are copied from just before themselves, so the copies overlap the
+    # bytes they're writing.
+    data = b"\x00" * 0x800 + b"ab" * 0x400 + b"abc" * 0x155 + b"\xFF"
+    compressed = compression.compress(data)
+    assert len(compressed) < len(data) // 8
+    assert compression.decompress(compressed) == data
+
+
+def test_decompress_returns_bytearray(overlay_data):
+    decompressed = compression.decompress(compression.compress(overlay_data))
+    assert isinstance(decompressed, bytearray)
+
+
+def test_decompress_matches_iter_decompress():
+    data = benchmark.make_overlay_data(0x30000)
+    compressed = compression.compress(data)
+    chunks = list(compression.iter_decompress(compressed))
+    assert len(chunks) > 1
+    assert b"".join(chunks) == compression.decompress(compressed) == data
+
+
+def test_decompress_wrong_size():
+    compressed = bytearray(compression.compress(b"hello hello hello"))
+    compressed[3] += 1
+    with pytest.raises(SystemExit) as excinfo:
+        compression.decompress(compressed)
+    assert "header says 18 bytes" in str(excinfo.value.code)
+
+
+def test_decompress_no_header():
+    with pytest.raises(SystemExit):
+        compression.decompress(b"\x01\x00")
+
+
+def edit(data, offset, new_bytes):
+    return data[:offset] + new_bytes + data[offset + len(new_bytes):]
+
+
+@pytest.fixture(scope="module")
+def large_data():
+    return benchmark.make_overlay_data(3 * compression.LZ_MIN_SEGMENT_SIZE)
+
+
+@pytest.mark.parametrize("level", LEVELS)
+def test_parallel_matches_serial(large_data, level):
+    serial = compression.compress(large_data, level=level)
+    parallel = compression.compress(large_data, level=level, workers=3)
+    assert compression.decompress(parallel) == large_data
+    # Matches can't cross segments, so the output can be slightly larger.
+    assert len(parallel) <= len(serial) * 1.01
+
+
+@pytest.mark.parametrize("edits", [
+    [],
+    [(0x100, b"\x12\x34\x56\x78")],
+    [(0x18000, b"\xFF" * 0x40), (0x2F000, b"edited")],
+    [(0, b"\x00" * 0x1000)],
+])
+def test_incremental_matches_parallel(large_data, edits):
+    _, stream = compression.compress_incremental(large_data)
+    data = large_data
+    for offset, new_bytes in edits:
+        data = edit(data, offset, new_bytes)
+
+    incremental, new_stream = compression.compress_incremental(data, stream)
+    parallel = compression.compress(data, workers=3)
+    assert compression.decompress(incremental) == compression.decompress(parallel) == data
+    assert new_stream["data"] == data
+
+    # The new stream can be reused for the next edit.
+    data = edit(data, 0x20000, b"again")
+    incremental, _ = compression.compress_incremental(data, new_stream)
+    assert compression.decompress(incremental) == data
+
+
+def test_incremental_insert_and_delete(large_data):
+    _, stream = compression.compress_incremental(large_data)
+    for data in [
+        large_data[:0x8000] + b"inserted" + large_data[0x8000:],
+        large_data[:0x8000] + large_data[0x8100:],
+        large_data + b"\x00" * 0x100,
+        large_data[:-0x100],
+    ]:
+        incremental, _ = compression.compress_incremental(data, stream)
+        assert compression.decompress(incremental) == data
+
+
+def test_incremental_ignores_other_settings(large_data):
+    _, stream = compression.compress_incremental(large_data, window_size=0x100)
+    data = edit(large_data, 0x100, b"edit")
+    incremental, new_stream = compression.compress_incremental(data, stream)
+    assert incremental == compression.compress(data)
+    assert new_stream["window_size"] == compression.LZ_WINDOW_SIZE
+
+
+@pytest.mark.parametrize("level", LEVELS)
+@pytest.mark.parametrize("window_size, max_chain", [
+    (compression.LZ_WINDOW_SIZE, compression.LZ_MAX_CHAIN),
+    (WINDOW_SIZES[1], MAX_CHAINS[1]),
+])
+def test_numpy_backend_matches_python(overlay_data, level, window_size, max_chain):
+    pytest.importorskip("numpy")
+    python_output = compression.compress(overlay_data, window_size=window_size, max_chain=max_chain, level=level, backend="python")
+    numpy_output = compression.compress(overlay_data, window_size=window_size, max_chain=max_chain, level=level, backend="numpy")
+    assert numpy_output == python_output
+
+
+@pytest.mark.parametrize("level", LEVELS)
+def test_budget_round_trip(level):
+    data = benchmark.make_overlay_data(0x8000)
+    stats = {}
+    compressed = compression.compress(data, level=level, time_budget=10, stats=stats)
+    assert compression.decompress(compressed) == data
+    assert sum(stats["effort_bytes"].values()) == len(data)
+
+
+@pytest.mark.parametrize("level", LEVELS)
+def test_budget_is_respected(level):
+    # More data than can be compressed at the requested level in time. Even
+    # one segment at the requested level would take longer than the budget.
+    data = benchmark.make_overlay_data(0x20000)
+    time_budget = 0.1
+    stats = {}
+    compressed = compression.compress(data, level=level, time_budget=time_budget, stats=stats)
+    assert stats["seconds"] < time_budget * 2
+    assert sum(stats["effort_bytes"].values()) == len(data)
+    assert compression.decompress(compressed) == data
+
+
+def test_budget_invalid():
+    with pytest.raises(SystemExit):
+        compression.compress(b"data", time_budget=0)
+
+
+def test_budget_uses_spare_time():
+    # With plenty of time, most of the data gets the requested level, even
+    # though compression starts with the least effort.
+    data = benchmark.make_overlay_data(0x8000)
+    stats = {}
+    compression.compress(data, level=compression.COMPRESS_LEVEL_OPTIMAL, time_budget=60, stats=stats)
+    name = "%s/%s/%s" % (compression.COMPRESS_LEVEL_OPTIMAL, compression.LZ_WINDOW_SIZE, compression.LZ_MAX_CHAIN)
+    assert stats["effort_bytes"][name] >= len(data) // 2
@@ -0,0 +1,51 @@
+import pytest
+
+import benchmark
+import compression
+import compression_cache
+
+
+@pytest.fixture
+def cache_dir(tmp_path):
+    yield str(tmp_path / "cache")
+    compression_cache.clear(str(tmp_path / "cache"))
+
+
+def test_cached_result(cache_dir):
+    data = benchmark.make_overlay_data(0x2000)
+    compressed, cached = compression_cache.compress(data, cache_dir)
+    assert compressed == compression.compress(data)
+    assert not cached
+    assert compression_cache.compress(data, cache_dir) == (compressed, True)
+
+
+def test_incremental_results_are_kept_apart(cache_dir):
+    # The incremental result depends on the stream saved for the first
+    # version, so it's not used for plain compression of the second version,
+    # or for incremental compression from another stream.
+    data = benchmark.make_overlay_data(0x2000)
+    edited = data[:0x1000] + b"edited" + data[0x1000:]
+    compression_cache.compress(data, cache_dir, stream_name="a.bin")
+    incremental, cached = compression_cache.compress(edited, cache_dir, stream_name="a.bin")
+    assert compression.decompress(incremental) == edited
+    assert not cached
+
+    compressed, cached = compression_cache.compress(edited, cache_dir)
+    assert compressed == compression.compress(edited)
+    assert not cached
+    _, base_stream = compression.compress_incremental(edited[:0x1800])
+    compressed, cached = compression_cache.compress(edited, cache_dir, base_stream=base_stream)
+    assert compressed == compression.compress_incremental(edited, base_stream)[0]
+    assert not cached
+    assert compression_cache.compress(edited, cache_dir, base_stream=base_stream) == (compressed, True)
+
+
+def test_evict(cache_dir):
+    data = benchmark.make_overlay_data(0x2000)
+    compression_cache.compress(data, cache_dir, stream_name="a.bin")
+    stats = compression_cache.get_stats(cache_dir)
+    assert (stats["entries"], stats["streams"]) == (1, 1)
+
+    assert compression_cache.evict(cache_dir, max_size=0) == 2
+    assert compression_cache.get_stats(cache_dir) == {"entries": 0, "streams": 0, "size": 0}
+    assert compression_cache.load_stream(cache_dir, "a.bin") is None
@@ -0,0 +1,101 @@
+import random
+import time
+
+import pytest
+
+import delta
+
+
+def make_data(size, seed=0):
+    rng = random.Random(seed)
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+def test_apply_entry_round_trip():
+    source = make_data(0x4000)
+    target = bytearray(source)
+    target[0x100:0x104] = b"\x12\x34\x56\x78"
+    target[0x2000:0x2000] = b"inserted bytes"
+    del target[0x3000:0x3040]
+    target = bytes(target)
+
+    entry = delta.make_entry("sys/main.dol", source, target)
+    assert len(entry["delta"]) < 0x100
+    assert delta.apply_entry(entry, source) == target
+    assert delta.is_patched(entry, target)
+    assert not delta.is_patched(entry, source)
+
+
+def test_apply_entry_moved_and_new_data():
+    source = make_data(0x2000, seed=1)
+    target = source[0x1000:] + make_data(0x80, seed=2) + source[:0x1000]
+    entry = delta.make_entry("files/a.bin", source, target)
+    assert delta.apply_entry(entry, source) == target
+
+
+
+def test_apply_entry_run_after_new_data():
+    # The unchanged run is at an odd offset, after more new data than is
+    # checked byte by byte.
+    source = make_data(0x4000, seed=3)
+    target = make_data(0x1003, seed=4) + source[0x1000:0x3000]
+    entry = delta.make_entry("files/a.bin", source, target)
+    assert len(entry["delta"]) < 0x1003 + 0x20
+    assert delta.apply_entry(entry, source) == target
+
+
+def test_get_delta_random_target_time():
+    rng = random.Random(5)
+    source = rng.randbytes(0x400000)
+    target = rng.randbytes(0x400000)
+    start = time.perf_counter()
+    target_delta = delta.get_delta(source, target)
+    assert time.perf_counter() - start < 1.0
+    assert delta.apply_delta(source, target_delta) == target
+
+
+def test_apply_entry_empty_files():
+    entry = delta.make_entry("files/empty.bin", b"", b"new")
+    assert delta.apply_entry(entry, b"") == b"new"
+    entry = delta.make_entry("files/empty.bin", b"old", b"")
+    assert delta.apply_entry(entry, b"old") == b""
+
+
+def test_apply_entry_wrong_source():
+    source = make_data(0x1000)
+    entry = delta.make_entry("files/a.bin", source, source[:0x800] + b"edit" + source[0x800:])
+
+    edited = bytearray(source)
+    edited[0x10] ^= 0xFF
+    with pytest.raises(SystemExit):
+        delta.apply_entry(entry, bytes(edited))
+    with pytest.raises(SystemExit):
+        delta.apply_entry(entry, source[:-1])
+
+
+def test_apply_entry_wrong_source_message():
+    entry = delta.make_entry("files/a.bin", b"original", b"patched")
+    with pytest.raises(SystemExit) as excinfo:
+        delta.apply_entry(entry, b"not the original")
+    assert "'files/a.bin' isn't the file this patch was made from" in str(excinfo.value.code)
+
+
+def test_save_load(tmp_path):
+    source = make_data(0x1000)
+    entries = [
+        delta.make_entry("sys/main.dol", source, source + b"tail"),
+        delta.make_entry("files/é.bin", b"", source),
+    ]
+    filepath = str(tmp_path / "mod.ttp")
+    delta.save(filepath, entries)
+    loaded = delta.load(filepath)
+    assert [entry["filepath"] for entry in loaded] == ["sys/main.dol", "files/é.bin"]
+    assert delta.apply_entry(loaded[0], source) == source + b"tail"
+    assert delta.apply_entry(loaded[1], b"") == source
+
+
+def test_load_not_a_patch(tmp_path):
+    filepath = tmp_path / "mod.ttp"
+    filepath.write_bytes(b"not a patch")
+    with pytest.raises(SystemExit):
+        delta.load(str(filepath))
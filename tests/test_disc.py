@@ -0,0 +1,145 @@
+import os
+import struct
+
+import pytest
+
+import disc
+
+IMAGE_SIZE = 0x8000
+DOL_OFFSET = 0x3000
+FST_OFFSET = 0x4000
+
+# The files of the fake image, as (filepath, offset, contents). a.bin is
+# right before dir/b.bin, so it can't grow in place, but c.bin can.
+FILES = [
+    ("files/a.bin", 0x5000, b"\x0a" * 0x100),
+    ("files/dir/b.bin", 0x5100, b"\x0b" * 0x100),
+    ("files/c.bin", 0x6000, b"\x0c" * 0x80),
+]
+
+
+def make_image(filepath):
+    """
+    Writes a small disc image with a disc header, an apploader, a .dol with
+    one section, and an FST of the files in FILES.
+    """
+    data = bytearray(IMAGE_SIZE)
+    struct.pack_into(">I", data, disc.DISC_MAGIC_OFFSET, disc.DISC_MAGIC)
+    struct.pack_into(">II", data, disc.APPLOADER_OFFSET + 0x14, 0x20, 0)
+
+    struct.pack_into(">I", data, DOL_OFFSET, 0x100)
+    struct.pack_into(">I", data, DOL_OFFSET + disc.DOL_SECTION_SIZES_OFFSET, 0x100)
+    data[DOL_OFFSET + 0x100:DOL_OFFSET + 0x200] = b"\xd0" * 0x100
+
+    # Root, a.bin, dir/, dir/b.bin, c.bin.
+    names = b"a.bin\0dir\0b.bin\0c.bin\0"
+    entries = [
+        (0x01000000, 0, 5),
+        (0x00000000, FILES[0][1], len(FILES[0][2])),
+        (0x01000006, 0, 4),
+        (0x0000000A, FILES[1][1], len(FILES[1][2])),
+        (0x00000010, FILES[2][1], len(FILES[2][2])),
+    ]
+    fst = b"".join(struct.pack(">III", *entry) for entry in entries) + names
+    data[FST_OFFSET:FST_OFFSET + len(fst)] = fst
+    struct.pack_into(">III", data, disc.HEADER_DOL_OFFSET, DOL_OFFSET, FST_OFFSET, len(fst))
+
+    for _, offset, contents in FILES:
+        data[offset:offset + len(contents)] = contents
+    with open(filepath, "wb") as f:
+        f.write(data)
+
+
+@pytest.fixture
+def image_filepath(tmp_path):
+    filepath = str(tmp_path / "game.iso")
+    make_image(filepath)
+    return filepath
+
+
+def read_all(filepath):
+    """
+    Reopens the image and reads every file from it.
+    """
+    image = disc.open_image(filepath)
+    files = {filepath: bytes(disc.read_file(image, filepath)) for filepath in image["files"]}
+    entries = {filepath: dict(entry) for filepath, entry in image["files"].items()}
+    disc.close(image)
+    return files, entries
+
+
+def test_open_image(image_filepath):
+    assert disc.is_image(image_filepath)
+    files, entries = read_all(image_filepath)
+    for filepath, offset, contents in FILES:
+        assert files[filepath] == contents
+        assert entries[filepath]["offset"] == offset
+    assert entries["sys/main.dol"]["offset"] == DOL_OFFSET
+    assert len(files["sys/main.dol"]) == 0x200
+    assert len(files["sys/apploader.img"]) == 0x40
+
+
+def test_not_an_image(tmp_path):
+    filepath = str(tmp_path / "game.iso")
+    with open(filepath, "wb") as f:
+        f.write(bytes(0x100))
+    assert not disc.is_image(filepath)
+    assert not disc.is_image(str(tmp_path))
+    with pytest.raises(SystemExit):
+        disc.open_image(filepath)
+
+
+def test_write_in_place(image_filepath):
+    image = disc.open_image(image_filepath)
+    moved = disc.write_files(image, {"files/a.bin": b"\x1a" * 0x100, "files/c.bin": b"\x1c" * 0x200})
+    disc.close(image)
+
+    assert moved == []
+    assert os.path.getsize(image_filepath) == IMAGE_SIZE
+    files, entries = read_all(image_filepath)
+    assert files["files/a.bin"] == b"\x1a" * 0x100
+    assert files["files/dir/b.bin"] == FILES[1][2]
+    assert files["files/c.bin"] == b"\x1c" * 0x200
+    assert entries["files/a.bin"]["offset"] == FILES[0][1]
+    assert entries["files/c.bin"]["offset"] == FILES[2][1]
+
+
+def test_write_relocated(image_filepath):
+    image = disc.open_image(image_filepath)
+    moved = disc.write_files(image, {"files/a.bin": b"\x1a" * 0x101})
+    # The image object is remapped, and points to the file's new location.
+    assert bytes(disc.read_file(image, "files/a.bin")) == b"\x1a" * 0x101
+    disc.close(image)
+
+    assert moved == ["files/a.bin"]
+    files, entries = read_all(image_filepath)
+    assert files["files/a.bin"] == b"\x1a" * 0x101
+    assert files["files/dir/b.bin"] == FILES[1][2]
+    # Moved files are aligned, and the only free space is past the end of
+    # the image, so it grows.
+    assert entries["files/a.bin"]["offset"] == IMAGE_SIZE
+    assert os.path.getsize(image_filepath) == IMAGE_SIZE + 0x101
+
+
+def test_write_main_dol(image_filepath):
+    image = disc.open_image(image_filepath)
+    dol = bytearray(disc.read_file(image, "sys/main.dol"))
+    moved = disc.write_files(image, {"sys/main.dol": dol + bytes(0x1000)})
+    disc.close(image)
+
+    assert moved == ["sys/main.dol"]
+    files, entries = read_all(image_filepath)
+    assert entries["sys/main.dol"]["offset"] == IMAGE_SIZE
+    with open(image_filepath, "rb") as f:
+        f.seek(disc.HEADER_DOL_OFFSET)
+        assert struct.unpack(">I", f.read(4))[0] == IMAGE_SIZE
+    assert files["sys/main.dol"][:0x200] == dol
+
+
+def test_write_invalid_files(image_filepath):
+    image = disc.open_image(image_filepath)
+    with pytest.raises(SystemExit):
+        disc.write_files(image, {"files/missing.bin": b""})
+    with pytest.raises(SystemExit):
+        disc.write_files(image, {"sys/fst.bin": b""})
+    disc.close(image)
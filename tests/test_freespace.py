@@ -0,0 +1,102 @@
+import pytest
+
+import freespace
+
+SECTOR_A = {"address": 0x80100000, "size": 0x40, "dol_section": 8}
+SECTOR_B = {"address": 0x80200002, "size": 0x20, "dol_section": 9}
+
+
+def get_addresses(layout):
+    return [alloc["address"] for alloc in layout["allocs"]]
+
+
+def test_identical_data_is_shared():
+    space = freespace.init([SECTOR_A])
+    freespace.alloc(space, b"\x01\x02\x03\x04", 0x10)
+    freespace.alloc(space, b"\x05\x06", 0x20)
+    freespace.alloc(space, b"\x01\x02\x03\x04", 0x30, alignment=4)
+    layout = freespace.get_layout(space)
+
+    assert get_addresses(layout) == [0x80100000, 0x80100004, 0x80100000]
+    assert [alloc["pointer"] for alloc in layout["allocs"]] == [0x10, 0x20, 0x30]
+    assert layout["sectors"][0]["data"] == b"\x01\x02\x03\x04\x05\x06"
+    assert layout["sectors"][0]["num_blocks"] == 2
+    assert layout["requested_size"] == 10
+
+
+def test_string_suffixes_are_merged():
+    space = freespace.init([SECTOR_A])
+    freespace.alloc_string(space, b"Rings\x00", 0x10)
+    freespace.alloc_string(space, b"Ring Attack: Rings\x00", 0x20)
+    freespace.alloc_string(space, b"\x00", 0x30)
+    layout = freespace.get_layout(space)
+
+    long_address = layout["allocs"][1]["address"]
+    assert get_addresses(layout) == [long_address + 13, long_address, long_address + 18]
+    assert layout["sectors"][0]["data"] == b"Ring Attack: Rings\x00"
+    assert layout["sectors"][0]["num_blocks"] == 1
+
+
+def test_strings_and_data_are_kept_apart():
+    # Only strings can point into other strings, so data that happens to
+    # be the end of a string still gets its own copy.
+    space = freespace.init([SECTOR_A])
+    freespace.alloc_string(space, b"Hole 1\x00", 0x10)
+    freespace.alloc(space, b"1\x00", 0x20)
+    layout = freespace.get_layout(space)
+
+    assert get_addresses(layout) == [0x80100000, 0x80100007]
+    assert layout["sectors"][0]["data"] == b"Hole 1\x001\x00"
+
+
+def test_alignment_gaps_are_filled():
+    space = freespace.init([SECTOR_A])
+    freespace.alloc(space, b"\xAA", 0x10)
+    freespace.alloc(space, b"\xBB" * 8, 0x20, alignment=8)
+    freespace.alloc(space, b"\xCC" * 3, 0x30)
+    layout = freespace.get_layout(space)
+
+    assert get_addresses(layout) == [0x80100000, 0x80100008, 0x80100001]
+    assert layout["sectors"][0]["data"] == b"\xAA" + b"\xCC" * 3 + bytes(4) + b"\xBB" * 8
+
+
+def test_overflow_to_next_sector():
+    space = freespace.init([SECTOR_A, SECTOR_B])
+    freespace.alloc(space, bytes(0x30), 0x10)
+    freespace.alloc(space, b"\x01" * 0x18, 0x20)
+    freespace.alloc(space, b"\x02" * 0x10, 0x30)
+    freespace.alloc(space, b"\x03" * 4, 0x40, alignment=4)
+    layout = freespace.get_layout(space)
+
+    # The second sector starts at an unaligned address, so aligned data has
+    # to skip its first bytes.
+    assert get_addresses(layout) == [0x80100000, 0x80200002, 0x80100030, 0x8020001C]
+    assert len(layout["sectors"][0]["data"]) == 0x40
+    assert layout["sectors"][1]["data"] == b"\x01" * 0x18 + bytes(2) + b"\x03" * 4
+    assert [sector["num_blocks"] for sector in layout["sectors"]] == [2, 2]
+
+
+def test_overflow_fails():
+    space = freespace.init([SECTOR_A, SECTOR_B])
+    freespace.alloc(space, bytes(0x30), 0x10)
+    freespace.alloc(space, b"\x01" * 0x30, 0x20)
+    with pytest.raises(SystemExit) as excinfo:
+        freespace.get_layout(space)
+    assert "Failed to allocate 48 bytes" in str(excinfo.value.code)
+
+
+def test_unterminated_string_fails():
+    space = freespace.init([SECTOR_A])
+    with pytest.raises(SystemExit):
+        freespace.alloc_string(space, b"Rings", 0x10)
+
+
+def test_report():
+    space = freespace.init([SECTOR_A])
+    freespace.alloc_string(space, b"Ring Attack: Rings\x00", 0x10)
+    freespace.alloc_string(space, b"Rings\x00", 0x20)
+    lines = freespace.get_report(freespace.get_layout(space))
+    assert lines == [
+        "Free space 0x80100000: 0x13 of 0x40 bytes used (29.7%), 1 block(s)",
+        "Free space: 2 allocation(s) of 0x19 bytes stored in 0x13 bytes (0x6 bytes saved by sharing)",
+    ]
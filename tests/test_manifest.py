@@ -0,0 +1,150 @@
+import os
+
+import pytest
+
+import manifest
+
+CONFIG = {"compress_level": "greedy", "title": b"Mario Golf"}
+
+
+def write(filepath, data, mtime_ns):
+    with open(filepath, "wb") as f:
+        f.write(data)
+    # Set the modification time explicitly, since writes in quick succession
+    # can share one.
+    os.utime(filepath, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture
+def build(tmp_path):
+    """
+    Builds "a.bin" from the input "a.json", and records it in a manifest.
+    """
+    write(str(tmp_path / "a.json"), b"{}", 1000)
+    output_filepath = str(tmp_path / "a.bin")
+    write(output_filepath, b"output", 1000)
+    build_manifest = manifest.load(str(tmp_path))
+    record = manifest.get_record(str(tmp_path), ["a.json"], CONFIG)
+    manifest.update(build_manifest, manifest.SECTION_STAGE, "a.bin", record, output_filepath)
+    return tmp_path, build_manifest
+
+
+def get_changes(build, config=CONFIG):
+    tmp_path, build_manifest = build
+    record = manifest.get_record(str(tmp_path), ["a.json"], config)
+    return manifest.get_changes(build_manifest, manifest.SECTION_STAGE, "a.bin", record, str(tmp_path / "a.bin"))
+
+
+def test_never_built(tmp_path):
+    build_manifest = manifest.load(str(tmp_path))
+    record = manifest.get_record(str(tmp_path), ["a.json"], CONFIG)
+    assert manifest.get_changes(build_manifest, manifest.SECTION_STAGE, "a.bin", record, str(tmp_path / "a.bin")) == ["never built"]
+
+
+def test_unchanged(build):
+    assert get_changes(build) == []
+
+
+def test_input_changed(build):
+    tmp_path, _ = build
+    write(str(tmp_path / "a.json"), b"[]", 2000)
+    assert get_changes(build) == ["'a.json' changed"]
+
+
+def test_input_touched(build):
+    tmp_path, _ = build
+    write(str(tmp_path / "a.json"), b"{}", 2000)
+    assert get_changes(build) == []
+
+
+def test_config_changed(build):
+    assert get_changes(build, dict(CONFIG, title=b"Mario Golf 2")) == ["config changed"]
+
+
+def test_output_tampered(build):
+    tmp_path, _ = build
+    write(str(tmp_path / "a.bin"), b"OUTPUT", 2000)
+    assert get_changes(build) == ["output was modified"]
+
+    # A different time alone isn't a modification, since the output is
+    # hashed again.
+    write(str(tmp_path / "a.bin"), b"output", 3000)
+    assert get_changes(build) == []
+
+    os.remove(str(tmp_path / "a.bin"))
+    assert get_changes(build) == ["output is missing"]
+
+
+def test_all_changes(build):
+    tmp_path, _ = build
+    write(str(tmp_path / "a.json"), b"[]", 2000)
+    write(str(tmp_path / "a.bin"), b"OUTPUT", 2000)
+    assert get_changes(build, {}) == ["'a.json' changed", "config changed", "output was modified"]
+
+
+def test_output_not_hashed(build):
+    tmp_path, build_manifest = build
+    output_filepath = str(tmp_path / "a.bin")
+    write(output_filepath, b"patched", 2000)
+    record = manifest.get_record(str(tmp_path), ["a.json"], CONFIG)
+    manifest.update(build_manifest, manifest.SECTION_STAGE, "a.bin", record, output_filepath, hash_output=False)
+    entry = build_manifest[manifest.SECTION_STAGE]["a.bin"]
+    assert entry["output"] is None
+    assert (entry["output_size"], entry["output_mtime"]) == (7, 2000)
+    assert manifest.get_output_change(entry, output_filepath) is None
+    assert get_changes(build) == []
+
+    # Without a hash, a different time counts as a modification.
+    write(output_filepath, b"patched", 3000)
+    assert manifest.get_output_change(entry, output_filepath) == "output was modified"
+    assert get_changes(build) == ["output was modified"]
+
+
+def test_output_in_memory(tmp_path):
+    build_manifest = manifest.load(str(tmp_path))
+    record = manifest.get_data_record({"a.json": b"{}"}, CONFIG)
+    manifest.update(build_manifest, manifest.SECTION_APPLY, "files/a.bin", record, None, output_data=b"output")
+    entry = build_manifest[manifest.SECTION_APPLY]["files/a.bin"]
+
+    assert manifest.get_output_change(entry, None, lambda: b"output") is None
+    assert manifest.get_output_change(entry, None, lambda: b"OUTPUT") == "output was modified"
+    assert manifest.get_output_change(entry, None, lambda: None) == "output is missing"
+    changes = manifest.get_changes(build_manifest, manifest.SECTION_APPLY, "files/a.bin", record, None, lambda: b"output")
+    assert changes == []
+
+
+def test_save_load(build):
+    tmp_path, build_manifest = build
+    manifest.save(str(tmp_path), build_manifest)
+    assert manifest.load(str(tmp_path)) == build_manifest
+    assert not os.path.exists(manifest.get_manifest_filepath(str(tmp_path)) + ".tmp")
+
+
+def test_load_other_version(tmp_path):
+    build_manifest = manifest.load(str(tmp_path))
+    build_manifest["version"] = manifest.MANIFEST_VERSION - 1
+    build_manifest[manifest.SECTION_STAGE]["a.bin"] = {}
+    manifest.save(str(tmp_path), build_manifest)
+    assert manifest.load(str(tmp_path))[manifest.SECTION_STAGE] == {}
+
+    with open(manifest.get_manifest_filepath(str(tmp_path)), "w") as f:
+        f.write("{")
+    assert manifest.load(str(tmp_path))[manifest.SECTION_STAGE] == {}
+
+
+def test_patch_entry(build):
+    tmp_path, build_manifest = build
+    output_filepath = str(tmp_path / "a.bin")
+    record = dict(manifest.get_record(str(tmp_path), ["a.json"], CONFIG), patch=[[0, 4]])
+    assert manifest.get_patch_entry(build_manifest, manifest.SECTION_STAGE, "a.bin", record, "a.json", output_filepath) is None
+
+    manifest.update(build_manifest, manifest.SECTION_STAGE, "a.bin", record, output_filepath)
+    entry = manifest.get_patch_entry(build_manifest, manifest.SECTION_STAGE, "a.bin", record, "a.json", output_filepath)
+    assert entry["patch"] == [[0, 4]]
+
+    write(output_filepath, b"OUTPUT", 2000)
+    assert manifest.get_patch_entry(build_manifest, manifest.SECTION_STAGE, "a.bin", record, "a.json", output_filepath) is None
+    write(output_filepath, b"output", 3000)
+    write(str(tmp_path / "a.json"), b"[]", 2000)
+    record = dict(manifest.get_record(str(tmp_path), ["a.json"], CONFIG), patch=[[0, 4]])
+    assert manifest.get_patch_entry(build_manifest, manifest.SECTION_STAGE, "a.bin", record, "a.json", output_filepath) is None
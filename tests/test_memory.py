@@ -0,0 +1,57 @@
+import os
+import tracemalloc
+
+import benchmark
+import compression
+
+DATA_SIZE = 3 * 1024 * 1024
+
+# Peak memory allowed while compressing or decompressing DATA_SIZE bytes,
+# on top of the input and output. Neither grows with the size of the data.
+MAX_COMPRESS_PEAK = 2 * 1024 * 1024
+MAX_DECOMPRESS_PEAK = 512 * 1024
+
+
+def get_data():
+    # Repeat a chunk of overlay-like data that fits in the window, with a
+    # byte changed each time, so it's quick to compress but still needs
+    # real matches.
+    chunk = benchmark.make_overlay_data(0x800)
+    data = bytearray()
+    for i in range(DATA_SIZE // len(chunk)):
+        chunk = bytearray(chunk)
+        chunk[(i * 0x1234) % len(chunk)] ^= 0xFF
+        data.extend(chunk)
+    return bytes(data)
+
+
+def measure_peak(func, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        result = func(*args, **kwargs)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def decompress_all(compressed):
+    size = 0
+    for chunk in compression.iter_decompress(compressed):
+        size += len(chunk)
+    return size
+
+
+def test_compress_and_decompress_memory():
+    data = get_data()
+    # The compressed data is written to a file as it's encoded, so it isn't
+    # counted either.
+    with open(os.devnull, "wb") as f:
+        compressed_size, compress_peak = measure_peak(compression.compress, data, f=f, backend=compression.LZ_BACKEND_PYTHON)
+    assert compress_peak < MAX_COMPRESS_PEAK
+
+    compressed = compression.compress(data, backend=compression.LZ_BACKEND_PYTHON)
+    assert len(compressed) == compressed_size
+    decompressed_size, decompress_peak = measure_peak(decompress_all, compressed)
+    assert decompressed_size == len(data)
+    assert decompress_peak < MAX_DECOMPRESS_PEAK
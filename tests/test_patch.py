@@ -0,0 +1,89 @@
+import pytest
+
+import patch
+
+
+def make_patch(size=None):
+    file_patch = patch.init(size)
+    patch.pack_into(">I", file_patch, 0x4, 0x12345678)
+    patch.write(file_patch, 0x10, b"edit")
+    return file_patch
+
+
+def test_apply():
+    data = bytearray(0x20)
+    patch.apply(make_patch(), data)
+    assert data[0x4:0x8] == b"\x12\x34\x56\x78"
+    assert data[0x10:0x14] == b"edit"
+    assert len(data) == 0x20
+
+    data = bytearray(0x20)
+    patch.apply(make_patch(0x18), data)
+    assert len(data) == 0x18
+    patch.apply(make_patch(0x40), data)
+    assert data[0x18:] == bytes(0x28)
+
+
+def test_apply_out_of_bounds():
+    file_patch = patch.init()
+    patch.write(file_patch, 0x1E, b"edit")
+    with pytest.raises(SystemExit):
+        patch.apply(file_patch, bytearray(0x20))
+
+
+def test_apply_to_file(tmp_path):
+    filepath = str(tmp_path / "a.bin")
+    with open(filepath, "wb") as f:
+        f.write(bytes(0x20))
+    expected = bytearray(0x20)
+    patch.apply(make_patch(), expected)
+
+    assert patch.apply_to_file(make_patch(), filepath) == 8
+    with open(filepath, "rb") as f:
+        assert f.read() == expected
+    # Edits that are already in the file aren't written again.
+    assert patch.apply_to_file(make_patch(), filepath) == 0
+
+
+def test_apply_to_file_resize(tmp_path):
+    filepath = str(tmp_path / "a.bin")
+    with open(filepath, "wb") as f:
+        f.write(b"\xff" * 0x20)
+    for size in [0x18, 0x40]:
+        expected = bytearray(b"\xff" * 0x20)
+        patch.apply(make_patch(size), expected)
+        with open(filepath, "wb") as f:
+            f.write(b"\xff" * 0x20)
+        patch.apply_to_file(make_patch(size), filepath)
+        with open(filepath, "rb") as f:
+            assert f.read() == expected
+
+
+def test_apply_to_file_empty(tmp_path):
+    filepath = str(tmp_path / "a.bin")
+    with open(filepath, "wb"):
+        pass
+    assert patch.apply_to_file(patch.init(), filepath) == 0
+    with pytest.raises(SystemExit):
+        patch.apply_to_file(make_patch(), filepath)
+
+
+def test_get_ranges():
+    file_patch = make_patch()
+    patch.write(file_patch, 0x6, b"\x00" * 4)
+    patch.write(file_patch, 0x14, b"\x00")
+    assert patch.get_ranges(file_patch) == [[0x4, 0xA], [0x10, 0x15]]
+
+
+def test_covers():
+    ranges = patch.get_ranges(make_patch())
+    assert patch.covers(make_patch(), ranges, 0x20, 0x20)
+
+    smaller = patch.init()
+    patch.write(smaller, 0x10, b"edit")
+    assert not patch.covers(smaller, ranges, 0x20, 0x20)
+
+    # Ranges past the new end of the file don't need to be rewritten, but
+    # the zeros a file is extended with do.
+    assert patch.covers(smaller, [[0x10, 0x14], [0x18, 0x1C]], 0x20, 0x14)
+    assert not patch.covers(make_patch(0x40), ranges, 0x20, 0x40)
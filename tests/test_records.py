@@ -0,0 +1,111 @@
+import struct
+
+import pytest
+
+import records
+import tt_config
+
+GOLF_STATS = {
+    "drive_distance": 230,
+    "shot_loft": -2,
+    "shot_curve_direction": "fade",
+    "shot_curve_amount": 12,
+    "impact": 3,
+    "control": -1,
+    "spin": 5,
+}
+
+SELECT_STATS = {
+    "index": 4,
+    "character_id": 0x15,
+    "drive_distance": 230,
+    "shot_loft": -2,
+    "shot_curve_direction": "draw",
+    "shot_curve_amount": 12,
+    "impact": 3,
+    "control": -1,
+    "spin": 5,
+}
+
+
+def test_golf_stats_round_trip():
+    schema = tt_config.character_golf_stats_record
+    stats = [GOLF_STATS, dict(GOLF_STATS, drive_distance=250, shot_curve_direction="draw")]
+    data = records.pack_table(schema, stats)
+
+    assert len(data) == 2 * schema["size"]
+    assert data[:0xC] == struct.pack(">IiI", 230, -2, 1)
+    assert records.unpack_table(schema, data, count=2) == stats
+    assert records.unpack_table(schema, b"\xff" * 4 + data, offset=4, count=1) == stats[:1]
+
+
+def test_select_stats_round_trip():
+    schema = tt_config.character_select_stats_record
+    data = records.pack_table(schema, [SELECT_STATS])
+
+    assert data == struct.pack(">BBHbBBbbb", 4, 0x15, 230, -2, 0, 12, 3, -1, 5)
+    assert records.unpack_table(schema, data, count=1) == [SELECT_STATS]
+
+
+def test_ring_table_round_trip():
+    schema = tt_config.ring_attack_ring_record
+    rings = [
+        {"x": 1.5, "y": -2.0, "z": 100.25, "rotationX": 0.0, "rotationY": 90.0, "scaleX": 1.0, "scaleY": 0.5},
+        {"x": 0.0, "y": 0.0, "z": 0.0, "rotationX": 45.0, "rotationY": 0.0, "scaleX": 2.0, "scaleY": 2.0},
+    ]
+    data = records.pack_table(schema, rings)
+
+    assert data[:4] == struct.pack(">I", 2)
+    assert len(data) == 4 + 2 * schema["size"]
+    assert records.unpack_table(schema, data) == rings
+    assert records.pack_table(schema, []) == struct.pack(">I", 0)
+    assert records.unpack_table(schema, struct.pack(">I", 0)) == []
+
+
+def test_nonzero_curve_direction_is_fade():
+    schema = tt_config.character_golf_stats_record
+    data = struct.pack(">IiIIiii", 230, -2, 2, 12, 3, -1, 5)
+    assert records.unpack_table(schema, data, count=1)[0]["shot_curve_direction"] == "fade"
+
+
+def test_extra_keys_are_ignored():
+    schema = tt_config.character_golf_stats_record
+    data = records.pack_table(schema, [dict(GOLF_STATS, character_label="Mario")])
+    assert data == records.pack_table(schema, [GOLF_STATS])
+
+
+def test_invalid_records():
+    schema = tt_config.character_golf_stats_record
+    with pytest.raises(SystemExit) as excinfo:
+        records.pack_table(schema, [dict(GOLF_STATS, shot_curve_direction="hook")])
+    assert "Invalid value 'hook' for 'shot_curve_direction'" in str(excinfo.value.code)
+
+    missing = dict(GOLF_STATS)
+    del missing["spin"]
+    with pytest.raises(SystemExit) as excinfo:
+        records.pack_table(schema, [missing])
+    assert "missing 'spin'" in str(excinfo.value.code)
+
+    with pytest.raises(SystemExit) as excinfo:
+        records.pack_table(schema, [GOLF_STATS, dict(GOLF_STATS, drive_distance=-1)])
+    assert "record 1" in str(excinfo.value.code)
+
+
+def test_table_past_end_of_data():
+    schema = tt_config.character_golf_stats_record
+    data = records.pack_table(schema, [GOLF_STATS])
+    with pytest.raises(SystemExit):
+        records.unpack_table(schema, data, count=2)
+    with pytest.raises(SystemExit):
+        records.unpack_table(tt_config.ring_attack_ring_record, struct.pack(">I", 1))
+
+
+def test_schema_size_mismatch():
+    schema = {
+        "name": "test_wrong_size",
+        "byte_order": ">",
+        "size": 0x8,
+        "fields": [{"name": "value", "type": "I"}],
+    }
+    with pytest.raises(SystemExit):
+        records.compile_schema(schema)
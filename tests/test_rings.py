@@ -0,0 +1,103 @@
+import random
+
+import pytest
+
+import rings
+
+# Two holes of two rings each, as (x, y, z, rotationX, rotationY, scaleX,
+# scaleY) rows.
+ROWS = [
+    0.0, 10.0, 0.0, 0.0, 90.0, 1.0, 1.0,
+    2.0, 10.0, 4.0, 15.0, 0.0, 2.0, 0.5,
+    100.0, -5.0, 100.0, 0.0, 0.0, 1.0, 1.0,
+    104.0, -5.0, 100.0, 0.0, 0.0, 3.0, 1.0,
+]
+HOLE_INDEXES = [0, 0, 1, 1]
+
+
+def transform(transform, rows=ROWS, hole_indexes=HOLE_INDEXES):
+    return rings.transform_table(rows, hole_indexes, max(hole_indexes) + 1, transform)
+
+
+def get_ring(rows, i):
+    return rows[i * 7:i * 7 + 7]
+
+
+@pytest.fixture(autouse=True)
+def python_path(monkeypatch):
+    # The transforms are checked on the pure-Python path, which is the one
+    # that's always available. The NumPy path is checked against it below.
+    monkeypatch.setattr(rings, "np", None)
+
+
+def test_identity():
+    assert transform(rings.init_transform()) == ROWS
+
+
+def test_translate():
+    rows = transform(rings.init_transform(translate=(1.0, -2.0, 0.5)))
+    assert get_ring(rows, 0) == [1.0, 8.0, 0.5, 0.0, 90.0, 1.0, 1.0]
+    assert get_ring(rows, 3) == [105.0, -7.0, 100.5, 0.0, 0.0, 3.0, 1.0]
+
+
+def test_scale_around_hole_centers():
+    rows = transform(rings.init_transform(scale=(2.0, 1.0, 0.5)))
+    # The first hole's center is (1, 10, 2), and the second's is (102, -5, 100).
+    assert get_ring(rows, 0)[:3] == [-1.0, 10.0, 1.0]
+    assert get_ring(rows, 1)[:3] == [3.0, 10.0, 3.0]
+    assert get_ring(rows, 2)[:3] == [98.0, -5.0, 100.0]
+    assert get_ring(rows, 3)[:3] == [106.0, -5.0, 100.0]
+
+
+def test_rotate_around_pivot():
+    rows = transform(rings.init_transform(rotate=90.0, pivot=(0.0, 0.0, 0.0)))
+    # A quarter turn around the Y axis moves +X to -Z and +Z to +X.
+    assert get_ring(rows, 1)[:3] == pytest.approx([4.0, 10.0, -2.0])
+    assert get_ring(rows, 3)[:3] == pytest.approx([100.0, -5.0, -104.0])
+
+
+def test_rotate_only_moves_positions():
+    rows = transform(rings.init_transform(rotate=45.0))
+    for i in range(len(HOLE_INDEXES)):
+        assert get_ring(rows, i)[3:] == get_ring(ROWS, i)[3:]
+
+
+def test_ring_rotate_and_scale():
+    rows = transform(rings.init_transform(ring_rotate=(10.0, -90.0), ring_scale=(2.0, 4.0)))
+    for i in range(len(HOLE_INDEXES)):
+        before = get_ring(ROWS, i)
+        after = get_ring(rows, i)
+        assert after[:3] == before[:3]
+        assert after[3:5] == [before[3] + 10.0, before[4] - 90.0]
+        assert after[5:7] == [before[5] * 2.0, before[6] * 4.0]
+
+
+def test_clamp_scale():
+    rows = transform(rings.init_transform(ring_scale=(2.0, 2.0), clamp_scale=(1.0, 3.0)))
+    assert [get_ring(rows, i)[5:7] for i in range(len(HOLE_INDEXES))] == [[2.0, 2.0], [3.0, 1.0], [2.0, 2.0], [3.0, 2.0]]
+    with pytest.raises(SystemExit):
+        rings.init_transform(clamp_scale=(3.0, 1.0))
+
+
+def test_results_are_float32():
+    rows = transform(rings.init_transform(translate=(0.1, 0.0, 0.0)))
+    assert rows[0] == pytest.approx(0.1)
+    assert rows[0] != 0.1
+    with pytest.raises(SystemExit):
+        transform(rings.init_transform(scale=(1e39, 1.0, 1.0)))
+
+
+def test_numpy_matches_python(monkeypatch):
+    monkeypatch.setattr(rings, "np", pytest.importorskip("numpy"))
+    rng = random.Random(0)
+    hole_indexes = sorted(rng.randrange(5) for _ in range(200))
+    rows = [rng.uniform(-1000.0, 1000.0) for _ in range(len(hole_indexes) * 7)]
+    transforms = [
+        rings.init_transform(),
+        rings.init_transform(translate=(1.5, -3.0, 7.25), scale=(1.1, 0.9, 2.0), rotate=33.0),
+        rings.init_transform(rotate=-120.0, pivot=(10.0, 0.0, -10.0), ring_rotate=(5.0, 5.0)),
+        rings.init_transform(ring_scale=(0.3, 3.0), clamp_scale=(0.5, 2.0)),
+    ]
+    for ring_transform in transforms:
+        python_rows = rings.transform_table_python(rows, hole_indexes, 5, ring_transform)
+        assert rings.transform_table_numpy(rows, hole_indexes, 5, ring_transform) == python_rows
@@ -0,0 +1,163 @@
+# This file contains logic for reading the game's text table from the .dol
+# file. The table starts with a list of 32-bit offsets, one per string id,
+# relative to the start of the table in memory. The strings themselves are
+# null-terminated, and usually follow the list. For example, if string id 3's
+# entry is the value 0x100, then the string lives at the table's address
+# + 0x100.
+#
+# The table has no count, so it's taken to end where the first string it
+# points to begins. Strings that were moved into free space point past the
+# end of the table's section, so they don't affect the count. Their memory
+# addresses are mapped back to .dol file offsets through the .dol's section
+# headers.
+#
+# The offsets are all read once when the table is opened. Strings are only
+# decoded when they're looked up, and are then memoized. They're decoded as
+# Latin-1, so every byte maps to one character, and strings read and written
+# back unchanged are byte-for-byte the same.
+
+import struct
+
+import tt_config
+from util import fatal_error
+
+# A .dol file's header lists the file offsets of its 7 text sections and 11
+# data sections, followed by their memory addresses, then their sizes.
+DOL_NUM_SECTIONS = 18
+DOL_SECTION_ADDRESSES_OFFSET = 0x48
+DOL_SECTION_SIZES_OFFSET = 0x90
+
+TEXT_ENCODING = "latin-1"
+
+
+def open_table(dol, config=None):
+    """
+    Indexes the text table in the given .dol file contents, which can be
+    mapped. Returns a text table object. The .dol must stay open while the
+    table is used. config defaults to tt_config.dol_text_table.
+    """
+    config = tt_config.dol_text_table if config is None else config
+    file_offset = config["file_offset"]
+    table = {
+        "dol": dol,
+        "file_offset": file_offset,
+        "address": config["address"],
+        "sections": get_dol_sections(dol),
+        "offsets": [],
+        "strings": {},
+    }
+
+    # Read entries until reaching the first string that an entry points to.
+    table_end = len(dol)
+    entry_offset = file_offset
+    while entry_offset + 4 <= table_end:
+        offset = struct.unpack_from(">i", dol, entry_offset)[0]
+        table["offsets"].append(offset)
+        string_offset = get_file_offset(table, config["address"] + offset)
+        if string_offset is not None and entry_offset < string_offset < table_end:
+            table_end = string_offset
+        entry_offset += 4
+    return table
+
+
+def get_dol_sections(dol):
+    """
+    Gets the .dol file's sections, as tuples of (file offset, memory address,
+    size).
+    """
+    sections = []
+    for i in range(DOL_NUM_SECTIONS):
+        file_offset = struct.unpack_from(">I", dol, i * 4)[0]
+        address = struct.unpack_from(">I", dol, DOL_SECTION_ADDRESSES_OFFSET + i * 4)[0]
+        size = struct.unpack_from(">I", dol, DOL_SECTION_SIZES_OFFSET + i * 4)[0]
+        if size > 0:
+            sections.append((file_offset, address, size))
+    return sections
+
+
+def get_file_offset(table, address):
+    """
+    Gets the .dol file offset of a memory address, or None if it isn't in the
+    file. Addresses outside of every section are assumed to be laid out like
+    the text table itself.
+    """
+    for file_offset, section_address, size in table["sections"]:
+        if section_address <= address < section_address + size:
+            offset = file_offset + address - section_address
+            break
+    else:
+        offset = table["file_offset"] + address - table["address"]
+    if offset < 0 or offset >= len(table["dol"]):
+        return None
+    return offset
+
+
+def get_num_strings(table):
+    """
+    Gets the number of string ids in the text table.
+    """
+    return len(table["offsets"])
+
+
+def get_string_id(table, entry_file_offset):
+    """
+    Gets the id of the string whose table entry is at the given .dol file
+    offset.
+    """
+    string_id, remainder = divmod(entry_file_offset - table["file_offset"], 4)
+    if remainder != 0 or not 0 <= string_id < get_num_strings(table):
+        fatal_error("Offset 0x%X isn't an entry of the text table." % entry_file_offset)
+    return string_id
+
+
+def get_entry_file_offset(table, string_id):
+    """
+    Gets the .dol file offset of a string id's table entry.
+    """
+    return table["file_offset"] + string_id * 4
+
+
+def get_string(table, string_id):
+    """
+    Gets the string with the given id, or None if it doesn't point into the
+    .dol file.
+    """
+    if string_id in table["strings"]:
+        return table["strings"][string_id]
+
+    value = None
+    dol = table["dol"]
+    offset = get_file_offset(table, table["address"] + table["offsets"][string_id])
+    if offset is not None:
+        end = dol.find(b"\0", offset)
+        if end != -1:
+            value = dol[offset:end].decode(TEXT_ENCODING)
+    table["strings"][string_id] = value
+    return value
+
+
+def get_strings(table, exclude_ids=()):
+    """
+    Gets every string in the table, except for the given ids, as a dict of
+    string ids to strings. Ids that don't point to a string are left out.
+    """
+    strings = {}
+    for string_id in range(get_num_strings(table)):
+        if string_id in exclude_ids:
+            continue
+        value = get_string(table, string_id)
+        if value is not None:
+            strings[string_id] = value
+    return strings
+
+
+def encode_string(value):
+    """
+    Converts a string to the null-terminated bytes stored in the table.
+    """
+    if "\0" in value:
+        fatal_error("String %r can't have a null character." % value)
+    try:
+        return value.encode(TEXT_ENCODING) + b"\0"
+    except UnicodeEncodeError:
+        fatal_error("String %r has characters that the game's text can't hold." % value)
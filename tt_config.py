@@ -10,15 +10,70 @@ overlay_files = [
     "core/overlay_golf.bin",
 ]
 
+# Binary record schemas, used by records.py to read and write tables of
+# records. Fields are listed in the order they're stored.
+character_golf_stats_record = {
+    "name": "character_golf_stats",
+    "byte_order": ">",
+    "size": 0x1C,
+    "fields": [
+        {"name": "drive_distance", "type": "I"},
+        {"name": "shot_loft", "type": "i"},
+        {"name": "shot_curve_direction", "type": "I", "values": ["draw", "fade"]},
+        {"name": "shot_curve_amount", "type": "I"},
+        {"name": "impact", "type": "i"},
+        {"name": "control", "type": "i"},
+        {"name": "spin", "type": "i"},
+    ],
+}
+
+# The character select menu keeps a smaller copy of the stats, along with
+# each entry's index and character id.
+character_select_stats_record = {
+    "name": "character_select_stats",
+    "byte_order": ">",
+    "size": 0xA,
+    "fields": [
+        {"name": "index", "type": "B"},
+        {"name": "character_id", "type": "B"},
+        {"name": "drive_distance", "type": "H"},
+        {"name": "shot_loft", "type": "b"},
+        {"name": "shot_curve_direction", "type": "B", "values": ["draw", "fade"]},
+        {"name": "shot_curve_amount", "type": "B"},
+        {"name": "impact", "type": "b"},
+        {"name": "control", "type": "b"},
+        {"name": "spin", "type": "b"},
+    ],
+}
+
+# A Ring Attack file is a count of rings, followed by the rings.
+ring_attack_ring_record = {
+    "name": "ring_attack_ring",
+    "byte_order": ">",
+    "size": 0x1C,
+    "count_type": "I",
+    "fields": [
+        {"name": "x", "type": "f"},
+        {"name": "y", "type": "f"},
+        {"name": "z", "type": "f"},
+        {"name": "rotationX", "type": "f"},
+        {"name": "rotationY", "type": "f"},
+        {"name": "scaleX", "type": "f"},
+        {"name": "scaleY", "type": "f"},
+    ],
+}
+
 # Character golf stats file metadata.
 character_stats = {
     "character_select": {
         "overlay_file": "core/overlay_menu.bin",
         "offset": 0x45b50,
+        "record": character_select_stats_record,
     },
     "golf_overlay_file": {
         "overlay_file": "core/overlay_golf.bin",
         "offset": 0xd2980,
+        "record": character_golf_stats_record,
     },
     "work_file": "characters/stats.json",
     "character_labels": {
@@ -75,6 +130,15 @@ character_stats = {
     ]
 }
 
+# The game's text table in the .dol file, at this file offset and memory
+# address. Its strings are extracted to work_file for editing, except for
+# the Ring Attack hole titles, which are edited in each hole's file.
+dol_text_table = {
+    "file_offset": 0x1401CC,
+    "address": 0x801431CC,
+    "work_file": "text/strings.json",
+}
+
 # List of hole data for Ring Attack that contain Ring Attack ring definitions.
 # 801431CC, 1401CC
 ring_attack_holes = [
@@ -1,5 +1,6 @@
 # This file holds various utility functions.
 
+import concurrent.futures
 import os
 import sys
 
@@ -20,6 +21,64 @@ def fatal_error(message):
     sys.exit("ERROR: %s" % message)
 
 
+def get_error_message(error):
+    """
+    Gets a printable message for an exception. fatal_error() exits with its
+    message, so that is used as-is.
+    """
+    if isinstance(error, SystemExit):
+        return str(error.code)
+    return "ERROR: %s" % error
+
+
+def run_parallel(func, args_list, jobs=1, initializer=None, initargs=()):
+    """
+    Calls func once for each tuple of arguments in args_list, using a pool
+    of `jobs` worker processes. The results are returned in the same order
+    as args_list, as tuples of (return value, error message). The error
+    message is None if the call succeeded. One failing call doesn't stop
+    the others from running. If initializer is given, it's called with
+    initargs once in each worker process, or once in this process if the
+    calls run here, before any of the calls. Data that every call shares
+    can be passed this way, so it's only sent to each worker once.
+    """
+    results = []
+    if jobs <= 1 or len(args_list) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for args in args_list:
+            try:
+                results.append((func(*args), None))
+            except (Exception, SystemExit) as e:
+                results.append((None, get_error_message(e)))
+        return results
+
+    with concurrent.futures.ProcessPoolExecutor(min(jobs, len(args_list)), initializer=initializer, initargs=initargs) as executor:
+        futures = [executor.submit(func, *args) for args in args_list]
+        for future in futures:
+            try:
+                results.append((future.result(), None))
+            except (Exception, SystemExit) as e:
+                results.append((None, get_error_message(e)))
+    return results
+
+
+def call_task(func, *args):
+    """
+    Calls func with the given arguments. run_tasks() uses it to run
+    different functions in one pool.
+    """
+    return func(*args)
+
+
+def run_tasks(tasks, jobs=1):
+    """
+    Like run_parallel(), but for a list of tasks that can each call a
+    different function, given as tuples of (function, args...).
+    """
+    return run_parallel(call_task, tasks, jobs)
+
+
 def assert_dir_exists(directory):
     """
     Checks if the given directory exists. If it doesn't,
@@ -45,23 +104,3 @@ def assert_file_exists(filepath):
     """
     if not os.path.exists(filepath):
         fatal_error("File '%s' doesn't exist." % filepath)
-
-
-def read_c_ascii_string(buff, offset):
-    """
-    Reads a C-style (null-terminated) string from a buffer decoded as ASCII.
-    """
-    s = ""
-    while buff[offset] != 0:
-        s += chr(buff[offset])
-        offset += 1
-    return s
-
-
-def to_c_ascii_string(value):
-    """
-    Converts a Python string to a C-style (null-terminated) ASCII bytearray.
-    """
-    s = bytearray(value, 'ASCII')
-    s.append(0)
-    return s